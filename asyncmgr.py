@@ -83,6 +83,7 @@ class ServerMgr(object):
             self._loop.add(self._sock, eventloop.POLL_IN, self)
         else:
             self._handle_data(sock)
+            return True
 
     def close(self):
         if self._sock:
@@ -18,8 +18,7 @@ class TransferBase(object):
 		import threading
 		self.event = threading.Event()
 		self.key_list = ['port', 'u', 'd', 'transfer_enable', 'passwd', 'enable']
-		self.last_get_transfer = {} #上一次的实际流量
-		self.last_update_transfer = {} #上一次更新到的流量（小于等于实际流量）
+		self.pending_transfer = {} #还未推入数据库的流量
 		self.force_update_transfer = set() #强制推入数据库的ID
 		self.port_uid_table = {} #端口到uid的映射（仅v3以上有用）
 		self.onlineuser_cache = lru_cache.LRUCache(timeout=60*30) #用户在线状态记录
@@ -33,48 +32,40 @@ class TransferBase(object):
 		if self.pull_ok is False:
 			return
 		#更新用户流量到数据库
-		last_transfer = self.last_update_transfer
-		curr_transfer = ServerPool.get_instance().get_servers_transfer()
-		#上次和本次的增量
-		dt_transfer = {}
-		for id in self.force_update_transfer: #此表中的用户统计上次未计入的流量
-			if id in self.last_get_transfer and id in last_transfer:
-				dt_transfer[id] = [self.last_get_transfer[id][0] - last_transfer[id][0], self.last_get_transfer[id][1] - last_transfer[id][1]]
-
+		#本次新增的流量，计数在各worker间共享的表中
+		curr_transfer = ServerPool.get_instance().get_servers_transfer_delta()
+		pending = self.pending_transfer
 		for id in curr_transfer.keys():
-			if id in self.force_update_transfer or id in self.mu_ports:
+			if id in self.mu_ports:
 				continue
-			#算出与上次记录的流量差值，保存于dt_transfer表
-			if id in last_transfer:
-				if curr_transfer[id][0] + curr_transfer[id][1] - last_transfer[id][0] - last_transfer[id][1] <= 0:
-					continue
-				dt_transfer[id] = [curr_transfer[id][0] - last_transfer[id][0],
-								curr_transfer[id][1] - last_transfer[id][1]]
+			u, d = curr_transfer[id]
+			if id in pending:
+				pending[id] = [pending[id][0] + u, pending[id][1] + d]
 			else:
-				if curr_transfer[id][0] + curr_transfer[id][1] <= 0:
-					continue
-				dt_transfer[id] = [curr_transfer[id][0], curr_transfer[id][1]]
-
+				pending[id] = [u, d]
 			#有流量的，先记录在线状态
-			if id in self.last_get_transfer:
-				if curr_transfer[id][0] + curr_transfer[id][1] > self.last_get_transfer[id][0] + self.last_get_transfer[id][1]:
-					self.onlineuser_cache[id] = curr_transfer[id][0] + curr_transfer[id][1]
-			else:
-				self.onlineuser_cache[id] = curr_transfer[id][0] + curr_transfer[id][1]
+			self.onlineuser_cache[id] = u + d
 
 		self.onlineuser_cache.sweep()
 
+		#上次未推入的流量也一起推入
+		dt_transfer = {}
+		for id in pending.keys():
+			if pending[id][0] + pending[id][1] > 0:
+				dt_transfer[id] = list(pending[id])
+
 		update_transfer = self.update_all_user(dt_transfer) #返回有更新的表
-		for id in update_transfer.keys(): #其增量加在此表
-			if id not in self.force_update_transfer: #但排除在force_update_transfer内的
-				last = self.last_update_transfer.get(id, [0,0])
-				self.last_update_transfer[id] = [last[0] + update_transfer[id][0], last[1] + update_transfer[id][1]]
-		self.last_get_transfer = curr_transfer
-		for id in self.force_update_transfer:
-			if id in self.last_update_transfer:
-				del self.last_update_transfer[id]
-			if id in self.last_get_transfer:
-				del self.last_get_transfer[id]
+		for id in update_transfer.keys(): #从未推入的流量中减去
+			if id in pending:
+				u = pending[id][0] - update_transfer[id][0]
+				d = pending[id][1] - update_transfer[id][1]
+				if u + d > 0:
+					pending[id] = [u, d]
+				else:
+					del pending[id]
+		for id in self.force_update_transfer: #已停止的端口不再保留
+			if id in pending:
+				del pending[id]
 		self.force_update_transfer = set()
 
 	def del_server_out_of_bound_safe(self, last_rows, rows):
@@ -103,7 +94,7 @@ class TransferBase(object):
 			if 'id' in row:
 				self.port_uid_table[row['port']] = row['id']
 
-			read_config_keys = ['method', 'obfs', 'obfs_param', 'protocol', 'protocol_param', 'forbidden_ip', 'forbidden_port', 'speed_limit_per_con', 'speed_limit_per_user']
+			read_config_keys = ['method', 'obfs', 'obfs_param', 'protocol', 'protocol_param', 'forbidden_ip', 'forbidden_port', 'speed_limit_per_con', 'speed_limit_per_user', 'speed_limit_per_port']
 			for name in read_config_keys:
 				if name in row and row[name]:
 					cfg[name] = row[name]
@@ -194,9 +185,8 @@ class TransferBase(object):
 		self.mu_ports = mu_servers
 
 	def clear_cache(self, port):
-		if port in self.force_update_transfer: del self.force_update_transfer[port]
-		if port in self.last_get_transfer: del self.last_get_transfer[port]
-		if port in self.last_update_transfer: del self.last_update_transfer[port]
+		self.force_update_transfer.discard(port)
+		if port in self.pending_transfer: del self.pending_transfer[port]
 
 	def new_server(self, port, passwd, cfg):
 		protocol = cfg.get('protocol', ServerPool.get_instance().config.get('protocol', 'origin'))
@@ -265,7 +255,7 @@ class TransferBase(object):
 					trace = traceback.format_exc()
 					logging.error(trace)
 					#logging.warn('db thread except:%s' % e)
-				if db_instance.event.wait(get_config().UPDATE_TIME) or not ServerPool.get_instance().thread.is_alive():
+				if db_instance.event.wait(get_config().UPDATE_TIME) or not ServerPool.get_instance().is_running():
 					break
 		except KeyboardInterrupt as e:
 			pass
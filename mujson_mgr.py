@@ -234,6 +234,7 @@ Options:
   -i MUID              set sub id to display (only work with -l)
   -s SPEED             set speed_limit_per_con
   -S SPEED             set speed_limit_per_user
+  -P SPEED             set speed_limit_per_port, shared fairly by its users
 
 General options:
   -h, --help           show this help message and exit
@@ -241,7 +242,7 @@ General options:
 
 
 def main():
-	shortopts = 'adeclu:i:p:k:O:o:G:g:m:t:f:hs:S:'
+	shortopts = 'adeclu:i:p:k:O:o:G:g:m:t:f:hs:S:P:'
 	longopts = ['help']
 	action = None
 	user = {}
@@ -308,6 +309,8 @@ def main():
 				user['speed_limit_per_con'] = int(value)
 			elif key == '-S':
 				user['speed_limit_per_user'] = int(value)
+			elif key == '-P':
+				user['speed_limit_per_port'] = int(value)
 			elif key == '-m':
 				if value in fast_set_method:
 					user['method'] = fast_set_method[value]
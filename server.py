@@ -43,6 +43,8 @@ class MainThread(threading.Thread):
 
 def main():
 	shell.check_python()
+	# fork the workers, if any, before starting threads
+	server_pool.ServerPool.get_instance()
 	if False:
 		db_transfer.DbTransfer.thread_db()
 	else:
@@ -23,15 +23,20 @@
 
 import os
 import logging
-import struct
 import time
 from shadowsocks import shell, eventloop, tcprelay, udprelay, asyncdns, common
+from shadowsocks.transfer_table import TransferTable
 import threading
 import sys
 import traceback
+import signal
 from socket import *
+from multiprocessing import Pipe
 from configloader import load_config, get_config
 
+# seconds a worker has to answer the master before it's restarted
+WORKER_TIMEOUT = 10
+
 class MainThread(threading.Thread):
 	def __init__(self, params):
 		super(MainThread, self).__init__()
@@ -40,13 +45,60 @@ class MainThread(threading.Thread):
 	def run(self):
 		ServerPool._loop(*self.params)
 
+class WorkerRelay(object):
+	# stands in the pools of the master for the relays of a port, which
+	# run in the worker processes
+
+	def __init__(self, config):
+		self._config = config
+		self.users = None
+
+	def add_to_loop(self, loop):
+		pass
+
+	def close(self, next_tick=False):
+		pass
+
+	def update_users(self, users):
+		# kept for the workers started again
+		self.users = users
+
+class WorkerHandler(object):
+	# runs the commands of the master in a worker process
+
+	def __init__(self, pool, conn):
+		self._pool = pool
+		self._conn = conn
+
+	def handle_event(self, sock, fd, event):
+		# runs all the commands waiting, an edge triggered loop calls it
+		# again after it handled some, recv would block then
+		try:
+			if not self._conn.poll():
+				return False
+			while self._conn.poll():
+				name, args = self._conn.recv()
+				try:
+					ret = getattr(self._pool, name)(*args)
+				except Exception as e:
+					shell.print_exception(e)
+					ret = None
+				self._conn.send(ret)
+		except (EOFError, IOError, OSError):
+			logging.info('master exited, stopping worker')
+			self._pool.loop.remove(self._conn)
+			self._pool.stop()
+		return True
+
 class ServerPool(object):
 
 	instance = None
 
-	def __init__(self):
+	def __init__(self, config=None, is_worker=False, transfer_table=None):
 		shell.check_python()
-		self.config = shell.get_config(False)
+		if config is None:
+			config = shell.get_config(False)
+		self.config = config
 		self.dns_resolver = asyncdns.DNSResolver()
 		if not self.config.get('dns_ipv6', False):
 			asyncdns.IPV6_CONNECTION_SUPPORT = False
@@ -59,9 +111,118 @@ class ServerPool(object):
 		self.udp_ipv6_servers_pool = {}
 		self.stat_counter = {}
 
-		self.loop = eventloop.EventLoop()
-		self.thread = MainThread( (self.loop, self.dns_resolver, self.mgr) )
-		self.thread.start()
+		# with workers the master only keeps WorkerRelay in the pools, and
+		# forwards every change to the workers, each of them listening on
+		# all the ports with SO_REUSEPORT. the workers count the transfer
+		# in the table the master reads
+		self.workers = []
+		self.worker_ports = {}  # port -> user_config, run by the workers
+		self.loop = None
+		table_size = int(self.config.get('transfer_table_size', 65536))
+		workers = int(self.config.get('workers', 1))
+		if workers > 1 and not is_worker:
+			if os.name == 'posix' and common.SO_REUSEPORT is not None:
+				self.config['reuse_port'] = True
+				self.transfer_table = TransferTable(table_size, workers)
+				self._fork_workers(workers)
+				return
+			logging.warn('workers are only available on Unix/Linux with SO_REUSEPORT')
+		if transfer_table is None:
+			transfer_table = TransferTable(table_size)
+		self.transfer_table = transfer_table
+
+		self.loop = eventloop.create_loop(self.config)
+		if not is_worker:
+			self.thread = MainThread( (self.loop, self.dns_resolver, self.mgr) )
+			self.thread.start()
+
+	def _fork_workers(self, count):
+		for i in range(count):
+			self.workers.append(self._fork_worker(i))
+		logging.info('started %d workers' % count)
+
+	def _fork_worker(self, i):
+		conn, worker_conn = Pipe()
+		pid = os.fork()
+		if pid == 0:
+			conn.close()
+			for pid, other_conn in self.workers:
+				other_conn.close()
+			self.transfer_table.set_writer(i)
+			ServerPool._worker(self.config, worker_conn, self.transfer_table)
+			os._exit(0)
+		worker_conn.close()
+		return pid, conn
+
+	@staticmethod
+	def _worker(config, conn, transfer_table):
+		# the worker exits with the master, when its pipe is closed
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		pool = ServerPool(config, True, transfer_table)
+		ServerPool.instance = pool
+		pool.loop.add(conn, eventloop.POLL_IN | eventloop.POLL_ERR, WorkerHandler(pool, conn))
+		ServerPool._loop(pool.loop, pool.dns_resolver, pool.mgr)
+
+	def _call_workers(self, name, *args):
+		# the answers of the workers, None from a worker which died or
+		# didn't answer in time, it is started again
+		failed = set()
+		for i, (pid, conn) in enumerate(self.workers):
+			try:
+				conn.send((name, args))
+			except (IOError, OSError) as e:
+				logging.error('worker %d failed on %s: %s' % (pid, name, e))
+				failed.add(i)
+		ret = []
+		for i, (pid, conn) in enumerate(self.workers):
+			if i not in failed:
+				try:
+					if conn.poll(WORKER_TIMEOUT):
+						ret.append(conn.recv())
+						continue
+					logging.error('worker %d did not answer %s in %d seconds' % (pid, name, WORKER_TIMEOUT))
+				except (EOFError, IOError, OSError) as e:
+					logging.error('worker %d failed on %s: %s' % (pid, name, e))
+			self._restart_worker(i)
+			ret.append(None)
+		return ret
+
+	def _restart_worker(self, i, reaped=False):
+		pid, conn = self.workers[i]
+		conn.close()
+		if not reaped:
+			try:
+				os.kill(pid, signal.SIGKILL)
+				os.waitpid(pid, 0)
+			except OSError:
+				pass
+		# the counters of the worker are left in the table for the new one
+		self.workers[i] = self._fork_worker(i)
+		logging.warn('worker %d exited, started worker %d' % (pid, self.workers[i][0]))
+		# it runs the ports of the master
+		pid, conn = self.workers[i]
+		try:
+			for port, user_config in self.worker_ports.items():
+				ServerPool._call_worker(conn, 'new_server', port, user_config)
+				relay = self.tcp_servers_pool.get(port) or self.tcp_ipv6_servers_pool.get(port)
+				if relay is not None and relay.users is not None:
+					ServerPool._call_worker(conn, 'update_mu_users', port, relay.users)
+		except (EOFError, IOError, OSError) as e:
+			logging.error('worker %d failed to start the ports: %s' % (pid, e))
+
+	@staticmethod
+	def _call_worker(conn, name, *args):
+		conn.send((name, args))
+		if not conn.poll(WORKER_TIMEOUT):
+			raise IOError('no answer to %s in %d seconds' % (name, WORKER_TIMEOUT))
+		return conn.recv()
+
+	def _new_relay(self, relay_class, a_config, stat_counter=None):
+		if self.workers:
+			return WorkerRelay(a_config)
+		relay = relay_class(a_config, self.dns_resolver, False, stat_counter=stat_counter, transfer_table=self.transfer_table)
+		relay.add_to_loop(self.loop)
+		return relay
 
 	@staticmethod
 	def get_instance():
@@ -69,8 +230,25 @@ class ServerPool(object):
 			ServerPool.instance = ServerPool()
 		return ServerPool.instance
 
+	def is_running(self):
+		if self.workers:
+			for i, (pid, conn) in enumerate(self.workers):
+				if os.waitpid(pid, os.WNOHANG)[0] != 0:
+					self._restart_worker(i, True)
+			return True
+		return self.thread.is_alive()
+
 	def stop(self):
-		self.loop.stop()
+		if self.workers:
+			for pid, conn in self.workers:
+				conn.close()
+				try:
+					os.waitpid(pid, 0)
+				except OSError:
+					pass
+			self.workers = []
+		else:
+			self.loop.stop()
 
 	@staticmethod
 	def _loop(loop, dns_resolver, mgr):
@@ -126,12 +304,10 @@ class ServerPool(object):
 				try:
 					logging.info("starting server at [%s]:%d" % (common.to_str(a_config['server']), port))
 
-					tcp_server = tcprelay.TCPRelay(a_config, self.dns_resolver, False, stat_counter=self.stat_counter)
-					tcp_server.add_to_loop(self.loop)
+					tcp_server = self._new_relay(tcprelay.TCPRelay, a_config, self.stat_counter)
 					self.tcp_ipv6_servers_pool.update({port: tcp_server})
 
-					udp_server = udprelay.UDPRelay(a_config, self.dns_resolver, False, stat_counter=self.stat_counter)
-					udp_server.add_to_loop(self.loop)
+					udp_server = self._new_relay(udprelay.UDPRelay, a_config, self.stat_counter)
 					self.udp_ipv6_servers_pool.update({port: udp_server})
 
 					if common.to_str(a_config['server_ipv6']) == "::":
@@ -152,18 +328,19 @@ class ServerPool(object):
 				try:
 					logging.info("starting server at %s:%d" % (common.to_str(a_config['server']), port))
 
-					tcp_server = tcprelay.TCPRelay(a_config, self.dns_resolver, False)
-					tcp_server.add_to_loop(self.loop)
+					tcp_server = self._new_relay(tcprelay.TCPRelay, a_config)
 					self.tcp_servers_pool.update({port: tcp_server})
 
-					udp_server = udprelay.UDPRelay(a_config, self.dns_resolver, False)
-					udp_server.add_to_loop(self.loop)
+					udp_server = self._new_relay(udprelay.UDPRelay, a_config)
 					self.udp_servers_pool.update({port: udp_server})
 
 				except Exception as e:
 					if not ipv6_ok:
 						logging.warn("IPV4 %s " % (e,))
 
+		if self.workers:
+			self.worker_ports[port] = user_config
+			self._call_workers('new_server', port, user_config)
 		return True
 
 	def del_server(self, port):
@@ -211,6 +388,9 @@ class ServerPool(object):
 				except Exception as e:
 					logging.warn(e)
 
+		if self.workers:
+			self.worker_ports.pop(port, None)
+			self._call_workers('cb_del_server', port)
 		return True
 
 	def update_mu_users(self, port, users):
@@ -233,61 +413,23 @@ class ServerPool(object):
 				self.udp_ipv6_servers_pool[port].update_users(users)
 			except Exception as e:
 				logging.warn(e)
+		if self.workers:
+			self._call_workers('update_mu_users', port, users)
 
-	def get_server_transfer(self, port):
-		port = int(port)
-		uid = struct.pack('<I', port)
-		ret = [0, 0]
-		if port in self.tcp_servers_pool:
-			ret[0], ret[1] = self.tcp_servers_pool[port].get_ud()
-		if port in self.udp_servers_pool:
-			u, d = self.udp_servers_pool[port].get_ud()
-			ret[0] += u
-			ret[1] += d
-		if port in self.tcp_ipv6_servers_pool:
-			u, d = self.tcp_ipv6_servers_pool[port].get_ud()
-			ret[0] += u
-			ret[1] += d
-		if port in self.udp_ipv6_servers_pool:
-			u, d = self.udp_ipv6_servers_pool[port].get_ud()
-			ret[0] += u
-			ret[1] += d
-		return ret
+	def get_transfer_overflow(self):
+		return self.transfer_table.overflow()
 
-	def get_server_mu_transfer(self, server):
-		return server.get_users_ud()
-
-	def update_mu_transfer(self, user_dict, u, d):
-		for uid in u:
-			port = struct.unpack('<I', uid)[0]
-			if port not in user_dict:
-				user_dict[port] = [0, 0]
-			user_dict[port][0] += u[uid]
-		for uid in d:
-			port = struct.unpack('<I', uid)[0]
-			if port not in user_dict:
-				user_dict[port] = [0, 0]
-			user_dict[port][1] += d[uid]
+	def _transfer_overflows(self):
+		# the ids the workers count beyond the capacity of the table
+		if self.workers:
+			return self._call_workers('get_transfer_overflow')
+		return []
 
 	def get_servers_transfer(self):
-		servers = self.tcp_servers_pool.copy()
-		servers.update(self.tcp_ipv6_servers_pool)
-		servers.update(self.udp_servers_pool)
-		servers.update(self.udp_ipv6_servers_pool)
-		ret = {}
-		for port in servers.keys():
-			ret[port] = self.get_server_transfer(port)
-		for port in self.tcp_servers_pool:
-			u, d = self.get_server_mu_transfer(self.tcp_servers_pool[port])
-			self.update_mu_transfer(ret, u, d)
-		for port in self.tcp_ipv6_servers_pool:
-			u, d = self.get_server_mu_transfer(self.tcp_ipv6_servers_pool[port])
-			self.update_mu_transfer(ret, u, d)
-		for port in self.udp_servers_pool:
-			u, d = self.get_server_mu_transfer(self.udp_servers_pool[port])
-			self.update_mu_transfer(ret, u, d)
-		for port in self.udp_ipv6_servers_pool:
-			u, d = self.get_server_mu_transfer(self.udp_ipv6_servers_pool[port])
-			self.update_mu_transfer(ret, u, d)
-		return ret
+		# {port or user id: [upload, download]} since the start
+		return self.transfer_table.snapshot(self._transfer_overflows())
+
+	def get_servers_transfer_delta(self):
+		# {port or user id: [upload, download]} since the last call
+		return self.transfer_table.delta(self._transfer_overflows())
 
@@ -20,6 +20,7 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import socket
+import errno
 import struct
 import re
 import logging
@@ -264,6 +265,10 @@ class DNSResponse(object):
 STATUS_IPV4 = 0
 STATUS_IPV6 = 1
 
+# with IPv6, AAAA and A are queried at once. an A answer is only used after
+# waiting this long for the AAAA one, as in RFC 8305
+RESOLUTION_DELAY = 0.05
+
 
 class DNSResolver(object):
 
@@ -274,6 +279,10 @@ class DNSResolver(object):
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
         self._cache = lru_cache.LRUCache(timeout=300)
+        # the A answers when the AAAA ones are preferred, for happy eyeballs
+        self._cache_v4 = lru_cache.LRUCache(timeout=300)
+        self._sweeper = None
+        self._sweeper_v4 = None
         self._sock = None
         self._servers = None
         self._parse_resolv()
@@ -353,7 +362,8 @@ class DNSResolver(object):
                                    socket.SOL_UDP)
         self._sock.setblocking(False)
         loop.add(self._sock, eventloop.POLL_IN, self)
-        loop.add_periodic(self.handle_periodic)
+        self._sweeper = lru_cache.Sweeper(loop, self._cache)
+        self._sweeper_v4 = lru_cache.Sweeper(loop, self._cache_v4)
 
     def _call_callback(self, hostname, ip, error=None):
         callbacks = self._hostname_to_cb.get(hostname, [])
@@ -381,19 +391,7 @@ class DNSResolver(object):
                     ip = answer[0]
                     break
             if IPV6_CONNECTION_SUPPORT:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV4) \
-                        == STATUS_IPV6:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV4:
-                        for question in response.questions:
-                            if question[1] == QTYPE_A:
-                                self._call_callback(hostname, None)
-                                break
+                self._handle_dual_stack(hostname, response, ip)
             else:
                 if not ip and self._hostname_status.get(hostname, STATUS_IPV6) \
                         == STATUS_IPV4:
@@ -409,9 +407,57 @@ class DNSResolver(object):
                                 self._call_callback(hostname, None)
                                 break
 
+    def _handle_dual_stack(self, hostname, response, ip):
+        # the status is the set of the query types still waiting for an
+        # answer, the AAAA answer wins unless it does not come in time
+        qtype = None
+        for question in response.questions:
+            if question[1] in (QTYPE_A, QTYPE_AAAA):
+                qtype = question[1]
+                break
+        if qtype is None:
+            return
+        if ip and common.is_ip(ip) == socket.AF_INET:
+            qtype = QTYPE_A
+        elif ip:
+            qtype = QTYPE_AAAA
+        pending = self._hostname_status.get(hostname, None)
+        if pending is not None:
+            pending.discard(qtype)
+        if ip and qtype == QTYPE_AAAA:
+            self._cache[hostname] = ip
+            self._call_callback(hostname, ip)
+        elif ip:
+            self._cache_v4[hostname] = ip
+            if pending is None:
+                return
+            if QTYPE_AAAA in pending:
+                self._loop.call_later(RESOLUTION_DELAY,
+                                      self._resolution_delay_done, hostname)
+            else:
+                self._cache[hostname] = ip
+                self._call_callback(hostname, ip)
+        elif pending is not None and not pending:
+            # AAAA failed after A was answered, or both failed
+            self._call_callback(hostname, self._cache_v4.get(hostname, None))
+
+    def _resolution_delay_done(self, hostname):
+        pending = self._hostname_status.get(hostname, None)
+        if pending is not None and pending == set([QTYPE_AAAA]):
+            ip = self._cache_v4.get(hostname, None)
+            if ip:
+                self._cache[hostname] = ip
+                self._call_callback(hostname, ip)
+
+    def ipv4_address(self, hostname):
+        # the IPv4 address of hostname learnt while resolving it to IPv6
+        if type(hostname) != bytes:
+            hostname = hostname.encode('utf8')
+        return self._cache_v4.get(hostname, None)
+
     def handle_event(self, sock, fd, event):
         if sock != self._sock:
-            return
+            return False
         if event & eventloop.POLL_ERR:
             logging.error('dns socket err')
             self._loop.remove(self._sock)
@@ -422,14 +468,18 @@ class DNSResolver(object):
             self._sock.setblocking(False)
             self._loop.add(self._sock, eventloop.POLL_IN, self)
         else:
-            data, addr = sock.recvfrom(1024)
+            try:
+                data, addr = sock.recvfrom(1024)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) in (errno.EAGAIN,
+                                                         errno.EWOULDBLOCK):
+                    return False
+                raise
             if addr not in self._servers:
                 logging.warn('received a packet other than our dns')
-                return
+                return True
             self._handle_data(data)
-
-    def handle_periodic(self):
-        self._cache.sweep()
+        return True
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -481,8 +531,10 @@ class DNSResolver(object):
             arr = self._hostname_to_cb.get(hostname, None)
             if not arr:
                 if IPV6_CONNECTION_SUPPORT:
-                    self._hostname_status[hostname] = STATUS_IPV6
+                    self._hostname_status[hostname] = \
+                        set([QTYPE_AAAA, QTYPE_A])
                     self._send_req(hostname, QTYPE_AAAA)
+                    self._send_req(hostname, QTYPE_A)
                 else:
                     self._hostname_status[hostname] = STATUS_IPV4
                     self._send_req(hostname, QTYPE_A)
@@ -492,14 +544,16 @@ class DNSResolver(object):
                 arr.append(callback)
                 # TODO send again only if waited too long
                 if IPV6_CONNECTION_SUPPORT:
-                    self._send_req(hostname, QTYPE_AAAA)
+                    for qtype in self._hostname_status.get(hostname, ()):
+                        self._send_req(hostname, qtype)
                 else:
                     self._send_req(hostname, QTYPE_A)
 
     def close(self):
         if self._sock:
             if self._loop:
-                self._loop.remove_periodic(self.handle_periodic)
+                self._sweeper.cancel()
+                self._sweeper_v4.cancel()
                 self._loop.remove(self._sock)
             self._sock.close()
             self._sock = None
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# runs the relays on an asyncio event loop, or on uvloop when installed
+# Python 3 only, use eventloop.create_loop to get a loop from the config
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import errno
+import socket
+import logging
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None  # Python 2
+
+from shadowsocks import shell, eventloop
+from shadowsocks.eventloop import POLL_NULL, POLL_IN, POLL_OUT, POLL_ERR, \
+    TIMEOUT_PRECISION
+
+
+class AsyncioLoop(object):
+    """Same interface as eventloop.EventLoop, for TCPRelay, UDPRelay and
+    DNSResolver. asyncio_loop is the underlying loop, other asyncio services
+    may use it as well"""
+
+    def __init__(self, config=None):
+        if config is None:
+            config = {}
+        model = 'asyncio'
+        loop = None
+        if config.get('event_loop') == 'uvloop':
+            try:
+                import uvloop
+                loop = uvloop.new_event_loop()
+                model = 'uvloop'
+            except ImportError:
+                logging.warn('uvloop not installed, using asyncio')
+        if loop is None:
+            loop = asyncio.SelectorEventLoop()
+        self.asyncio_loop = loop
+        self._fdmap = {}  # (f, handler, mode)
+        # stream sockets not writable yet, maybe still connecting
+        self._unconnected = set()
+        self._periodic_callbacks = []
+        self._periodic_timer = None
+        logging.debug('using event model: %s', model)
+
+    @property
+    def now(self):
+        # EventLoop.now, asyncio reads its monotonic clock every time
+        return self.asyncio_loop.time()
+
+    def _on_event(self, fd, event):
+        item = self._fdmap.get(fd, None)
+        if item is not None:
+            if event == POLL_OUT and fd in self._unconnected:
+                # asyncio reports a failed connect as writable only, where
+                # epoll adds POLL_ERR. it has no peer; getpeername() keeps
+                # SO_ERROR for the handler to log, getsockopt would clear it
+                self._unconnected.discard(fd)
+                try:
+                    item[0].getpeername()
+                except (OSError, IOError):
+                    event = POLL_ERR
+            try:
+                item[1].handle_event(item[0], fd, event)
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+
+    def _watch(self, fd, old_mode, mode):
+        # asyncio has no POLL_ERR, errors show up as readable and writable,
+        # or not at all for a fd only waiting for POLL_ERR
+        loop = self.asyncio_loop
+        if (old_mode ^ mode) & POLL_IN:
+            if mode & POLL_IN:
+                loop.add_reader(fd, self._on_event, fd, POLL_IN)
+            else:
+                loop.remove_reader(fd)
+        if (old_mode ^ mode) & POLL_OUT:
+            if mode & POLL_OUT:
+                loop.add_writer(fd, self._on_event, fd, POLL_OUT)
+            else:
+                loop.remove_writer(fd)
+
+    def add(self, f, mode, handler, exclusive=False):
+        fd = f.fileno()
+        self._fdmap[fd] = (f, handler, mode)
+        if getattr(f, 'type', None) == socket.SOCK_STREAM:
+            self._unconnected.add(fd)
+        self._watch(fd, POLL_NULL, mode)
+
+    def remove(self, f):
+        self.removefd(f.fileno())
+
+    def removefd(self, fd):
+        item = self._fdmap.pop(fd)
+        self._unconnected.discard(fd)
+        self._watch(fd, item[2], POLL_NULL)
+
+    def modify(self, f, mode):
+        fd = f.fileno()
+        item = self._fdmap[fd]
+        self._fdmap[fd] = (item[0], item[1], mode)
+        self._watch(fd, item[2], mode)
+
+    def requeue(self, f, event):
+        # asyncio is level triggered
+        pass
+
+    def add_periodic(self, callback):
+        self._periodic_callbacks.append(callback)
+        if self._periodic_timer is None:
+            self._periodic_timer = self.asyncio_loop.call_later(
+                TIMEOUT_PRECISION, self._run_periodic)
+
+    def remove_periodic(self, callback):
+        self._periodic_callbacks.remove(callback)
+
+    def _run_periodic(self):
+        for callback in list(self._periodic_callbacks):
+            callback()
+        self._periodic_timer = self.asyncio_loop.call_later(
+            TIMEOUT_PRECISION, self._run_periodic)
+
+    def call_later(self, delay, callback, *args):
+        return self.asyncio_loop.call_later(delay, callback, *args)
+
+    def cancel(self, timer):
+        timer.cancel()
+
+    def call_soon(self, callback, *args):
+        self.asyncio_loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        # ServerPool.stop calls this from the db thread
+        self.asyncio_loop.call_soon_threadsafe(self.asyncio_loop.stop)
+
+    def run(self):
+        asyncio.set_event_loop(self.asyncio_loop)
+        self.asyncio_loop.run_forever()
+
+
+def test():
+    if asyncio is None:
+        return
+
+    loop = AsyncioLoop()
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    events = []
+
+    class Handler(object):
+        def handle_event(self, sock, fd, event):
+            events.append(event)
+            if event & POLL_OUT:
+                sock.send(b'x')
+                loop.modify(sock, POLL_NULL)
+            else:
+                assert sock.recv(1) == b'x'
+                loop.stop()
+
+    handler = Handler()
+    loop.add(a, POLL_OUT, handler)
+    loop.add(b, POLL_IN | eventloop.POLL_ERR, handler)
+    loop.run()
+    assert events == [POLL_OUT, POLL_IN], events
+    loop.remove(a)
+    loop.remove(b)
+    a.close()
+    b.close()
+
+    # a refused connect is POLL_ERR, as with epoll
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    sock = socket.socket()
+    sock.setblocking(False)
+    try:
+        sock.connect(('127.0.0.1', port))
+    except (OSError, IOError):
+        pass
+    del events[:]
+
+    class Connecting(object):
+        def handle_event(self, sock, fd, event):
+            events.append(event)
+            loop.remove(sock)
+            loop.stop()
+
+    loop.add(sock, POLL_OUT | POLL_ERR, Connecting())
+    loop.run()
+    assert events == [POLL_ERR], events
+    assert eventloop.get_sock_error(sock).errno == errno.ECONNREFUSED
+    sock.close()
+
+    # stop from another thread wakes the loop up
+    import threading
+    timer = loop.call_later(5, events.append, 'timeout')
+    threading.Timer(0.1, loop.stop).start()
+    loop.run()
+    loop.cancel(timer)
+    assert 'timeout' not in events, events
+
+
+if __name__ == '__main__':
+    test()
@@ -18,13 +18,14 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import sys
 import socket
 import struct
 import logging
 import binascii
 import re
 
-from shadowsocks import lru_cache
+from shadowsocks import lru_cache, log
 
 def compat_ord(s):
     if type(s) == int:
@@ -121,6 +122,23 @@ def is_ip(address):
     return False
 
 
+def getaddrinfo(host, port, socktype, proto):
+    # socket.getaddrinfo without the libc call for an IP literal, the relays
+    # pass those on the data path nearly always
+    host = to_str(host)
+    if ':' in host:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    try:
+        socket.inet_pton(family, host)
+    except (OSError, IOError, ValueError):
+        return socket.getaddrinfo(host, port, 0, socktype, proto)
+    if family == socket.AF_INET:
+        return [(family, socktype, proto, '', (host, port))]
+    return [(family, socktype, proto, '', (host, port, 0, 0))]
+
+
 def match_regex(regex, text):
     regex = re.compile(regex)
     for item in regex.findall(text):
@@ -143,6 +161,10 @@ ADDRTYPE_IPV4 = 1
 ADDRTYPE_IPV6 = 4
 ADDRTYPE_HOST = 3
 
+# the socket module of Python 2 doesn't define it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
 
 def pack_addr(address):
     address_str = to_str(address)
@@ -200,7 +222,9 @@ def pre_parse_header(data):
             data += ogn_data[data_size:]
     return data
 
-def parse_header(data):
+def parse_header(data, source=None):
+    # source: where data comes from, the lines about bad headers are
+    # limited and counted by it
     addrtype = ord(data[0])
     dest_addr = None
     dest_port = None
@@ -213,7 +237,7 @@ def parse_header(data):
             dest_port = struct.unpack('>H', data[5:7])[0]
             header_length = 7
         else:
-            logging.warn('header is too short')
+            log.limited(source, logging.WARN, 'header is too short')
     elif addrtype == ADDRTYPE_HOST:
         if len(data) > 2:
             addrlen = ord(data[1])
@@ -223,19 +247,19 @@ def parse_header(data):
                                                      addrlen])[0]
                 header_length = 4 + addrlen
             else:
-                logging.warn('header is too short')
+                log.limited(source, logging.WARN, 'header is too short')
         else:
-            logging.warn('header is too short')
+            log.limited(source, logging.WARN, 'header is too short')
     elif addrtype == ADDRTYPE_IPV6:
         if len(data) >= 19:
             dest_addr = socket.inet_ntop(socket.AF_INET6, data[1:17])
             dest_port = struct.unpack('>H', data[17:19])[0]
             header_length = 19
         else:
-            logging.warn('header is too short')
+            log.limited(source, logging.WARN, 'header is too short')
     else:
-        logging.warn('unsupported addrtype %d, maybe wrong password or '
-                     'encryption method' % addrtype)
+        log.limited(source, logging.WARN, 'unsupported addrtype %d, maybe '
+                    'wrong password or encryption method', addrtype)
     if dest_addr is None:
         return None
     return connecttype, addrtype, to_bytes(dest_addr), dest_port, header_length
@@ -379,6 +403,14 @@ def test_inet_conv():
     assert inet_ntop(socket.AF_INET6, b) == ipv6
 
 
+def test_getaddrinfo():
+    for host in ('8.8.4.4', b'8.8.4.4', '2404:6800:4005:805::1011',
+                 '::ffff:127.0.0.1', 'localhost'):
+        assert getaddrinfo(host, 53, socket.SOCK_DGRAM, socket.SOL_UDP)[0] \
+            == socket.getaddrinfo(host, 53, 0, socket.SOCK_DGRAM,
+                                  socket.SOL_UDP)[0]
+
+
 def test_parse_header():
     assert parse_header(b'\x03\x0ewww.google.com\x00\x50') == \
         (0, b'www.google.com', 80, 18)
@@ -389,6 +421,20 @@ def test_parse_header():
         (0, b'2404:6800:4005:805::1011', 80, 19)
 
 
+def test_parse_header_source():
+    # the bad headers are logged by where they come from
+    sources = []
+    limited = log.limited
+    log.limited = lambda source, level, msg, *args: sources.append(source)
+    try:
+        assert parse_header(b'\x01\x08\x08', '1.2.3.4') is None
+        assert parse_header(b'\x05', '5.6.7.8') is None
+        assert parse_header(b'\x03') is None
+    finally:
+        log.limited = limited
+    assert sources == ['1.2.3.4', '5.6.7.8', None], sources
+
+
 def test_pack_header():
     assert pack_addr(b'8.8.8.8') == b'\x01\x08\x08\x08\x08'
     assert pack_addr(b'2404:6800:4005:805::1011') == \
@@ -413,6 +459,8 @@ def test_ip_network():
 
 if __name__ == '__main__':
     test_inet_conv()
+    test_getaddrinfo()
     test_parse_header()
+    test_parse_header_source()
     test_pack_header()
     test_ip_network()
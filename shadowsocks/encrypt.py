@@ -51,7 +51,7 @@ def EVP_BytesToKey(password, key_len, iv_len):
     # so that we make the same key and iv as nodejs version
     if hasattr(password, 'encode'):
         password = password.encode('utf-8')
-    cached_key = '%s-%d-%d' % (password, key_len, iv_len)
+    cached_key = (password, key_len, iv_len)
     r = cached_keys.get(cached_key, None)
     if r:
         return r
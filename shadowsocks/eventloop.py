@@ -26,14 +26,16 @@ import time
 import socket
 import select
 import errno
+import heapq
+import itertools
 import logging
-from collections import defaultdict
+from collections import deque
 
 from shadowsocks import shell
 
 
-__all__ = ['EventLoop', 'POLL_NULL', 'POLL_IN', 'POLL_OUT', 'POLL_ERR',
-           'POLL_HUP', 'POLL_NVAL', 'EVENT_NAMES']
+__all__ = ['EventLoop', 'create_loop', 'POLL_NULL', 'POLL_IN', 'POLL_OUT',
+           'POLL_ERR', 'POLL_HUP', 'POLL_NVAL', 'EVENT_NAMES']
 
 POLL_NULL = 0x00
 POLL_IN = 0x01
@@ -53,8 +55,57 @@ EVENT_NAMES = {
 }
 
 # we check timeouts every TIMEOUT_PRECISION seconds
+# timers run on time, but poll never waits longer than this, so callbacks
+# added from other threads with call_soon run within TIMEOUT_PRECISION
 TIMEOUT_PRECISION = 2
 
+# timers are not affected by the system clock being changed, when possible
+monotonic = getattr(time, 'monotonic', time.time)
+
+# if a poll returned events but no handler did any work on them (e.g. all
+# the ready sockets are speed limited), sleep IDLE_SLEEP seconds before the
+# next poll so that level triggered events can not spin the CPU
+# set it to 0 to never sleep after a non-empty poll
+IDLE_SLEEP = 0.001
+
+
+class Timer(object):
+    # returned by EventLoop.call_later, pass it to EventLoop.cancel
+
+    __slots__ = ('deadline', 'callback', 'args')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+
+
+class EpollLoop(object):
+    # epoll in edge triggered mode, every fd is registered once for all the
+    # events and EventLoop keeps the interest set of the handlers itself
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def poll(self, timeout):
+        return self._epoll.poll(timeout)
+
+    def register(self, fd, mode, exclusive=False):
+        mode |= select.EPOLLET
+        if exclusive and hasattr(select, 'EPOLLEXCLUSIVE'):
+            # only wake up one of the processes sharing a listening socket
+            mode |= select.EPOLLEXCLUSIVE
+        self._epoll.register(fd, mode)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def modify(self, fd, mode):
+        self._epoll.modify(fd, mode | select.EPOLLET)
+
+    def close(self):
+        self._epoll.close()
+
 
 class KqueueLoop(object):
 
@@ -77,13 +128,13 @@ class KqueueLoop(object):
         if timeout < 0:
             timeout = None  # kqueue behaviour
         events = self._kqueue.control(None, KqueueLoop.MAX_EVENTS, timeout)
-        results = defaultdict(lambda: POLL_NULL)
+        results = {}
         for e in events:
             fd = e.ident
             if e.filter == select.KQ_FILTER_READ:
-                results[fd] |= POLL_IN
+                results[fd] = results.get(fd, POLL_NULL) | POLL_IN
             elif e.filter == select.KQ_FILTER_WRITE:
-                results[fd] |= POLL_OUT
+                results[fd] = results.get(fd, POLL_NULL) | POLL_OUT
         return results.items()
 
     def register(self, fd, mode):
@@ -112,10 +163,11 @@ class SelectLoop(object):
     def poll(self, timeout):
         r, w, x = select.select(self._r_list, self._w_list, self._x_list,
                                 timeout)
-        results = defaultdict(lambda: POLL_NULL)
-        for p in [(r, POLL_IN), (w, POLL_OUT), (x, POLL_ERR)]:
-            for fd in p[0]:
-                results[fd] |= p[1]
+        results = dict.fromkeys(r, POLL_IN)
+        for fd in w:
+            results[fd] = results.get(fd, POLL_NULL) | POLL_OUT
+        for fd in x:
+            results[fd] = results.get(fd, POLL_NULL) | POLL_ERR
         return results.items()
 
     def register(self, fd, mode):
@@ -143,8 +195,16 @@ class SelectLoop(object):
 
 
 class EventLoop(object):
-    def __init__(self):
-        if hasattr(select, 'epoll'):
+    def __init__(self, config=None):
+        if config is None:
+            config = {}
+        self._edge_triggered = False
+        if hasattr(select, 'epoll') and \
+                config.get('loop_edge_triggered', False):
+            self._impl = EpollLoop()
+            self._edge_triggered = True
+            model = 'epoll (edge triggered)'
+        elif hasattr(select, 'epoll'):
             self._impl = select.epoll()
             model = 'epoll'
         elif hasattr(select, 'kqueue'):
@@ -157,27 +217,70 @@ class EventLoop(object):
             raise Exception('can not find any available functions in select '
                             'package')
         self._fdmap = {}  # (f, handler)
-        self._last_time = time.time()
+        # edge triggered only: the interest set of each fd, and the events
+        # to report again without waiting for a new edge
+        self._fdmode = {}
+        self._pending = {}
+        # the time of the current iteration, see run
+        self.now = monotonic()
+        self._last_time = self.now
         self._periodic_callbacks = []
+        self._timers = []  # heap of (deadline, seq, Timer)
+        self._timer_seq = itertools.count()
+        self._timers_cancelled = 0
+        self._soon = deque()
         self._stopping = False
+        self._idle_sleep = float(config.get('loop_idle_sleep', IDLE_SLEEP))
         logging.debug('using event model: %s', model)
 
-    def poll(self, timeout=None):
-        events = self._impl.poll(timeout)
-        return [(self._fdmap[fd][0], fd, event) for fd, event in events]
+    def _poll(self, timeout):
+        # (fd, event) pairs, as returned by the poller when possible
+        if self._edge_triggered:
+            if self._pending:
+                timeout = 0
+            return self._edge_events(self._impl.poll(timeout))
+        return self._impl.poll(timeout)
 
-    def add(self, f, mode, handler):
+    def poll(self, timeout=None):
+        return [(self._fdmap[fd][0], fd, event)
+                for fd, event in self._poll(timeout)]
+
+    def _edge_events(self, events):
+        # merge the new edges with the events waiting to be reported again,
+        # and only report what the handler is currently interested in
+        pending = self._pending
+        self._pending = {}
+        for fd, event in events:
+            pending[fd] = pending.get(fd, POLL_NULL) | event
+        results = []
+        for fd, event in pending.items():
+            mode = self._fdmode.get(fd, None)
+            if mode is None:
+                continue
+            event &= mode | POLL_ERR | POLL_HUP
+            if event:
+                results.append((fd, event))
+        return results
+
+    def add(self, f, mode, handler, exclusive=False):
+        # exclusive: only one of the processes sharing f needs to be woken
+        # up, honoured by the edge triggered epoll loop
         fd = f.fileno()
         self._fdmap[fd] = (f, handler)
-        self._impl.register(fd, mode)
+        if self._edge_triggered:
+            self._fdmode[fd] = mode
+            self._impl.register(fd, POLL_IN | POLL_OUT | POLL_ERR, exclusive)
+        else:
+            self._impl.register(fd, mode)
 
     def remove(self, f):
-        fd = f.fileno()
-        del self._fdmap[fd]
-        self._impl.unregister(fd)
+        self.removefd(f.fileno())
 
     def removefd(self, fd):
         del self._fdmap[fd]
+        if self._edge_triggered:
+            del self._fdmode[fd]
+            self._pending.pop(fd, None)
         self._impl.unregister(fd)
 
     def add_periodic(self, callback):
@@ -186,19 +289,104 @@ class EventLoop(object):
     def remove_periodic(self, callback):
         self._periodic_callbacks.remove(callback)
 
+    def call_later(self, delay, callback, *args):
+        # run callback(*args) once after delay seconds
+        # ServerPool adds relays, hence their timers, from its own thread,
+        # every heap operation is atomic and the loop rechecks what it pops
+        timer = Timer(monotonic() + delay, callback, args)
+        heapq.heappush(self._timers,
+                       (timer.deadline, next(self._timer_seq), timer))
+        return timer
+
+    def cancel(self, timer):
+        if timer.callback is None:
+            return
+        timer.callback = None
+        timer.args = None
+        self._timers_cancelled += 1
+        # cancelled timers stay in the heap until they are due, unless they
+        # make up most of it
+        if self._timers_cancelled > 512 and \
+                self._timers_cancelled * 2 > len(self._timers):
+            self._timers[:] = [t for t in self._timers if t[2].callback]
+            heapq.heapify(self._timers)
+            self._timers_cancelled = 0
+
+    def call_soon(self, callback, *args):
+        # run callback(*args) in the loop thread at the next iteration
+        # the only method of the loop which is safe to call from other threads
+        self._soon.append((callback, args))
+
+    def _poll_timeout(self):
+        if self._soon or self._pending:
+            return 0
+        timers = self._timers
+        while timers and timers[0][2].callback is None:
+            item = heapq.heappop(timers)
+            if item[2].callback is not None:
+                heapq.heappush(timers, item)
+                break
+            self._timers_cancelled -= 1
+        if not timers:
+            return TIMEOUT_PRECISION
+        return min(max(timers[0][0] - self.now, 0), TIMEOUT_PRECISION)
+
+    def _run_callbacks(self):
+        timers = self._timers
+        now = self.now
+        while timers and timers[0][0] <= now:
+            item = heapq.heappop(timers)
+            if item[0] > now:
+                heapq.heappush(timers, item)
+                break
+            timer = item[2]
+            callback = timer.callback
+            if callback is None:
+                self._timers_cancelled -= 1
+                continue
+            timer.callback = None
+            try:
+                callback(*timer.args)
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+        while self._soon:
+            callback, args = self._soon.popleft()
+            try:
+                callback(*args)
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+
     def modify(self, f, mode):
         fd = f.fileno()
-        self._impl.modify(fd, mode)
+        if self._edge_triggered:
+            # no syscall, the fd is registered for everything already
+            # the socket may have become ready while we were not interested
+            # so check the newly wanted events at the next iteration
+            added = mode & ~self._fdmode[fd] & (POLL_IN | POLL_OUT)
+            self._fdmode[fd] = mode
+            if added:
+                self._pending[fd] = self._pending.get(fd, POLL_NULL) | added
+        else:
+            self._impl.modify(fd, mode)
+
+    def requeue(self, f, event):
+        # an edge triggered socket is not reported again until new data
+        # arrives, so a handler skipping an event asks for it once more
+        if self._edge_triggered:
+            fd = f.fileno()
+            self._pending[fd] = self._pending.get(fd, POLL_NULL) | event
 
     def stop(self):
         self._stopping = True
 
     def run(self):
         events = []
+        fdmap = self._fdmap
+        edge_triggered = self._edge_triggered
         while not self._stopping:
             asap = False
             try:
-                events = self.poll(TIMEOUT_PRECISION)
+                events = self._poll(self._poll_timeout())
             except (OSError, IOError) as e:
                 if errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
                     # EPIPE: Happens when the client closes the connection
@@ -211,23 +399,36 @@ class EventLoop(object):
                     import traceback
                     traceback.print_exc()
                     continue
+            # the clock is read once per iteration, the handlers, timers and
+            # caches of the loop take the time from now. timers due while
+            # the events are handled run at the next iteration
+            self.now = now = monotonic()
 
             handle = False
-            for sock, fd, event in events:
-                handler = self._fdmap.get(fd, None)
-                if handler is not None:
-                    handler = handler[1]
+            for fd, event in events:
+                # a handler may remove fds which are ready in the same poll
+                item = fdmap.get(fd, None)
+                if item is not None:
                     try:
-                        handle = handler.handle_event(sock, fd, event) or handle
+                        if item[1].handle_event(item[0], fd, event):
+                            handle = True
+                            if edge_triggered and event & POLL_IN:
+                                # keep reading until the handler finds
+                                # nothing more, i.e. EAGAIN
+                                self._requeue_in(fd)
                     except (OSError, IOError) as e:
                         shell.print_exception(e)
-            now = time.time()
+            self._run_callbacks()
             if asap or now - self._last_time >= TIMEOUT_PRECISION:
                 for callback in self._periodic_callbacks:
                     callback()
                 self._last_time = now
-            if events and not handle:
-                time.sleep(0.001)
+            if events and not handle and self._idle_sleep > 0:
+                time.sleep(self._idle_sleep)
+
+    def _requeue_in(self, fd):
+        if self._fdmode.get(fd, POLL_NULL) & POLL_IN:
+            self._pending[fd] = self._pending.get(fd, POLL_NULL) | POLL_IN
 
     def __del__(self):
         self._impl.close()
@@ -252,7 +453,44 @@ def errno_from_exception(e):
         return None
 
 
+def create_loop(config=None):
+    # "event_loop": "native" (default), "asyncio" or "uvloop"
+    if config is None:
+        config = {}
+    if config.get('event_loop', 'native') in ('asyncio', 'uvloop'):
+        from shadowsocks import asyncioloop
+        if asyncioloop.asyncio is not None:
+            return asyncioloop.AsyncioLoop(config)
+        logging.warn('asyncio not available, using the native event loop')
+    return EventLoop(config)
+
+
 # from tornado
 def get_sock_error(sock):
     error_number = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
     return socket.error(error_number, os.strerror(error_number))
+
+
+def test():
+    loop = EventLoop()
+    fired = []
+
+    def fire(name):
+        fired.append(name)
+        if name == 'last':
+            loop.stop()
+
+    start = monotonic()
+    loop.call_later(0.2, fire, 'last')
+    loop.call_later(0.1, fire, 'b')
+    loop.call_later(0.05, fire, 'a')
+    loop.cancel(loop.call_later(0.1, fire, 'cancelled'))
+    loop.call_soon(fire, 'soon')
+    loop.run()
+    assert fired == ['soon', 'a', 'b', 'last'], fired
+    assert 0.2 <= monotonic() - start < TIMEOUT_PRECISION
+    assert start + 0.2 <= loop.now <= monotonic()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# log-linear histograms of the time TCP connections spend in each stage
+#
+# a value in microseconds falls in one of SUB_BUCKETS linear buckets of the
+# power of two range it is in, so a bucket is never wider than 1/SUB_BUCKETS
+# of the values in it. recording is an index computation and an increment,
+# cheap enough to do for every connection
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+
+SUB_BITS = 3
+SUB_BUCKETS = 1 << SUB_BITS
+MAX_BITS = 40  # about 12 days
+MAX_VALUE = (1 << MAX_BITS) - 1
+BUCKETS = (MAX_BITS - SUB_BITS + 1) * SUB_BUCKETS
+
+# the stages of a connection, each ends with the mark of the same name
+ACCEPT = 0
+HEADER = 1      # accepted to the header parsed
+DNS = 2         # header parsed to the address resolved
+CONNECT = 3     # resolved to connected to the remote
+FIRST_BYTE = 4  # connected to the first byte from the remote
+LIFETIME = 5    # accepted to destroyed
+STAGES = ('header', 'dns', 'connect', 'first_byte', 'lifetime')
+
+
+def bit_length(n):
+    # int.bit_length, which Python 2.6 doesn't have
+    return len(bin(n)) - 2
+
+
+def bucket_index(us):
+    if us < SUB_BUCKETS:
+        return us
+    shift = bit_length(us) - SUB_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (us >> shift) - SUB_BUCKETS
+
+
+def bucket_bound(index):
+    # the largest value that falls in the bucket
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram(object):
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        us = int(seconds * 1000000)
+        if us >= SUB_BUCKETS:
+            if us > MAX_VALUE:
+                us = MAX_VALUE
+            # bucket_index, without the calls
+            shift = len(bin(us)) - 2 - SUB_BITS - 1
+            index = (shift + 1) * SUB_BUCKETS + (us >> shift) - SUB_BUCKETS
+        elif us > 0:
+            index = us
+        else:
+            us = index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        # in microseconds, the upper bound of the bucket it falls in
+        if not self.count:
+            return 0
+        rank = max(int(self.count * p / 100 + 0.5), 1)
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bucket_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        # in milliseconds
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count / 1000, 3),
+            'p50': self.percentile(50) / 1000,
+            'p90': self.percentile(90) / 1000,
+            'p99': self.percentile(99) / 1000,
+            'max': self.max / 1000,
+        }
+
+
+class ConnectionLatency(object):
+    # the histograms of the stages of the connections of a port
+
+    def __init__(self):
+        self.histograms = [Histogram() for stage in STAGES]
+
+    def record(self, stage, seconds):
+        self.histograms[stage - 1].record(seconds)
+
+    def summary(self):
+        return dict((name, h.summary())
+                    for name, h in zip(STAGES, self.histograms))
+
+
+def test():
+    assert [bit_length(n) for n in (1, 2, 3, 255, 256, MAX_VALUE)] == \
+        [1, 2, 2, 8, 9, len('{0:b}'.format(MAX_VALUE))]
+    for us in range(0, 1 << 16):
+        index = bucket_index(us)
+        assert index < BUCKETS
+        assert us <= bucket_bound(index)
+        if index:
+            assert us > bucket_bound(index - 1)
+        # never wider than 1/SUB_BUCKETS of the values
+        assert bucket_bound(index) - us <= us // SUB_BUCKETS
+    assert bucket_index(MAX_VALUE) == BUCKETS - 1
+
+    h = Histogram()
+    for us in (0, 1, 7, 8, 1000, 123456789, MAX_VALUE + 1):
+        h.record(us / 1000000)
+        assert h.counts[bucket_index(min(us, MAX_VALUE))]
+    h = Histogram()
+    for ms in range(1, 101):
+        h.record(ms / 1000)
+    assert h.count == 100
+    assert 50000 <= h.percentile(50) <= 50000 * 9 // 8
+    assert 99000 <= h.percentile(99) <= 100000
+    assert h.percentile(100) == 100000
+
+    a = ConnectionLatency()
+    a.record(DNS, 0.002)
+    a.record(DNS, 0.004)
+    a.record(LIFETIME, 1)
+    summary = a.summary()
+    assert summary['dns']['count'] == 2
+    assert summary['lifetime']['max'] == 1000
+    assert summary['header'] == {'count': 0}
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# logging on the data path of the relays
+#
+# the relays test VERBOSE, DEBUG and INFO before building a message for
+# these levels, instead of formatting it for the logger to drop, and CONNECT
+# before common.connect_log. the flags are worked out again by update()
+# whenever the level of the root logger changes, shell.get_config does it.
+# the bytes dumped in a message are wrapped in Hex, so they are only
+# hexlified when the message is emitted
+#
+# the lines about bad connections go through limited(), a token bucket
+# shared by all of them. while it is empty the lines are dropped and
+# counted per source address, and "N similar errors from X suppressed" is
+# logged once there are tokens again. protocol_errors counts the bad
+# connections per port and per address, for tools like utils/autoban.py
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import sys
+import time
+import logging
+import binascii
+
+
+VERBOSE_LEVEL = 5
+
+# as eventloop.monotonic, shell imports this before the loop
+monotonic = getattr(time, 'monotonic', time.time)
+
+VERBOSE = False
+DEBUG = False
+INFO = True
+CONNECT = False
+
+# connect_verbose_info, common.connect_log logs at INFO instead of DEBUG
+connect_verbose = False
+
+# lines per second about bad connections, and how many in a burst
+ERROR_RATE = 10
+ERROR_BURST = 50
+# sources with suppressed lines, or with a protocol error count
+MAX_SOURCES = 4096
+
+
+def update():
+    global VERBOSE, DEBUG, INFO, CONNECT
+    logger = logging.getLogger()
+    VERBOSE = logger.isEnabledFor(VERBOSE_LEVEL)
+    DEBUG = logger.isEnabledFor(logging.DEBUG)
+    INFO = logger.isEnabledFor(logging.INFO)
+    CONNECT = INFO if connect_verbose else DEBUG
+
+
+class Hex(object):
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(self.data).decode('ascii')
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate=ERROR_RATE, burst=ERROR_BURST, logger=None):
+        self.logger = logger or logging.getLogger()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.suppressed = {}  # source: lines dropped, None for the rest
+
+    def log(self, source, level, msg, *args):
+        logger = self.logger
+        if not logger.isEnabledFor(level):
+            return
+        now = monotonic()
+        tokens = min(self.tokens + (now - self.last) * self.rate, self.burst)
+        self.last = now
+        suppressed = self.suppressed
+        if tokens < 1:
+            self.tokens = tokens
+            if source in suppressed:
+                suppressed[source] += 1
+            elif len(suppressed) < MAX_SOURCES:
+                suppressed[source] = 1
+            else:
+                suppressed[None] = suppressed.get(None, 0) + 1
+            return
+        # the records show where limited() was called, not this line
+        caller = sys._getframe(1)
+        code = caller.f_code
+
+        def emit(msg, args):
+            logger.handle(logger.makeRecord(
+                logger.name, level, code.co_filename, caller.f_lineno, msg,
+                args, None, code.co_name))
+
+        emit(msg, args)
+        tokens -= 1
+        # the suppressed of this source first, then of the others
+        n = suppressed.pop(source, 0)
+        while True:
+            if n:
+                emit('%d similar errors from %s suppressed',
+                     (n, 'other sources' if source is None else source))
+                tokens -= 1
+            if tokens < 1 or not suppressed:
+                break
+            source, n = suppressed.popitem()
+        self.tokens = tokens
+
+
+class ErrorCounter(object):
+
+    def __init__(self):
+        self.ports = {}
+        self.sources = {}
+
+    def add(self, port, source):
+        ports = self.ports
+        ports[port] = ports.get(port, 0) + 1
+        sources = self.sources
+        if source not in sources and len(sources) >= MAX_SOURCES:
+            # keep the half that failed the most
+            kept = sorted(sources.items(), key=lambda item: item[1],
+                          reverse=True)[:MAX_SOURCES // 2]
+            sources.clear()
+            sources.update(kept)
+        sources[source] = sources.get(source, 0) + 1
+
+    def snapshot(self):
+        return {'ports': dict(self.ports), 'sources': dict(self.sources)}
+
+
+limiter = RateLimiter()
+protocol_errors = ErrorCounter()
+
+
+# limited(source, level, msg, *args), a line about a bad connection
+limited = limiter.log
+
+
+update()
+
+
+def test():
+    logger = logging.getLogger()
+    level = logger.level
+    try:
+        logger.setLevel(logging.INFO)
+        update()
+        assert INFO and not DEBUG and not CONNECT
+        logger.setLevel(logging.WARN)
+        update()
+        assert not DEBUG and not INFO and not VERBOSE
+        logger.setLevel(VERBOSE_LEVEL)
+        update()
+        assert DEBUG and INFO and VERBOSE
+    finally:
+        logger.setLevel(level)
+        update()
+    assert '%s' % Hex(b'\x00\xff') == '00ff'
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            lines.append(record.getMessage())
+            records.append(record)
+
+    lines = []
+    records = []
+    logger = logging.getLogger('log.test')
+    logger.addHandler(Handler())
+    logger.propagate = False
+    r = RateLimiter(rate=1, burst=2, logger=logger)
+    for i in range(5):
+        r.log('1.2.3.4', logging.WARN, 'bad %d', i)
+    r.log('5.6.7.8', logging.WARN, 'bad')
+    assert lines == ['bad 0', 'bad 1'], lines
+    assert records[0].funcName == 'test'
+    assert r.suppressed == {'1.2.3.4': 3, '5.6.7.8': 1}
+    r.last -= 10
+    r.log('1.2.3.4', logging.WARN, 'bad 5')
+    assert lines[2:] == ['bad 5',
+                         '3 similar errors from 1.2.3.4 suppressed'], lines
+    assert r.suppressed == {'5.6.7.8': 1}
+    r.last -= 10
+    r.log('9.9.9.9', logging.WARN, 'bad 6')
+    assert lines[4:] == ['bad 6',
+                         '1 similar errors from 5.6.7.8 suppressed'], lines
+    assert not r.suppressed
+
+    c = ErrorCounter()
+    for i in range(MAX_SOURCES):
+        c.add(8388, i)
+    c.add(8388, 0)
+    c.add(8389, -1)
+    assert len(c.sources) == MAX_SOURCES // 2 + 1
+    assert c.sources[0] == 2 and c.sources[-1] == 1
+    assert c.snapshot()['ports'] == {8388: MAX_SOURCES + 1, 8389: 1}
+
+
+if __name__ == '__main__':
+    test()
@@ -20,6 +20,7 @@ from __future__ import absolute_import, division, print_function, \
 
 import collections
 import logging
+import heapq
 import time
 
 if __name__ == '__main__':
@@ -41,19 +42,33 @@ except:
 
 SWEEP_MAX_ITEMS = 1024
 
+# a Sweeper may sweep up to SWEEP_SLACK seconds late, so that keys timing
+# out at about the same time are swept together
+SWEEP_SLACK = 1
+
+# as eventloop.monotonic, which imports this through shell and common
+monotonic = getattr(time, 'monotonic', time.time)
+
+# an ActivityWheel files its objects in slots of this many seconds
+WHEEL_SLOT = 1
+
 class LRUCache(collections.MutableMapping):
     """This class is not thread safe"""
 
     def __init__(self, timeout=60, close_callback=None, *args, **kwargs):
         self.timeout = timeout
         self.close_callback = close_callback
+        # the time is clock.now when set, the event loop a Sweeper sweeps
+        # the cache with, instead of reading the clock for every key used
+        self.clock = None
         self._store = {}
         self._keys_to_last_time = OrderedDict()
         self.update(dict(*args, **kwargs))  # use the free update to set keys
 
     def __getitem__(self, key):
         # O(1)
-        t = time.time()
+        clock = self.clock
+        t = clock.now if clock is not None else monotonic()
         last_t = self._keys_to_last_time[key]
         del self._keys_to_last_time[key]
         self._keys_to_last_time[key] = t
@@ -61,7 +76,8 @@ class LRUCache(collections.MutableMapping):
 
     def __setitem__(self, key, value):
         # O(1)
-        t = time.time()
+        clock = self.clock
+        t = clock.now if clock is not None else monotonic()
         if key in self._keys_to_last_time:
             del self._keys_to_last_time[key]
         self._keys_to_last_time[key] = t
@@ -87,9 +103,19 @@ class LRUCache(collections.MutableMapping):
             for key in self._keys_to_last_time:
                 return key
 
+    def next_expiry(self):
+        # when the least recently used key times out, None if empty
+        for key in self._keys_to_last_time:
+            return self._keys_to_last_time[key] + self.timeout
+        return None
+
+    def now(self):
+        clock = self.clock
+        return clock.now if clock is not None else monotonic()
+
     def sweep(self, sweep_item_cnt = SWEEP_MAX_ITEMS):
         # O(n - m)
-        now = time.time()
+        now = self.now()
         c = 0
         while c < sweep_item_cnt:
             if len(self._keys_to_last_time) == 0:
@@ -110,7 +136,6 @@ class LRUCache(collections.MutableMapping):
         return c < SWEEP_MAX_ITEMS
 
     def clear(self, keep):
-        now = time.time()
         c = 0
         while len(self._keys_to_last_time) > keep:
             if len(self._keys_to_last_time) == 0:
@@ -128,6 +153,135 @@ class LRUCache(collections.MutableMapping):
             logging.debug('%d keys swept' % c)
         return c < SWEEP_MAX_ITEMS
 
+class ActivityWheel(object):
+    """Times out objects by their last_activity attribute, the time they
+    were last active at, which is all the data path has to update.
+    The objects are filed in slots of WHEEL_SLOT seconds by when they would
+    time out, and only checked once their slot is over: the idle ones are
+    closed, the others filed again by their new deadline. So an active
+    object is looked at once per timeout, not at every activity.
+    timeout_of(obj) gives the timeout of each object when set, timeout is
+    then the shortest of them. Swept by a Sweeper like a LRUCache"""
+
+    def __init__(self, timeout=60, close_callback=None, timeout_of=None):
+        self.timeout = timeout
+        self.close_callback = close_callback
+        self.timeout_of = timeout_of
+        self.clock = None  # as LRUCache.clock
+        self._slots = {}  # slot: set of the objects timing out in it
+        self._slot_of = {}  # object: its slot
+        self._heap = []  # the slots, the soonest first
+
+    def now(self):
+        clock = self.clock
+        return clock.now if clock is not None else monotonic()
+
+    def _file(self, obj, deadline):
+        slot = int(deadline // WHEEL_SLOT)
+        objs = self._slots.get(slot, None)
+        if objs is None:
+            objs = self._slots[slot] = set()
+            heapq.heappush(self._heap, slot)
+        objs.add(obj)
+        self._slot_of[obj] = slot
+
+    def _deadline(self, obj):
+        timeout_of = self.timeout_of
+        if timeout_of is None:
+            return obj.last_activity + self.timeout
+        return obj.last_activity + timeout_of(obj)
+
+    def add(self, obj):
+        # again when its timeout gets shorter, so it is checked in time
+        self.remove(obj)
+        self._file(obj, self._deadline(obj))
+
+    def remove(self, obj):
+        # O(1), an emptied slot stays until it is over
+        slot = self._slot_of.pop(obj, None)
+        if slot is not None:
+            self._slots[slot].discard(obj)
+
+    def __contains__(self, obj):
+        return obj in self._slot_of
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def next_expiry(self):
+        # when the soonest slot is over, None if empty
+        heap = self._heap
+        if not heap:
+            return None
+        return (heap[0] + 1) * WHEEL_SLOT
+
+    def sweep(self, sweep_item_cnt = SWEEP_MAX_ITEMS):
+        # checks up to sweep_item_cnt objects of the slots which are over
+        now = self.now()
+        deadline_of = self._deadline
+        heap = self._heap
+        slots = self._slots
+        slot_of = self._slot_of
+        c = 0
+        closed = 0
+        while heap and (heap[0] + 1) * WHEEL_SLOT <= now:
+            objs = slots[heap[0]]
+            while objs:
+                if c >= sweep_item_cnt:
+                    break
+                obj = objs.pop()
+                c += 1
+                deadline = deadline_of(obj)
+                if deadline < now:
+                    del slot_of[obj]
+                    closed += 1
+                    if self.close_callback is not None:
+                        self.close_callback(obj)
+                else:
+                    # deadline >= now, a slot which is not over yet
+                    self._file(obj, deadline)
+            if objs:
+                break
+            del slots[heapq.heappop(heap)]
+        if closed:
+            logging.debug('%d keys swept' % closed)
+        return c < sweep_item_cnt
+
+
+class Sweeper(object):
+    """Sweeps a LRUCache with the timers of an event loop, waking up only
+    when its oldest key times out. The cache takes the time from the loop.
+    sweep replaces cache.sweep, it must call it and return its result"""
+
+    def __init__(self, loop, cache, sweep=None):
+        self._loop = loop
+        self._cache = cache
+        cache.clock = loop
+        self._sweep_cache = sweep or cache.sweep
+        self._timer = None
+        self._schedule()
+
+    def _schedule(self):
+        # keys added from now on can't time out in less than the timeout
+        delay = self._cache.timeout
+        expiry = self._cache.next_expiry()
+        if expiry is not None:
+            delay = min(max(expiry - self._loop.now, 0), delay)
+        self._timer = self._loop.call_later(delay + SWEEP_SLACK, self._sweep)
+
+    def _sweep(self):
+        if self._sweep_cache():
+            self._schedule()
+        else:
+            # swept SWEEP_MAX_ITEMS keys, continue at the next iteration
+            self._timer = self._loop.call_later(0, self._sweep)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._loop.cancel(self._timer)
+            self._timer = None
+
+
 def test():
     c = LRUCache(timeout=0.3)
 
@@ -175,5 +329,79 @@ def test():
     time.sleep(0.3)
     c.sweep()
 
+    c = LRUCache(timeout=0.1)
+    assert c.next_expiry() is None
+    c['a'] = 1
+    c['b'] = 2
+    t = monotonic()
+    assert t <= c.next_expiry() <= t + 0.1
+    c['a']
+    time.sleep(0.05)
+    c['b']
+    assert c.next_expiry() >= t + 0.1
+
+    # the time of a loop, only what it says counts
+    class Clock(object):
+        now = 100
+
+    c = LRUCache(timeout=10)
+    c.clock = Clock()
+    c['a'] = 1
+    assert c.next_expiry() == 110
+    c.clock.now = 105
+    c['b'] = 2
+    c.clock.now = 111
+    c.sweep()
+    assert 'a' not in c and c['b'] == 2
+    assert c.next_expiry() == 121
+
+    class Conn(object):
+        def __init__(self, t):
+            self.last_activity = t
+
+    closed = []
+    w = ActivityWheel(timeout=10, close_callback=closed.append)
+    w.clock = Clock()
+    w.clock.now = 100
+    idle, busy, gone = Conn(100), Conn(100), Conn(100.5)
+    for conn in (idle, busy, gone):
+        w.add(conn)
+    assert len(w) == 3 and w.next_expiry() == 111
+    w.remove(gone)
+    assert gone not in w
+    busy.last_activity = 105
+    w.clock.now = 110.5
+    assert w.sweep() and not closed
+    w.clock.now = 111
+    assert w.sweep()
+    assert closed == [idle] and busy in w and len(w) == 1
+    assert w.next_expiry() == 116
+    w.clock.now = 116
+    w.sweep()
+    assert closed == [idle, busy] and len(w) == 0
+    assert w.next_expiry() is None
+    # a sweep checks a bounded number of objects, the rest at the next one
+    for i in range(5):
+        w.add(Conn(200))
+    w.clock.now = 300
+    assert not w.sweep(3) and len(w) == 2
+    assert w.sweep(3) and len(w) == 0
+
+    # a timeout for each object, an object filed again when it gets shorter
+    w = ActivityWheel(timeout=5, close_callback=closed.append,
+                      timeout_of=lambda conn: conn.timeout)
+    w.clock = Clock()
+    w.clock.now = 0
+    conn = Conn(0)
+    conn.timeout = 100
+    w.add(conn)
+    assert w.next_expiry() == 101
+    conn.timeout = 5
+    w.add(conn)
+    assert w.next_expiry() == 6
+    w.clock.now = 6
+    w.sweep()
+    assert closed[-1] is conn and not w
+
 if __name__ == '__main__':
     test()
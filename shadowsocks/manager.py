@@ -25,7 +25,8 @@ import logging
 import json
 import collections
 
-from shadowsocks import common, eventloop, tcprelay, udprelay, asyncdns, shell
+from shadowsocks import common, eventloop, tcprelay, udprelay, asyncdns, \
+    shell, log
 
 
 BUF_SIZE = 1506
@@ -37,7 +38,7 @@ class Manager(object):
     def __init__(self, config):
         self._config = config
         self._relays = {}  # (tcprelay, udprelay)
-        self._loop = eventloop.EventLoop()
+        self._loop = eventloop.create_loop(config)
         self._dns_resolver = asyncdns.DNSResolver()
         self._dns_resolver.add_to_loop(self._loop)
 
@@ -67,7 +68,8 @@ class Manager(object):
             exit(1)
         self._loop.add(self._control_socket,
                        eventloop.POLL_IN, self)
-        self._loop.add_periodic(self.handle_periodic)
+        self._loop.call_later(eventloop.TIMEOUT_PRECISION,
+                              self.handle_periodic)
 
         port_password = config['port_password']
         del config['port_password']
@@ -108,7 +110,13 @@ class Manager(object):
 
     def handle_event(self, sock, fd, event):
         if sock == self._control_socket and event == eventloop.POLL_IN:
-            data, self._control_client_addr = sock.recvfrom(BUF_SIZE)
+            try:
+                data, self._control_client_addr = sock.recvfrom(BUF_SIZE)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) in (errno.EAGAIN,
+                                                         errno.EWOULDBLOCK):
+                    return False
+                raise
             parsed = self._parse_command(data)
             if parsed:
                 command, config = parsed
@@ -127,13 +135,21 @@ class Manager(object):
                         self._send_control_data(b'ok')
                     elif command == 'ping':
                         self._send_control_data(b'pong')
+                    elif command == 'latency':
+                        self._send_latency(a_config['server_port'])
+                    elif command == 'errors':
+                        self._send_errors((config or {}).get('min_count', 1))
                     else:
                         logging.error('unknown command %s', command)
+            return True
+        return False
 
     def _parse_command(self, data):
         # commands:
         # add: {"server_port": 8000, "password": "foobar"}
         # remove: {"server_port": 8000"}
+        # latency: {"server_port": 8000}
+        # errors: {"min_count": 3}
         data = common.to_str(data)
         parts = data.split(':', 1)
         if len(parts) < 2:
@@ -171,6 +187,38 @@ class Manager(object):
         if len(r) > 0 :
             send_data(r)
         self._statistics.clear()
+        self._loop.call_later(eventloop.TIMEOUT_PRECISION,
+                              self.handle_periodic)
+
+    def _send_latency(self, port):
+        # the stages of the TCP connections of a port, in milliseconds
+        servers = self._relays.get(int(port), None)
+        if not servers:
+            logging.error('server not exist at port %s', port)
+            return
+        data = json.dumps({port: servers[0].latency.summary()},
+                          separators=(',', ':'))
+        self._send_control_data(b'latency: ' + common.to_bytes(data))
+
+    def _send_errors(self, min_count):
+        # the protocol errors per port, then per source address with at
+        # least min_count of them, split to fit in UDP packets
+        snapshot = log.protocol_errors.snapshot()
+
+        def send_data(data_dict):
+            data = json.dumps(data_dict, separators=(',', ':'))
+            self._send_control_data(b'errors: ' + common.to_bytes(data))
+
+        send_data({'ports': snapshot['ports']})
+        r = {}
+        for source, n in snapshot['sources'].items():
+            if n >= min_count:
+                r[source] = n
+                if len(r) >= STAT_SEND_LIMIT:
+                    send_data({'sources': r})
+                    r = {}
+        if r:
+            send_data({'sources': r})
 
     def _send_control_data(self, data):
         if self._control_client_addr:
@@ -38,10 +38,18 @@ def mu_protocol():
     return ["auth_aes128_md5", "auth_aes128_sha1", "auth_chain_a"]
 
 class server_info(object):
+    # one for the obfs and one for the protocol of every connection
+    __slots__ = ('data', 'host', 'port', 'users', 'update_user_func',
+                 'client', 'client_port', 'protocol_param', 'obfs_param',
+                 'iv', 'recv_iv', 'key_str', 'key', 'head_len', 'tcp_mss',
+                 'buffer_size', 'overhead')
+
     def __init__(self, data):
         self.data = data
 
 class obfs(object):
+    __slots__ = ('method', '_method_info', 'obfs')
+
     def __init__(self, method):
         method = common.to_str(method)
         self.method = method
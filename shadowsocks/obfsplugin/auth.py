@@ -33,7 +33,7 @@ import hmac
 import hashlib
 
 import shadowsocks
-from shadowsocks import common, lru_cache, encrypt
+from shadowsocks import common, lru_cache, encrypt, log
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
 
@@ -60,6 +60,8 @@ def match_begin(str1, str2):
     return False
 
 class auth_base(plain.plain):
+    __slots__ = ('no_compatible_method', 'overhead', 'raw_trans')
+
     def __init__(self, method):
         super(auth_base, self).__init__(method)
         self.method = method
@@ -179,6 +181,10 @@ class obfs_auth_v2_data(object):
             return self.client_id[client_id].insert(connection_id)
 
 class auth_sha1_v4(auth_base):
+    __slots__ = ('client_id', 'connection_id', 'decrypt_packet_num',
+                 'has_recv_header', 'has_sent_header', 'max_time_dif',
+                 'recv_buf', 'salt', 'unit_len')
+
     def __init__(self, method):
         super(auth_sha1_v4, self).__init__(method)
         self.recv_buf = b''
@@ -245,7 +251,7 @@ class auth_sha1_v4(auth_base):
             self.server_info.data.local_client_id = b''
         if not self.server_info.data.local_client_id:
             self.server_info.data.local_client_id = os.urandom(4)
-            logging.debug("local_client_id %s" % (binascii.hexlify(self.server_info.data.local_client_id),))
+            logging.debug("local_client_id %s", log.Hex(self.server_info.data.local_client_id))
             self.server_info.data.connection_id = struct.unpack('<I', os.urandom(4))[0] & 0xFFFFFF
         self.server_info.data.connection_id += 1
         return b''.join([struct.pack('<I', utc_time),
@@ -328,7 +334,7 @@ class auth_sha1_v4(auth_base):
                 return (b'', False)
             sha1data = hmac.new(self.server_info.recv_iv + self.server_info.key, self.recv_buf[:length - 10], hashlib.sha1).digest()[:10]
             if sha1data != self.recv_buf[length - 10:length]:
-                logging.error('auth_sha1_v4 data uncorrect auth HMAC-SHA1')
+                log.limited(self.server_info.client, logging.ERROR, 'auth_sha1_v4 data uncorrect auth HMAC-SHA1')
                 return self.not_match_return(self.recv_buf)
             pos = common.ord(self.recv_buf[6])
             if pos < 255:
@@ -337,14 +343,14 @@ class auth_sha1_v4(auth_base):
                 pos = struct.unpack('>H', self.recv_buf[7:9])[0] + 6
             out_buf = self.recv_buf[pos:length - 10]
             if len(out_buf) < 12:
-                logging.info('auth_sha1_v4: too short, data %s' % (binascii.hexlify(self.recv_buf),))
+                log.limited(self.server_info.client, logging.INFO, 'auth_sha1_v4: too short, data %s', log.Hex(self.recv_buf))
                 return self.not_match_return(self.recv_buf)
             utc_time = struct.unpack('<I', out_buf[:4])[0]
             client_id = struct.unpack('<I', out_buf[4:8])[0]
             connection_id = struct.unpack('<I', out_buf[8:12])[0]
             time_dif = common.int32(utc_time - (int(time.time()) & 0xffffffff))
             if time_dif < -self.max_time_dif or time_dif > self.max_time_dif:
-                logging.info('auth_sha1_v4: wrong timestamp, time_dif %d, data %s' % (time_dif, binascii.hexlify(out_buf),))
+                log.limited(self.server_info.client, logging.INFO, 'auth_sha1_v4: wrong timestamp, time_dif %d, data %s', time_dif, log.Hex(out_buf))
                 return self.not_match_return(self.recv_buf)
             elif self.server_info.data.insert(client_id, connection_id):
                 self.has_recv_header = True
@@ -352,7 +358,7 @@ class auth_sha1_v4(auth_base):
                 self.client_id = client_id
                 self.connection_id = connection_id
             else:
-                logging.info('auth_sha1_v4: auth fail, data %s' % (binascii.hexlify(out_buf),))
+                log.limited(self.server_info.client, logging.INFO, 'auth_sha1_v4: auth fail, data %s', log.Hex(out_buf))
                 return self.not_match_return(self.recv_buf)
             self.recv_buf = self.recv_buf[length:]
             self.has_recv_header = True
@@ -362,9 +368,9 @@ class auth_sha1_v4(auth_base):
             crc = struct.pack('<H', binascii.crc32(self.recv_buf[:2]) & 0xFFFF)
             if crc != self.recv_buf[2:4]:
                 self.raw_trans = True
-                logging.info('auth_sha1_v4: wrong crc')
+                log.limited(self.server_info.client, logging.INFO, 'auth_sha1_v4: wrong crc')
                 if self.decrypt_packet_num == 0:
-                    logging.info('auth_sha1_v4: wrong crc')
+                    log.limited(self.server_info.client, logging.INFO, 'auth_sha1_v4: wrong crc')
                     return (b'E'*2048, False)
                 else:
                     raise Exception('server_post_decrype data error')
@@ -373,7 +379,7 @@ class auth_sha1_v4(auth_base):
                 self.raw_trans = True
                 self.recv_buf = b''
                 if self.decrypt_packet_num == 0:
-                    logging.info('auth_sha1_v4: over size')
+                    log.limited(self.server_info.client, logging.INFO, 'auth_sha1_v4: over size')
                     return (b'E'*2048, False)
                 else:
                     raise Exception('server_post_decrype data error')
@@ -381,7 +387,7 @@ class auth_sha1_v4(auth_base):
                 break
 
             if struct.pack('<I', zlib.adler32(self.recv_buf[:length - 4]) & 0xFFFFFFFF) != self.recv_buf[length - 4:length]:
-                logging.info('auth_sha1_v4: checksum error, data %s' % (binascii.hexlify(self.recv_buf[:length]),))
+                log.limited(self.server_info.client, logging.INFO, 'auth_sha1_v4: checksum error, data %s', log.Hex(self.recv_buf[:length]))
                 self.raw_trans = True
                 self.recv_buf = b''
                 if self.decrypt_packet_num == 0:
@@ -452,6 +458,11 @@ class obfs_auth_mu_data(object):
             return local_client_id[client_id].insert(connection_id)
 
 class auth_aes128_sha1(auth_base):
+    __slots__ = ('client_id', 'connection_id', 'extra_wait_size',
+                 'has_recv_header', 'has_sent_header', 'hashfunc',
+                 'last_rnd_len', 'max_time_dif', 'pack_id', 'recv_buf',
+                 'recv_id', 'salt', 'unit_len', 'user_id', 'user_key')
+
     def __init__(self, method, hashfunc):
         super(auth_aes128_sha1, self).__init__(method)
         self.hashfunc = hashfunc
@@ -567,7 +578,7 @@ class auth_aes128_sha1(auth_base):
             self.server_info.data.local_client_id = b''
         if not self.server_info.data.local_client_id:
             self.server_info.data.local_client_id = os.urandom(4)
-            logging.debug("local_client_id %s" % (binascii.hexlify(self.server_info.data.local_client_id),))
+            logging.debug("local_client_id %s", log.Hex(self.server_info.data.local_client_id))
             self.server_info.data.connection_id = struct.unpack('<I', os.urandom(4))[0] & 0xFFFFFF
         self.server_info.data.connection_id += 1
         return b''.join([struct.pack('<I', utc_time),
@@ -655,7 +666,7 @@ class auth_aes128_sha1(auth_base):
                 return (b'', False)
             sha1data = hmac.new(mac_key, self.recv_buf[7:27], self.hashfunc).digest()[:4]
             if sha1data != self.recv_buf[27:31]:
-                logging.error('%s data uncorrect auth HMAC-SHA1 from %s:%d, data %s' % (self.no_compatible_method, self.server_info.client, self.server_info.client_port, binascii.hexlify(self.recv_buf)))
+                log.limited(self.server_info.client, logging.ERROR, '%s data uncorrect auth HMAC-SHA1 from %s:%d, data %s', self.no_compatible_method, self.server_info.client, self.server_info.client_port, log.Hex(self.recv_buf))
                 if len(self.recv_buf) < 31 + self.extra_wait_size:
                     return (b'', False)
                 return self.not_match_return(self.recv_buf)
@@ -681,11 +692,11 @@ class auth_aes128_sha1(auth_base):
             connection_id = struct.unpack('<I', head[8:12])[0]
             rnd_len = struct.unpack('<H', head[14:16])[0]
             if hmac.new(self.user_key, self.recv_buf[:length - 4], self.hashfunc).digest()[:4] != self.recv_buf[length - 4:length]:
-                logging.info('%s: checksum error, data %s' % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
+                log.limited(self.server_info.client, logging.INFO, '%s: checksum error, data %s', self.no_compatible_method, log.Hex(self.recv_buf[:length]))
                 return self.not_match_return(self.recv_buf)
             time_dif = common.int32(utc_time - (int(time.time()) & 0xffffffff))
             if time_dif < -self.max_time_dif or time_dif > self.max_time_dif:
-                logging.info('%s: wrong timestamp, time_dif %d, data %s' % (self.no_compatible_method, time_dif, binascii.hexlify(head)))
+                log.limited(self.server_info.client, logging.INFO, '%s: wrong timestamp, time_dif %d, data %s', self.no_compatible_method, time_dif, log.Hex(head))
                 return self.not_match_return(self.recv_buf)
             elif self.server_info.data.insert(self.user_id, client_id, connection_id):
                 self.has_recv_header = True
@@ -693,7 +704,7 @@ class auth_aes128_sha1(auth_base):
                 self.client_id = client_id
                 self.connection_id = connection_id
             else:
-                logging.info('%s: auth fail, data %s' % (self.no_compatible_method, binascii.hexlify(out_buf)))
+                log.limited(self.server_info.client, logging.INFO, '%s: auth fail, data %s', self.no_compatible_method, log.Hex(out_buf))
                 return self.not_match_return(self.recv_buf)
             self.recv_buf = self.recv_buf[length:]
             self.has_recv_header = True
@@ -704,9 +715,9 @@ class auth_aes128_sha1(auth_base):
             mac = hmac.new(mac_key, self.recv_buf[:2], self.hashfunc).digest()[:2]
             if mac != self.recv_buf[2:4]:
                 self.raw_trans = True
-                logging.info(self.no_compatible_method + ': wrong crc')
+                log.limited(self.server_info.client, logging.INFO, '%s: wrong crc', self.no_compatible_method)
                 if self.recv_id == 0:
-                    logging.info(self.no_compatible_method + ': wrong crc')
+                    log.limited(self.server_info.client, logging.INFO, '%s: wrong crc', self.no_compatible_method)
                     return (b'E'*2048, False)
                 else:
                     raise Exception('server_post_decrype data error')
@@ -715,7 +726,7 @@ class auth_aes128_sha1(auth_base):
                 self.raw_trans = True
                 self.recv_buf = b''
                 if self.recv_id == 0:
-                    logging.info(self.no_compatible_method + ': over size')
+                    log.limited(self.server_info.client, logging.INFO, '%s: over size', self.no_compatible_method)
                     return (b'E'*2048, False)
                 else:
                     raise Exception('server_post_decrype data error')
@@ -723,7 +734,7 @@ class auth_aes128_sha1(auth_base):
                 break
 
             if hmac.new(mac_key, self.recv_buf[:length - 4], self.hashfunc).digest()[:4] != self.recv_buf[length - 4:length]:
-                logging.info('%s: checksum error, data %s' % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
+                log.limited(self.server_info.client, logging.INFO, '%s: checksum error, data %s', self.no_compatible_method, log.Hex(self.recv_buf[:length]))
                 self.raw_trans = True
                 self.recv_buf = b''
                 if self.recv_id == 0:
@@ -21,7 +21,6 @@ import os
 import sys
 import hashlib
 import logging
-import binascii
 import base64
 import time
 import datetime
@@ -34,7 +33,7 @@ import hashlib
 import bisect
 
 import shadowsocks
-from shadowsocks import common, lru_cache, encrypt
+from shadowsocks import common, lru_cache, encrypt, log
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
 
@@ -87,6 +86,8 @@ def match_begin(str1, str2):
     return False
 
 class auth_base(plain.plain):
+    __slots__ = ('no_compatible_method', 'overhead', 'raw_trans')
+
     def __init__(self, method):
         super(auth_base, self).__init__(method)
         self.method = method
@@ -230,6 +231,13 @@ class obfs_auth_chain_data(object):
                 local_client_id[client_id].delref()
 
 class auth_chain_a(auth_base):
+    __slots__ = ('client_id', 'client_over_head', 'connection_id', 'encryptor',
+                 'has_recv_header', 'has_sent_header', 'hashfunc',
+                 'last_client_hash', 'last_server_hash', 'max_time_dif',
+                 'pack_id', 'random_client', 'random_server', 'recv_buf',
+                 'recv_id', 'salt', 'unit_len', 'user_id', 'user_id_num',
+                 'user_key')
+
     def __init__(self, method):
         super(auth_chain_a, self).__init__(method)
         self.hashfunc = hashlib.md5
@@ -378,7 +386,7 @@ class auth_chain_a(auth_base):
             self.server_info.data.local_client_id = b''
         if not self.server_info.data.local_client_id:
             self.server_info.data.local_client_id = os.urandom(4)
-            logging.debug("local_client_id %s" % (binascii.hexlify(self.server_info.data.local_client_id),))
+            logging.debug("local_client_id %s", log.Hex(self.server_info.data.local_client_id))
             self.server_info.data.connection_id = struct.unpack('<I', os.urandom(4))[0] & 0xFFFFFF
         self.server_info.data.connection_id += 1
         return b''.join([struct.pack('<I', utc_time),
@@ -420,7 +428,7 @@ class auth_chain_a(auth_base):
 
             server_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
             if server_hash[:2] != self.recv_buf[length + 2 : length + 4]:
-                logging.info('%s: checksum error, data %s' % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
+                logging.info('%s: checksum error, data %s', self.no_compatible_method, log.Hex(self.recv_buf[:length]))
                 self.raw_trans = True
                 self.recv_buf = b''
                 raise Exception('client_post_decrypt data uncorrect checksum')
@@ -488,7 +496,7 @@ class auth_chain_a(auth_base):
 
             md5data = hmac.new(self.user_key, self.recv_buf[12 : 12 + 20], self.hashfunc).digest()
             if md5data[:4] != self.recv_buf[32:36]:
-                logging.error('%s data uncorrect auth HMAC-MD5 from %s:%d, data %s' % (self.no_compatible_method, self.server_info.client, self.server_info.client_port, binascii.hexlify(self.recv_buf)))
+                log.limited(self.server_info.client, logging.ERROR, '%s data uncorrect auth HMAC-MD5 from %s:%d, data %s', self.no_compatible_method, self.server_info.client, self.server_info.client_port, log.Hex(self.recv_buf))
                 if len(self.recv_buf) < 36:
                     return (b'', False)
                 return self.not_match_return(self.recv_buf)
@@ -503,14 +511,14 @@ class auth_chain_a(auth_base):
             connection_id = struct.unpack('<I', head[8:12])[0]
             time_dif = common.int32(utc_time - (int(time.time()) & 0xffffffff))
             if time_dif < -self.max_time_dif or time_dif > self.max_time_dif:
-                logging.info('%s: wrong timestamp, time_dif %d, data %s' % (self.no_compatible_method, time_dif, binascii.hexlify(head)))
+                log.limited(self.server_info.client, logging.INFO, '%s: wrong timestamp, time_dif %d, data %s', self.no_compatible_method, time_dif, log.Hex(head))
                 return self.not_match_return(self.recv_buf)
             elif self.server_info.data.insert(self.user_id, client_id, connection_id):
                 self.has_recv_header = True
                 self.client_id = client_id
                 self.connection_id = connection_id
             else:
-                logging.info('%s: auth fail, data %s' % (self.no_compatible_method, binascii.hexlify(out_buf)))
+                log.limited(self.server_info.client, logging.INFO, '%s: auth fail, data %s', self.no_compatible_method, log.Hex(out_buf))
                 return self.not_match_return(self.recv_buf)
 
             self.encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(self.last_client_hash)), 'rc4')
@@ -527,7 +535,7 @@ class auth_chain_a(auth_base):
                 self.raw_trans = True
                 self.recv_buf = b''
                 if self.recv_id == 0:
-                    logging.info(self.no_compatible_method + ': over size')
+                    log.limited(self.server_info.client, logging.INFO, '%s: over size', self.no_compatible_method)
                     return (b'E'*2048, False)
                 else:
                     raise Exception('server_post_decrype data error')
@@ -537,7 +545,7 @@ class auth_chain_a(auth_base):
 
             client_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
             if client_hash[:2] != self.recv_buf[length + 2 : length + 4]:
-                logging.info('%s: checksum error, data %s' % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
+                log.limited(self.server_info.client, logging.INFO, '%s: checksum error, data %s', self.no_compatible_method, log.Hex(self.recv_buf[:length]))
                 self.raw_trans = True
                 self.recv_buf = b''
                 if self.recv_id == 0:
@@ -635,6 +643,8 @@ class auth_chain_a(auth_base):
         self.server_info.data.remove(self.user_id, self.client_id)
 
 class auth_chain_b(auth_chain_a):
+    __slots__ = ('data_size_list', 'data_size_list2')
+
     def __init__(self, method):
         super(auth_chain_b, self).__init__(method)
         self.salt = b"auth_chain_b"
@@ -56,6 +56,9 @@ def match_begin(str1, str2):
     return False
 
 class http_simple(plain.plain):
+    __slots__ = ('has_recv_header', 'has_sent_header', 'host', 'port',
+                 'recv_buffer', 'user_agent')
+
     def __init__(self, method):
         self.method = method
         self.has_sent_header = False
@@ -215,6 +218,8 @@ class http_simple(plain.plain):
             return (b'', True, False)
 
 class http_post(http_simple):
+    __slots__ = ()
+
     def __init__(self, method):
         super(http_post, self).__init__(method)
 
@@ -262,6 +267,9 @@ class http_post(http_simple):
         return (buf, True, False)
 
 class random_head(plain.plain):
+    __slots__ = ('has_recv_header', 'has_sent_header', 'raw_trans_recv',
+                 'raw_trans_sent', 'send_buffer')
+
     def __init__(self, method):
         self.method = method
         self.has_sent_header = False
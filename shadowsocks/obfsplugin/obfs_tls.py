@@ -30,7 +30,7 @@ import hmac
 import hashlib
 import string
 
-from shadowsocks import common
+from shadowsocks import common, log
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord
 from shadowsocks import lru_cache
@@ -59,6 +59,9 @@ class obfs_auth_data(object):
         self.ticket_buf = {}
 
 class tls_ticket_auth(plain.plain):
+    __slots__ = ('client_id', 'handshake_status', 'max_time_dif', 'overhead',
+                 'recv_buffer', 'send_buffer', 'tls_version')
+
     def __init__(self, method):
         self.method = method
         self.handshake_status = 0
@@ -144,7 +147,7 @@ class tls_ticket_auth(plain.plain):
             self.recv_buffer += buf
             while len(self.recv_buffer) > 5:
                 if ord(self.recv_buffer[0]) != 0x17:
-                    logging.info("data = %s" % (binascii.hexlify(self.recv_buffer)))
+                    logging.info("data = %s", log.Hex(self.recv_buffer))
                     raise Exception('server_decode appdata error')
                 size = struct.unpack('>H', self.recv_buffer[3:5])[0]
                 if len(self.recv_buffer) < size + 5:
@@ -209,7 +212,7 @@ class tls_ticket_auth(plain.plain):
             self.recv_buffer += buf
             while len(self.recv_buffer) > 5:
                 if ord(self.recv_buffer[0]) != 0x17 or ord(self.recv_buffer[1]) != 0x3 or ord(self.recv_buffer[2]) != 0x3:
-                    logging.info("data = %s" % (binascii.hexlify(self.recv_buffer)))
+                    log.limited(self.server_info.client, logging.INFO, "data = %s", log.Hex(self.recv_buffer))
                     raise Exception('server_decode appdata error')
                 size = struct.unpack('>H', self.recv_buffer[3:5])[0]
                 if len(self.recv_buffer) < size + 5:
@@ -257,22 +260,22 @@ class tls_ticket_auth(plain.plain):
         self.handshake_status = 1
         buf = buf[2:header_len + 2]
         if not match_begin(buf, b'\x01\x00'): #client hello
-            logging.info("tls_auth not client hello message")
+            log.limited(self.server_info.client, logging.INFO, "tls_auth not client hello message")
             return self.decode_error_return(ogn_buf)
         buf = buf[2:]
         if struct.unpack('>H', buf[:2])[0] != len(buf) - 2:
-            logging.info("tls_auth wrong message size")
+            log.limited(self.server_info.client, logging.INFO, "tls_auth wrong message size")
             return self.decode_error_return(ogn_buf)
         buf = buf[2:]
         if not match_begin(buf, self.tls_version):
-            logging.info("tls_auth wrong tls version")
+            log.limited(self.server_info.client, logging.INFO, "tls_auth wrong tls version")
             return self.decode_error_return(ogn_buf)
         buf = buf[2:]
         verifyid = buf[:32]
         buf = buf[32:]
         sessionid_len = ord(buf[0])
         if sessionid_len < 32:
-            logging.info("tls_auth wrong sessionid_len")
+            log.limited(self.server_info.client, logging.INFO, "tls_auth wrong sessionid_len")
             return self.decode_error_return(ogn_buf)
         sessionid = buf[1:sessionid_len + 1]
         buf = buf[sessionid_len+1:]
@@ -287,13 +290,13 @@ class tls_ticket_auth(plain.plain):
                 pass
         if self.max_time_dif > 0 and (time_dif < -self.max_time_dif or time_dif > self.max_time_dif \
                 or common.int32(utc_time - self.server_info.data.startup_time) < -self.max_time_dif / 2):
-            logging.info("tls_auth wrong time")
+            log.limited(self.server_info.client, logging.INFO, "tls_auth wrong time")
             return self.decode_error_return(ogn_buf)
         if sha1 != verifyid[22:]:
-            logging.info("tls_auth wrong sha1")
+            log.limited(self.server_info.client, logging.INFO, "tls_auth wrong sha1")
             return self.decode_error_return(ogn_buf)
         if self.server_info.data.client_data.get(verifyid[:22]):
-            logging.info("replay attack detect, id = %s" % (binascii.hexlify(verifyid)))
+            log.limited(self.server_info.client, logging.INFO, "replay attack detect, id = %s", log.Hex(verifyid))
             return self.decode_error_return(ogn_buf)
         self.server_info.data.client_data.sweep()
         self.server_info.data.client_data[verifyid[:22]] = sessionid
@@ -33,6 +33,10 @@ obfs_map = {
 }
 
 class plain(object):
+    # a plugin is created for every connection, so its attributes are kept
+    # in slots. subclasses list the attributes they add
+    __slots__ = ('method', 'server_info')
+
     def __init__(self, method):
         self.method = method
         self.server_info = None
@@ -54,6 +54,8 @@ class obfs_verify_data(object):
         pass
 
 class verify_base(plain.plain):
+    __slots__ = ()
+
     def __init__(self, method):
         super(verify_base, self).__init__(method)
         self.method = method
@@ -77,6 +79,8 @@ class verify_base(plain.plain):
         return (buf, True, False)
 
 class verify_deflate(verify_base):
+    __slots__ = ('decrypt_packet_num', 'raw_trans', 'recv_buf', 'unit_len')
+
     def __init__(self, method):
         super(verify_deflate, self).__init__(method)
         self.recv_buf = b''
@@ -69,45 +69,73 @@ def main():
     tcp_servers = []
     udp_servers = []
     dns_resolver = asyncdns.DNSResolver()
-    if int(config['workers']) > 1:
+    # with reuse_port every worker creates its own listening sockets after
+    # fork, and the kernel balances the connections between them
+    workers = int(config['workers'])
+    reuse_port = workers > 1 and os.name == 'posix' and config['reuse_port']
+    config['reuse_port'] = reuse_port
+    if workers > 1 and not reuse_port:
         stat_counter_dict = None
     else:
         stat_counter_dict = {}
     port_password = config['port_password']
     config_password = config.get('password', 'm')
     del config['port_password']
-    for port, password_obfs in port_password.items():
-        method = config["method"]
-        protocol = config.get("protocol", 'origin')
-        protocol_param = config.get("protocol_param", '')
-        obfs = config.get("obfs", 'plain')
-        obfs_param = config.get("obfs_param", '')
-        bind = config.get("out_bind", '')
-        bindv6 = config.get("out_bindv6", '')
-        if type(password_obfs) == list:
-            password = password_obfs[0]
-            obfs = common.to_str(password_obfs[1])
-            if len(password_obfs) > 2:
-                protocol = common.to_str(password_obfs[2])
-        elif type(password_obfs) == dict:
-            password = password_obfs.get('password', config_password)
-            method = common.to_str(password_obfs.get('method', method))
-            protocol = common.to_str(password_obfs.get('protocol', protocol))
-            protocol_param = common.to_str(password_obfs.get('protocol_param', protocol_param))
-            obfs = common.to_str(password_obfs.get('obfs', obfs))
-            obfs_param = common.to_str(password_obfs.get('obfs_param', obfs_param))
-            bind = password_obfs.get('out_bind', bind)
-            bindv6 = password_obfs.get('out_bindv6', bindv6)
-        else:
-            password = password_obfs
-        a_config = config.copy()
-        ipv6_ok = False
-        logging.info("server start with protocol[%s] password [%s] method [%s] obfs [%s] obfs_param [%s]" %
-                (protocol, password, method, obfs, obfs_param))
-        if 'server_ipv6' in a_config:
+
+    def create_servers():
+        for port, password_obfs in port_password.items():
+            method = config["method"]
+            protocol = config.get("protocol", 'origin')
+            protocol_param = config.get("protocol_param", '')
+            obfs = config.get("obfs", 'plain')
+            obfs_param = config.get("obfs_param", '')
+            bind = config.get("out_bind", '')
+            bindv6 = config.get("out_bindv6", '')
+            if type(password_obfs) == list:
+                password = password_obfs[0]
+                obfs = common.to_str(password_obfs[1])
+                if len(password_obfs) > 2:
+                    protocol = common.to_str(password_obfs[2])
+            elif type(password_obfs) == dict:
+                password = password_obfs.get('password', config_password)
+                method = common.to_str(password_obfs.get('method', method))
+                protocol = common.to_str(password_obfs.get('protocol', protocol))
+                protocol_param = common.to_str(password_obfs.get('protocol_param', protocol_param))
+                obfs = common.to_str(password_obfs.get('obfs', obfs))
+                obfs_param = common.to_str(password_obfs.get('obfs_param', obfs_param))
+                bind = password_obfs.get('out_bind', bind)
+                bindv6 = password_obfs.get('out_bindv6', bindv6)
+            else:
+                password = password_obfs
+            a_config = config.copy()
+            ipv6_ok = False
+            logging.info("server start with protocol[%s] password [%s] method [%s] obfs [%s] obfs_param [%s]" %
+                    (protocol, password, method, obfs, obfs_param))
+            if 'server_ipv6' in a_config:
+                try:
+                    if len(a_config['server_ipv6']) > 2 and a_config['server_ipv6'][0] == "[" and a_config['server_ipv6'][-1] == "]":
+                        a_config['server_ipv6'] = a_config['server_ipv6'][1:-1]
+                    a_config['server_port'] = int(port)
+                    a_config['password'] = password
+                    a_config['method'] = method
+                    a_config['protocol'] = protocol
+                    a_config['protocol_param'] = protocol_param
+                    a_config['obfs'] = obfs
+                    a_config['obfs_param'] = obfs_param
+                    a_config['out_bind'] = bind
+                    a_config['out_bindv6'] = bindv6
+                    a_config['server'] = a_config['server_ipv6']
+                    logging.info("starting server at [%s]:%d" %
+                                 (a_config['server'], int(port)))
+                    tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
+                    udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
+                    if a_config['server_ipv6'] == b"::":
+                        ipv6_ok = True
+                except Exception as e:
+                    shell.print_exception(e)
+
             try:
-                if len(a_config['server_ipv6']) > 2 and a_config['server_ipv6'][0] == "[" and a_config['server_ipv6'][-1] == "]":
-                    a_config['server_ipv6'] = a_config['server_ipv6'][1:-1]
+                a_config = config.copy()
                 a_config['server_port'] = int(port)
                 a_config['password'] = password
                 a_config['method'] = method
@@ -117,34 +145,16 @@ def main():
                 a_config['obfs_param'] = obfs_param
                 a_config['out_bind'] = bind
                 a_config['out_bindv6'] = bindv6
-                a_config['server'] = a_config['server_ipv6']
-                logging.info("starting server at [%s]:%d" %
+                logging.info("starting server at %s:%d" %
                              (a_config['server'], int(port)))
                 tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
                 udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-                if a_config['server_ipv6'] == b"::":
-                    ipv6_ok = True
             except Exception as e:
-                shell.print_exception(e)
+                if not ipv6_ok:
+                    shell.print_exception(e)
 
-        try:
-            a_config = config.copy()
-            a_config['server_port'] = int(port)
-            a_config['password'] = password
-            a_config['method'] = method
-            a_config['protocol'] = protocol
-            a_config['protocol_param'] = protocol_param
-            a_config['obfs'] = obfs
-            a_config['obfs_param'] = obfs_param
-            a_config['out_bind'] = bind
-            a_config['out_bindv6'] = bindv6
-            logging.info("starting server at %s:%d" %
-                         (a_config['server'], int(port)))
-            tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-            udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-        except Exception as e:
-            if not ipv6_ok:
-                shell.print_exception(e)
+    if not reuse_port:
+        create_servers()
 
     def run_server():
         def child_handler(signum, _):
@@ -159,7 +169,7 @@ def main():
         signal.signal(signal.SIGINT, int_handler)
 
         try:
-            loop = eventloop.EventLoop()
+            loop = eventloop.create_loop(config)
             dns_resolver.add_to_loop(loop)
             list(map(lambda s: s.add_to_loop(loop), tcp_servers + udp_servers))
 
@@ -169,15 +179,17 @@ def main():
             shell.print_exception(e)
             sys.exit(1)
 
-    if int(config['workers']) > 1:
+    if workers > 1:
         if os.name == 'posix':
             children = []
             is_child = False
-            for i in range(0, int(config['workers'])):
+            for i in range(0, workers):
                 r = os.fork()
                 if r == 0:
                     logging.info('worker started')
                     is_child = True
+                    if reuse_port:
+                        create_servers()
                     run_server()
                     break
                 else:
@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# bandwidth limits of the TCP relays
+#
+# the limits nest: the node, the port, the user and the connection. the
+# user and the connection have a SpeedTester each, a connection over its
+# limit or the one of its user waits for a timer of its own. the port and
+# the node have a Shaper, shared by the users: while it has no bandwidth
+# to spare the users take turns by deficit round robin, so a user with
+# many connections or a fast link gets the same share as the others, and
+# what a user reading less than its share leaves goes to the others
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+from shadowsocks import eventloop
+
+
+# a congested shaper shares the bandwidth of this many seconds each round
+ROUND = 0.05
+
+
+class SpeedTester(object):
+    # a token bucket of max_speed KB/s holding one second of them at most.
+    # add takes the bytes relayed, the bucket may go into debt for the last
+    # chunk read, and is refilled only when asked how long to wait
+    __slots__ = ('max_speed', 'last_time', 'tokens')
+
+    def __init__(self, max_speed = 0):
+        self.max_speed = max_speed * 1024
+        self.last_time = eventloop.monotonic()
+        self.tokens = self.max_speed
+
+    def update_limit(self, max_speed):
+        self.max_speed = max_speed * 1024
+        self.tokens = min(self.tokens, self.max_speed)
+
+    def add(self, data_len):
+        # unlimited relays no debt to pay off once a limit is set
+        if self.max_speed > 0:
+            self.tokens -= data_len
+
+    def wait(self, now):
+        # seconds until the bucket is out of debt, 0 if it is now
+        max_speed = self.max_speed
+        if max_speed <= 0:
+            return 0
+        tokens = self.tokens + (now - self.last_time) * max_speed
+        if tokens > max_speed:
+            tokens = max_speed
+        self.tokens = tokens
+        self.last_time = now
+        if tokens >= 0:
+            return 0
+        return -tokens / max_speed
+
+
+class Shaper(object):
+    # the limit of a port or of the node, in one direction. a connection
+    # which may not read is parked with handler._unthrottle(stream) to call
+    # when its user has a share again. while congested, a round every ROUND
+    # seconds splits the bandwidth of the round evenly between the users
+    # which were parked or read during the last round, and only users with
+    # some of their share left may read. a user going over its share
+    # carries the debt to the next. the share a user which was not parked
+    # left is not kept, it goes to the parked users in the next round
+
+    def __init__(self, max_speed=0):
+        self.tester = SpeedTester(max_speed)
+        self.deficits = {}  # user: bytes left of its share, while congested
+        self.parked = {}  # user: set of (handler, stream)
+        self.active = set()  # the users which read during this round
+        self.loop = None
+        self.timer = None
+
+    def update_limit(self, max_speed):
+        self.tester.update_limit(max_speed)
+
+    @property
+    def max_speed(self):
+        return self.tester.max_speed
+
+    def add(self, user, data_len):
+        self.tester.add(data_len)
+        deficits = self.deficits
+        if user in deficits:
+            deficits[user] -= data_len
+            self.active.add(user)
+
+    def admit(self, user, now):
+        # whether a connection of user may read more now
+        if self.timer is None:
+            return self.tester.wait(now) <= 0
+        return self.deficits.get(user, 0) > 0
+
+    def park(self, loop, user, handler, stream):
+        self.parked.setdefault(user, set()).add((handler, stream))
+        if self.timer is None:
+            self.loop = loop
+            delay = max(self.tester.wait(loop.now), ROUND)
+            self.timer = loop.call_later(delay, self._round)
+
+    def unpark(self, user, handler, stream):
+        waiting = self.parked.get(user, None)
+        if waiting is not None:
+            waiting.discard((handler, stream))
+            if not waiting:
+                del self.parked[user]
+
+    def _round(self):
+        self.timer = None
+        parked = self.parked
+        deficits = self.deficits
+        active = self.active
+        self.active = set()
+        if not parked and not active:
+            # nobody read or waited during the last round
+            deficits.clear()
+            return
+        max_speed = self.tester.max_speed
+        woken = parked
+        self.parked = {}
+        if max_speed <= 0:
+            # no limit anymore
+            deficits.clear()
+        else:
+            quantum = max_speed * ROUND
+            active.update(parked)
+            share = quantum / len(active)
+            # what the users which were not parked left of their share, at
+            # most a round of it, so the limit is used up
+            unused = 0
+            for user, deficit in deficits.items():
+                if deficit > 0 and user not in parked:
+                    unused += deficit
+            parked_share = share
+            if parked:
+                parked_share += min(unused, quantum) / len(parked)
+            # what a user overdraws is its own debt, the others still get
+            # their share of every round
+            self.deficits = deficits = dict(
+                (user, min(deficits.get(user, 0), 0) +
+                 (parked_share if user in parked else share))
+                for user in active)
+            woken = {}
+            for user, waiting in parked.items():
+                if deficits[user] > 0:
+                    woken[user] = waiting
+                else:
+                    # still paying its debt
+                    self.parked[user] = waiting
+            self.timer = self.loop.call_later(ROUND, self._round)
+        for waiting in woken.values():
+            for handler, stream in waiting:
+                handler._unthrottle(stream)
+
+
+# the node, shared by the relays of the process
+node_up = Shaper()
+node_down = Shaper()
+
+
+def test():
+    t = SpeedTester(1)
+    now = t.last_time
+    t.add(1024)
+    assert t.wait(now) == 0
+    t.add(512)
+    assert t.wait(now) == 0.5
+    assert t.wait(now + 0.5) == 0
+    assert t.wait(now + 10) == 0 and t.tokens == 1024
+    assert SpeedTester(0).wait(now) == 0
+
+    # setting a limit after a while unlimited starts from a full bucket
+    t = SpeedTester(0)
+    now = t.last_time
+    for i in range(1000):
+        t.add(1024 * 1024)
+    assert t.wait(now) == 0
+    t.update_limit(1)
+    assert t.wait(now + 1) == 0 and t.tokens == 1024
+    t.add(2048)
+    assert t.wait(now + 1) == 1
+
+    class Loop(object):
+        def __init__(self):
+            self.timers = []
+            self.now = eventloop.monotonic()
+
+        def call_later(self, delay, callback, *args):
+            self.timers.append((callback, args))
+            return callback
+
+    class Handler(object):
+        def __init__(self):
+            self.woken = 0
+
+        def _unthrottle(self, stream):
+            self.woken += 1
+
+    loop = Loop()
+    s = Shaper(100)
+    now = eventloop.monotonic()
+    assert s.admit('a', now)
+    s.add('a', 200 * 1024)
+    assert not s.admit('a', now)
+    heavy = [Handler() for i in range(4)]
+    light = Handler()
+    for h in heavy:
+        s.park(loop, 'a', h, 0)
+    s.park(loop, 'b', light, 0)
+    assert len(loop.timers) == 1
+    # the bandwidth of a round is shared by a and b
+    s.tester.tokens = 0
+    loop.timers.pop()[0]()
+    share = s.deficits['a']
+    assert s.deficits['b'] == share >= s.max_speed * ROUND / 2
+    assert all(h.woken == 1 for h in heavy) and light.woken == 1
+    # the 4 connections of a use its share and overdraw it, b reads half
+    for h in heavy:
+        assert s.admit('a', now)
+        s.add('a', share / 4)
+    assert not s.admit('a', now)
+    s.add('a', 4 * share)
+    s.add('b', share / 2)
+    assert s.admit('b', now)
+    s.park(loop, 'a', heavy[0], 0)
+    s.tester.tokens = 0
+    loop.timers.pop()[0]()
+    # b read and keeps a share, a pays its debt first and is not woken
+    assert s.deficits['b'] > 0 and s.deficits['a'] <= 0
+    assert heavy[0].woken == 1 and s.parked
+    s.unpark('a', heavy[0], 0)
+    assert not s.parked
+    loop.timers.pop()[0]()
+    assert not s.deficits and s.timer is None
+    assert s.admit('a', eventloop.monotonic() + 10)
+
+    # a greedy user and one reading a trickle: the greedy one gets what
+    # the trickle leaves of the limit
+    s = Shaper(1000)
+    quantum = s.max_speed * ROUND
+    trickle = quantum / 20
+    chunk = quantum / 8
+    greedy = Handler()
+    s.add('greedy', s.max_speed * 2)
+    assert not s.admit('greedy', now)
+    s.park(loop, 'greedy', greedy, 0)
+    read = {'greedy': 0, 'trickle': 0}
+    rounds = 200
+    for i in range(rounds):
+        loop.timers.pop()[0]()
+        if 'greedy' not in s.parked:
+            while s.admit('greedy', now):
+                s.add('greedy', chunk)
+                read['greedy'] += chunk
+            s.park(loop, 'greedy', greedy, 0)
+        if s.admit('trickle', now):
+            s.add('trickle', trickle)
+            read['trickle'] += trickle
+        else:
+            s.park(loop, 'trickle', light, 0)
+    assert read['trickle'] >= trickle * rounds * 0.9, read
+    assert read['greedy'] >= (quantum - trickle) * rounds * 0.95, read
+    assert sum(read.values()) <= quantum * (rounds + 2), read
+
+
+if __name__ == '__main__':
+    test()
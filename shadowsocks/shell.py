@@ -23,11 +23,12 @@ import json
 import sys
 import getopt
 import logging
-from shadowsocks.common import to_bytes, to_str, IPNetwork, PortRange
-from shadowsocks import encrypt
+from shadowsocks.common import to_bytes, to_str, IPNetwork, PortRange, \
+    SO_REUSEPORT
+from shadowsocks import encrypt, log
 
 
-VERBOSE_LEVEL = 5
+VERBOSE_LEVEL = log.VERBOSE_LEVEL
 
 verbose = 0
 
@@ -126,6 +127,11 @@ def check_config(config, is_local):
             logging.error('user can be used only on Unix')
             sys.exit(1)
 
+    if config.get('reuse_port', False) and SO_REUSEPORT is None:
+        logging.warning('warning: reuse_port is not supported on this '
+                        'platform')
+        config['reuse_port'] = False
+
     encrypt.try_cipher(config['password'], config['method'])
 
 
@@ -135,6 +141,7 @@ def get_config(is_local):
     config_path = None
     logging.basicConfig(level=logging.INFO,
                         format='%(levelname)-s: %(message)s')
+    log.update()
     if is_local:
         shortopts = 'hd:s:b:p:k:l:m:O:o:G:g:c:t:vq'
         longopts = ['help', 'fast-open', 'pid-file=', 'log-file=', 'user=',
@@ -245,6 +252,9 @@ def get_config(is_local):
     config['udp_cache'] = int(config.get('udp_cache', 64))
     config['fast_open'] = config.get('fast_open', False)
     config['workers'] = config.get('workers', 1)
+    config['reuse_port'] = config.get('reuse_port', False)
+    config['transfer_table_size'] = int(config.get('transfer_table_size',
+                                                   65536))
     config['pid-file'] = config.get('pid-file', '/var/run/shadowsocksr.pid')
     config['log-file'] = config.get('log-file', '/var/log/shadowsocksr.log')
     config['verbose'] = config.get('verbose', False)
@@ -295,6 +305,7 @@ def get_config(is_local):
     logging.basicConfig(level=level,
                         format='%(asctime)s %(levelname)-8s %(filename)s:%(lineno)s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
+    log.update()
 
     check_config(config, is_local)
 
@@ -18,7 +18,7 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import time
+import os
 import socket
 import errno
 import struct
@@ -28,14 +28,21 @@ import traceback
 import random
 import platform
 import threading
+import itertools
+import collections
 
-from shadowsocks import encrypt, obfs, eventloop, shell, common, lru_cache, version
+from shadowsocks import encrypt, obfs, eventloop, shell, common, lru_cache, version, latency, log, \
+    shaper
 from shadowsocks.common import pre_parse_header, parse_header
+from shadowsocks.obfsplugin import plain
+from shadowsocks.transfer_table import TransferTable
 
 # we clear at most TIMEOUTS_CLEAN_SIZE timeouts each time
 TIMEOUTS_CLEAN_SIZE = 512
 
 MSG_FASTOPEN = 0x20000000
+# Linux 4.11+, connect returns at once and the first write goes in the SYN
+TCP_FASTOPEN_CONNECT = 30
 
 # SOCKS command definition
 CMD_CONNECT = 1
@@ -95,35 +102,167 @@ TCP_MSS = NETWORK_MTU - 40
 BUF_SIZE = 32 * 1024
 UDP_MAX_BUF_SIZE = 65536
 
-class SpeedTester(object):
-    def __init__(self, max_speed = 0):
-        self.max_speed = max_speed * 1024
-        self.last_time = time.time()
-        self.sum_len = 0
-
-    def update_limit(self, max_speed):
-        self.max_speed = max_speed * 1024
-
-    def add(self, data_len):
-        if self.max_speed > 0:
-            cut_t = time.time()
-            self.sum_len -= (cut_t - self.last_time) * self.max_speed
-            if self.sum_len < 0:
-                self.sum_len = 0
-            self.last_time = cut_t
-            self.sum_len += data_len
-
-    def isExceed(self):
-        if self.max_speed > 0:
-            cut_t = time.time()
-            self.sum_len -= (cut_t - self.last_time) * self.max_speed
-            if self.sum_len < 0:
-                self.sum_len = 0
-            self.last_time = cut_t
-            return self.sum_len >= self.max_speed
-        return False
+# most buffers given to a single sendmsg, Linux allows 1024
+IOV_MAX = 1024
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# a connection stops reading the other side when this many bytes wait to be
+# written, or the connections of the process together wait to write
+# WRITE_BUFFER_LIMIT bytes. it reads again at the low watermark
+WRITE_BUFFER_HIGH = 64 * 1024
+WRITE_BUFFER_LOW = 16 * 1024
+WRITE_BUFFER_LIMIT = 256 * 1024 * 1024
+
+# connections with nothing to transform move the bytes between the sockets
+# with splice through a pipe, SPLICE_SIZE bytes at most each time
+HAS_SPLICE = hasattr(os, 'splice')
+SPLICE_SIZE = 64 * 1024
+
+# connections accepted for each readable event of a listening socket at most
+ACCEPT_BATCH = 64
+# out of descriptors, a listening socket isn't polled for this long
+ACCEPT_BACKOFF = 0.1
+
+# an IPv6 connect that is not done after this long races an IPv4 one to the
+# same host, the first to connect is kept, as in RFC 8305
+CONNECT_ATTEMPT_DELAY = 0.25
+
+# seconds a connection may stay idle in the stages before STAGE_STREAM, the
+# handshake (STAGE_INIT and STAGE_ADDR), STAGE_DNS and STAGE_CONNECTING.
+# the config may change them, but they are never longer than the timeout.
+# sslocal with fast_open waits for data in STAGE_CONNECTING with the timeout
+HANDSHAKE_TIMEOUT = 30
+DNS_TIMEOUT = 30
+CONNECT_TIMEOUT = 30
+
+class WriteBuffer(collections.deque):
+    # the data waiting to be written to a socket, and its size. total is
+    # the size of all the write buffers of the process
+
+    total = 0
+
+    def __init__(self):
+        collections.deque.__init__(self)
+        self.size = 0
+
+    def append(self, data):
+        collections.deque.append(self, data)
+        self.size += len(data)
+        WriteBuffer.total += len(data)
+
+    def popleft(self):
+        data = collections.deque.popleft(self)
+        self.size -= len(data)
+        WriteBuffer.total -= len(data)
+        return data
+
+    def clear(self):
+        collections.deque.clear(self)
+        WriteBuffer.total -= self.size
+        self.size = 0
+
+    def consume(self, size):
+        # drops size bytes from the front. a partially sent buffer is
+        # replaced by a memoryview of its rest, so nothing is copied again
+        self.size -= size
+        WriteBuffer.total -= size
+        while size:
+            data = self[0]
+            if len(data) > size:
+                if HAS_SENDMSG:
+                    data = memoryview(data)
+                self[0] = data[size:]
+                return
+            size -= len(data)
+            collections.deque.popleft(self)
+
+
+class SplicePipe(object):
+    # a pipe the bytes of one direction are spliced through, and how many
+    # of them wait in it to be written
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        self.size = 0
+
+    def fill(self, fd, size):
+        n = os.splice(fd, self._w, size,
+                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.size += n
+        return n
+
+    def drain(self, fd):
+        n = os.splice(self._r, fd, self.size,
+                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.size -= n
+        return n
+
+    def close(self):
+        os.close(self._r)
+        os.close(self._w)
+
+
+def buffered_bytes():
+    # gauge of the bytes waiting to be written by all the TCP connections
+    return WriteBuffer.total
+
+
+class ConnectionTemplate(object):
+    # what the connections of a port are created with, worked out once from
+    # the config of the port instead of for every accepted socket
+
+    __slots__ = ('host', 'key_str', 'obfs_param', 'protocol_param',
+                 'redir_list', 'bind', 'bindv6', 'ignore_bind_list',
+                 'forbidden_iplist', 'forbidden_portset',
+                 'write_buffer_high', 'write_buffer_low',
+                 'write_buffer_limit', 'splice', 'happy_eyeballs',
+                 'remote_fast_open', 'bind_families', 'speed_limit_per_con')
+
+    def __init__(self, config):
+        self.host = config['server']
+        self.key_str = common.to_bytes(config['password'])
+        self.obfs_param = config['obfs_param']
+        self.protocol_param = config['protocol_param']
+        self.redir_list = config.get('redirect', ["*#0.0.0.0:0"])
+        self.bind = config.get('out_bind', '')
+        self.bindv6 = config.get('out_bindv6', '')
+        self.ignore_bind_list = config.get('ignore_bind', [])
+        # the address family of each address bound to, from getaddrinfo
+        self.bind_families = {}
+        self.forbidden_iplist = config.get('forbidden_ip', None)
+        self.forbidden_portset = config.get('forbidden_port', None)
+        self.write_buffer_high = config.get('write_buffer_high', WRITE_BUFFER_HIGH)
+        self.write_buffer_low = config.get('write_buffer_low', WRITE_BUFFER_LOW)
+        self.write_buffer_limit = config.get('write_buffer_limit', WRITE_BUFFER_LIMIT)
+        self.splice = HAS_SPLICE and config.get('splice', True)
+        self.happy_eyeballs = config.get('happy_eyeballs', True)
+        self.remote_fast_open = config.get('remote_fast_open', False)
+        self.speed_limit_per_con = config.get("speed_limit_per_con", 0)
+
 
 class TCPRelayHandler(object):
+    # there is one for every connection, keep it small
+    __slots__ = ('_server', '_fd_to_handlers', '_loop', '_config',
+                 '_dns_resolver', '_is_local', '_stage', '_add_ref',
+                 '_local_sock', '_local_sock_fd', '_remote_sock',
+                 '_remote_sock_fd', '_remote_sock_v6', '_remotev6_sock_fd',
+                 '_remote_sock_race', '_remote_sock_race_fd', '_race_timer',
+                 '_race_target',
+                 '_remote_udp', '_client_address', '_accept_address',
+                 '_remote_address', '_chosen_server', '_user', '_user_id',
+                 '_encryptor', '_encrypt_correct', '_obfs', '_protocol',
+                 '_overhead', '_tcp_mss', '_recv_buffer_size',
+                 '_recv_u_max_size', '_recv_d_max_size', '_recv_pack_id',
+                 '_udp_send_pack_id', '_udpv6_send_pack_id',
+                 '_accept_time', '_latency_time', '_latency_mark',
+                 '_template', '_is_redirect', '_fastopen_connected',
+                 '_data_to_write_to_local', '_data_to_write_to_remote',
+                 '_splice', '_pipe_to_local',
+                 '_pipe_to_remote', '_udp_data_send_buffer',
+                 '_upstream_status', '_downstream_status', 'last_activity',
+                 'speed_tester_u', 'speed_tester_d', '_throttle_u',
+                 '_throttle_d')
+
     def __init__(self, server, fd_to_handlers, loop, local_sock, config,
                  dns_resolver, is_local):
         self._server = server
@@ -135,10 +274,17 @@ class TCPRelayHandler(object):
         self._local_sock_fd = None
         self._remote_sock_fd = None
         self._remotev6_sock_fd = None
+        self._remote_sock_race = None
+        self._remote_sock_race_fd = None
+        self._race_timer = None
+        self._race_target = None
         self._remote_udp = False
         self._config = config
         self._dns_resolver = dns_resolver
+        self._template = template = server.template
         self._add_ref = 0
+        self._accept_time = self._latency_time = eventloop.monotonic()
+        self._latency_mark = latency.ACCEPT
         if not self._create_encryptor(config):
             return
 
@@ -158,17 +304,17 @@ class TCPRelayHandler(object):
         self._recv_buffer_size = BUF_SIZE - self._overhead
 
         server_info = obfs.server_info(server.obfs_data)
-        server_info.host = config['server']
+        server_info.host = template.host
         server_info.port = server._listen_port
         #server_info.users = server.server_users
         #server_info.update_user_func = self._update_user
         server_info.client = self._client_address[0]
         server_info.client_port = self._client_address[1]
         server_info.protocol_param = ''
-        server_info.obfs_param = config['obfs_param']
+        server_info.obfs_param = template.obfs_param
         server_info.iv = self._encryptor.cipher_iv
         server_info.recv_iv = b''
-        server_info.key_str = common.to_bytes(config['password'])
+        server_info.key_str = template.key_str
         server_info.key = self._encryptor.cipher_key
         server_info.head_len = 30
         server_info.tcp_mss = self._tcp_mss
@@ -177,17 +323,17 @@ class TCPRelayHandler(object):
         self._obfs.set_server_info(server_info)
 
         server_info = obfs.server_info(server.protocol_data)
-        server_info.host = config['server']
+        server_info.host = template.host
         server_info.port = server._listen_port
         server_info.users = server.server_users
         server_info.update_user_func = self._update_user
         server_info.client = self._client_address[0]
         server_info.client_port = self._client_address[1]
-        server_info.protocol_param = config['protocol_param']
+        server_info.protocol_param = template.protocol_param
         server_info.obfs_param = ''
         server_info.iv = self._encryptor.cipher_iv
         server_info.recv_iv = b''
-        server_info.key_str = common.to_bytes(config['password'])
+        server_info.key_str = template.key_str
         server_info.key = self._encryptor.cipher_key
         server_info.head_len = 30
         server_info.tcp_mss = self._tcp_mss
@@ -195,32 +341,36 @@ class TCPRelayHandler(object):
         server_info.overhead = self._overhead
         self._protocol.set_server_info(server_info)
 
-        self._redir_list = config.get('redirect', ["*#0.0.0.0:0"])
         self._is_redirect = False
-        self._bind = config.get('out_bind', '')
-        self._bindv6 = config.get('out_bindv6', '')
-        self._ignore_bind_list = config.get('ignore_bind', [])
 
         self._fastopen_connected = False
-        self._data_to_write_to_local = []
-        self._data_to_write_to_remote = []
+        self._data_to_write_to_local = WriteBuffer()
+        self._data_to_write_to_remote = WriteBuffer()
+        # none, origin and plain leave the bytes as they are
+        self._splice = template.splice and \
+            common.to_str(config['method']).lower() == 'none' and \
+            self._protocol.method.lower() in plain.obfs_map and \
+            self._obfs.method.lower() in plain.obfs_map
+        self._pipe_to_local = None
+        self._pipe_to_remote = None
         self._udp_data_send_buffer = b''
         self._upstream_status = WAIT_STATUS_READING
         self._downstream_status = WAIT_STATUS_INIT
         self._remote_address = None
 
-        self._forbidden_iplist = config.get('forbidden_ip', None)
-        self._forbidden_portset = config.get('forbidden_port', None)
         if is_local:
             self._chosen_server = self._get_a_server()
 
-        self.last_activity = 0
-        self._update_activity()
+        self.last_activity = loop.now
         self._server.add_connection(1)
         self._server.stat_add(self._client_address[0], 1)
         self._add_ref = 1
-        self.speed_tester_u = SpeedTester(config.get("speed_limit_per_con", 0))
-        self.speed_tester_d = SpeedTester(config.get("speed_limit_per_con", 0))
+        self.speed_tester_u = None
+        self.speed_tester_d = None
+        # what a throttled stream waits for, a timer or a shaper
+        self._throttle_u = None
+        self._throttle_d = None
+        self._update_speed_limit(template.speed_limit_per_con)
         self._recv_u_max_size = BUF_SIZE
         self._recv_d_max_size = BUF_SIZE
         self._recv_pack_id = 0
@@ -233,6 +383,7 @@ class TCPRelayHandler(object):
         fd_to_handlers[self._local_sock_fd] = self
         loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self._server)
         self._stage = STAGE_INIT
+        self._server.add_handler(self)
 
     def __hash__(self):
         # default __hash__ is id / 16
@@ -259,7 +410,8 @@ class TCPRelayHandler(object):
             tcp_mss = local_sock.getsockopt(socket.SOL_TCP, socket.TCP_MAXSEG)
             if tcp_mss > 500 and tcp_mss <= 1500:
                 self._tcp_mss = tcp_mss
-            logging.debug("TCP MSS = %d" % (self._tcp_mss,))
+            if log.DEBUG:
+                logging.debug("TCP MSS = %d", self._tcp_mss)
         except:
             pass
 
@@ -277,14 +429,43 @@ class TCPRelayHandler(object):
         self._user_id = struct.unpack('<I', user)[0]
         if self._user in self._server.server_users_cfg:
             cfg = self._server.server_users_cfg[self._user]
-            speed = cfg.get('speed_limit_per_con', 0)
+            self._update_speed_limit(cfg.get('speed_limit_per_con', 0))
+
+    def _update_speed_limit(self, speed):
+        # the speed testers only exist while the connection has a limit
+        if speed <= 0:
+            self.speed_tester_u = None
+            self.speed_tester_d = None
+        elif self.speed_tester_u is None:
+            self.speed_tester_u = shaper.SpeedTester(speed)
+            self.speed_tester_d = shaper.SpeedTester(speed)
+        else:
             self.speed_tester_u.update_limit(speed)
             self.speed_tester_d.update_limit(speed)
 
     def _update_activity(self, data_len=0):
-        # tell the TCP Relay we have activities recently
-        # else it will think we are inactive and timed out
-        self._server.update_activity(self, data_len)
+        # the TCP Relay times out the connections which have not been
+        # active for a while, it looks at last_activity now and then
+        self.last_activity = self._loop.now
+        if data_len:
+            server = self._server
+            if server._stat_callback:
+                server._stat_callback(server._listen_port, data_len)
+
+    def _set_stage(self, stage):
+        # the timeout of a stage counts from when it begins
+        if self._stage == STAGE_DESTROYED:
+            return
+        self._stage = stage
+        self.last_activity = self._loop.now
+        self._server.add_handler(self)
+
+    def _mark_latency(self, mark):
+        # the time since the last mark goes in the histogram of this one
+        now = eventloop.monotonic()
+        self._server.latency.record(mark, now - self._latency_time)
+        self._latency_time = now
+        self._latency_mark = mark
 
     def _update_stream(self, stream, status):
         # update a stream to a new waiting status
@@ -301,22 +482,95 @@ class TCPRelayHandler(object):
                 self._upstream_status = status
                 dirty = True
         if dirty:
-            if self._local_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                if self._upstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                self._loop.modify(self._local_sock, event)
-            if self._remote_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                if self._upstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                self._loop.modify(self._remote_sock, event)
-                if self._remote_sock_v6:
-                    self._loop.modify(self._remote_sock_v6, event)
+            self._update_events()
+
+    def _update_events(self):
+        if self._local_sock:
+            event = eventloop.POLL_ERR
+            if self._downstream_status & WAIT_STATUS_WRITING:
+                event |= eventloop.POLL_OUT
+            if self._upstream_status & WAIT_STATUS_READING and \
+                    self._throttle_u is None:
+                event |= eventloop.POLL_IN
+            self._loop.modify(self._local_sock, event)
+        if self._remote_sock:
+            event = self._remote_event()
+            self._loop.modify(self._remote_sock, event)
+            if self._remote_sock_v6:
+                self._loop.modify(self._remote_sock_v6, event)
+
+    def _add_read(self, stream, data_len):
+        # count the bytes read from a stream against its limits
+        server = self._server
+        if stream == STREAM_UP:
+            tester = self.speed_tester_u
+            server.speed_tester_u(self._user_id).add(data_len)
+            shapers = server.shapers_u
+        else:
+            tester = self.speed_tester_d
+            server.speed_tester_d(self._user_id).add(data_len)
+            shapers = server.shapers_d
+        if tester is not None:
+            tester.add(data_len)
+        if shapers:
+            user = (server._listen_port, self._user_id)
+            for s in shapers:
+                s.add(user, data_len)
+
+    def _throttle(self, stream):
+        # after a read, stop reading the stream until its limits have room
+        # again, a throttled socket is not polled at all. the connection
+        # and the user wait for a timer, the port and the node for their
+        # shaper to give the user a share
+        if self._stage == STAGE_DESTROYED:
+            return
+        now = self._loop.now
+        server = self._server
+        if stream == STREAM_UP:
+            tester = self.speed_tester_u
+            delay = server.speed_tester_u(self._user_id).wait(now)
+            shapers = server.shapers_u
+        else:
+            tester = self.speed_tester_d
+            delay = server.speed_tester_d(self._user_id).wait(now)
+            shapers = server.shapers_d
+        if tester is not None:
+            delay = max(delay, tester.wait(now))
+        if delay > 0:
+            throttle = self._loop.call_later(delay, self._unthrottle, stream)
+        else:
+            user = (server._listen_port, self._user_id)
+            for throttle in shapers:
+                if not throttle.admit(user, now):
+                    throttle.park(self._loop, user, self, stream)
+                    break
+            else:
+                return
+        # smaller reads once limited, so the rate is smoother
+        if stream == STREAM_UP:
+            self._recv_u_max_size = self._tcp_mss - self._overhead
+            self._throttle_u = throttle
+        else:
+            self._recv_d_max_size = self._tcp_mss - self._overhead
+            self._throttle_d = throttle
+        self._update_events()
+
+    def _unthrottle(self, stream):
+        if stream == STREAM_UP:
+            self._throttle_u = None
+        else:
+            self._throttle_d = None
+        if self._stage != STAGE_DESTROYED:
+            self._update_events()
+
+    def _remote_event(self):
+        event = eventloop.POLL_ERR
+        if self._downstream_status & WAIT_STATUS_READING and \
+                self._throttle_d is None:
+            event |= eventloop.POLL_IN
+        if self._upstream_status & WAIT_STATUS_WRITING:
+            event |= eventloop.POLL_OUT
+        return event
 
     def _write_to_sock(self, data, sock):
         # write data to sock
@@ -324,7 +578,6 @@ class TCPRelayHandler(object):
         # and update the stream to wait for writing
         if not sock:
             return False
-        uncomplete = False
         if self._remote_udp and sock == self._remote_sock:
             try:
                 self._udp_data_send_buffer += data
@@ -344,7 +597,7 @@ class TCPRelayHandler(object):
                         continue
                     else:
                         data = data[3:]
-                    header_result = parse_header(data)
+                    header_result = parse_header(data, self._client_address[0])
                     if header_result is None:
                         continue
                     connecttype, addrtype, dest_addr, dest_port, header_length = header_result
@@ -362,84 +615,178 @@ class TCPRelayHandler(object):
                 #trace = traceback.format_exc()
                 #logging.error(trace)
                 error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
-                                errno.EWOULDBLOCK):
-                    uncomplete = True
-                else:
+                if error_no not in (errno.EAGAIN, errno.EINPROGRESS,
+                                    errno.EWOULDBLOCK):
                     shell.print_exception(e)
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                     self.destroy()
                     return False
             return True
+        if sock == self._local_sock:
+            queue = self._data_to_write_to_local
+        elif sock == self._remote_sock:
+            queue = self._data_to_write_to_remote
         else:
-            try:
-                if self._encrypt_correct:
-                    if sock == self._remote_sock:
-                        self._server.add_transfer_u(self._user, len(data))
-                self._update_activity(len(data))
-                if data:
-                    l = len(data)
-                    s = sock.send(data)
-                    if s < l:
-                        data = data[s:]
-                        uncomplete = True
+            logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+            return False
+        self._update_activity()
+        if not data:
+            return
+        # anything still queued goes first
+        queue.append(data)
+        return self._flush_to_sock(queue, sock)
+
+    def _flush_to_sock(self, queue, sock):
+        # write as much of the queued buffers as the socket takes, with a
+        # single sendmsg (writev)
+        sent = 0
+        try:
+            if len(queue) == 1:
+                sent = sock.send(queue[0])
+            elif HAS_SENDMSG:
+                if len(queue) > IOV_MAX:
+                    sent = sock.sendmsg(list(itertools.islice(queue, IOV_MAX)))
                 else:
-                    return
-            except (OSError, IOError) as e:
-                error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
+                    sent = sock.sendmsg(queue)
+            else:
+                data = b''.join(queue)
+                queue.clear()
+                queue.append(data)
+                sent = sock.send(data)
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            if error_no not in (errno.EAGAIN, errno.EINPROGRESS,
                                 errno.EWOULDBLOCK):
-                    uncomplete = True
-                else:
-                    #traceback.print_exc()
-                    shell.print_exception(e)
-                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                    self.destroy()
-                    return False
-            except Exception as e:
+                #traceback.print_exc()
                 shell.print_exception(e)
                 logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                 self.destroy()
                 return False
-        if uncomplete:
-            if sock == self._local_sock:
-                self._data_to_write_to_local.append(data)
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
-            elif sock == self._remote_sock:
-                self._data_to_write_to_remote.append(data)
-                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
-            else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+        except Exception as e:
+            shell.print_exception(e)
+            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+            self.destroy()
+            return False
+        if sent:
+            if self._encrypt_correct and sock == self._remote_sock:
+                self._server.add_transfer_u(self._user, sent)
+            self._update_activity(sent)
+            queue.consume(sent)
+        if sock == self._local_sock:
+            self._update_write_status(STREAM_DOWN, queue)
         else:
-            if sock == self._local_sock:
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
-            elif sock == self._remote_sock:
-                self._update_stream(STREAM_UP, WAIT_STATUS_READING)
-            else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+            self._update_write_status(STREAM_UP, queue)
+        return True
+
+    def _update_write_status(self, stream, queue):
+        # keep reading the other socket while the data waiting for this one
+        # is below the high watermark, once above read again at the low one
+        template = self._template
+        if not queue:
+            status = WAIT_STATUS_READING
+        elif queue.size >= template.write_buffer_high or \
+                WriteBuffer.total >= template.write_buffer_limit > 0:
+            status = WAIT_STATUS_WRITING
+        elif queue.size <= template.write_buffer_low:
+            status = WAIT_STATUS_READWRITING
+        elif stream == STREAM_DOWN:
+            status = self._downstream_status | WAIT_STATUS_WRITING
+        else:
+            status = self._upstream_status | WAIT_STATUS_WRITING
+        self._update_stream(stream, status)
+
+    def _splice_read(self, stream):
+        # move what the socket has to the other one through a pipe, the
+        # bytes never enter userspace
+        # returns False if there was nothing to read, None if splice can not
+        # be used and the data has to be copied
+        if stream == STREAM_UP:
+            sock = self._local_sock
+            pipe = self._pipe_to_remote
+        else:
+            sock = self._remote_sock
+            pipe = self._pipe_to_local
+        if pipe is not None and pipe.size:
+            return self._splice_write(stream)
+        n = 0
+        try:
+            if pipe is None:
+                pipe = SplicePipe()
+                if stream == STREAM_UP:
+                    self._pipe_to_remote = pipe
+                else:
+                    self._pipe_to_local = pipe
+            n = pipe.fill(sock.fileno(), SPLICE_SIZE)
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            if error_no in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            if error_no in (errno.EINVAL, errno.ENOSYS, errno.EMFILE,
+                            errno.ENFILE):
+                logging.debug('splice: %s, copying instead', e)
+                self._splice = False
+                return None
+        if not n:
+            self.destroy()
+            return
+        self._add_read(stream, n)
+        if stream == STREAM_DOWN:
+            if self._latency_mark == latency.CONNECT:
+                self._mark_latency(latency.FIRST_BYTE)
+            if not self._is_local and self._encrypt_correct:
+                self._server.add_transfer_d(self._user, n)
+        return self._splice_write(stream)
+
+    def _splice_write(self, stream):
+        # write as much of the pipe as the socket takes
+        if stream == STREAM_UP:
+            sock = self._remote_sock
+            pipe = self._pipe_to_remote
+        else:
+            sock = self._local_sock
+            pipe = self._pipe_to_local
+        sent = 0
+        try:
+            sent = pipe.drain(sock.fileno())
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            if error_no not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                if error_no not in (errno.ECONNRESET, errno.EPIPE):
+                    shell.print_exception(e)
+                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+                self.destroy()
+                return
+        if sent:
+            if self._encrypt_correct and stream == STREAM_UP:
+                self._server.add_transfer_u(self._user, sent)
+            self._update_activity(sent)
+        if pipe.size:
+            self._update_stream(stream, WAIT_STATUS_WRITING)
+        else:
+            self._update_stream(stream, WAIT_STATUS_READING)
         return True
 
     def _handle_server_dns_resolved(self, error, remote_addr, server_addr, data):
         if error:
             return
         try:
-            addrs = socket.getaddrinfo(server_addr, remote_addr[1], 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs = common.getaddrinfo(server_addr, remote_addr[1], socket.SOCK_DGRAM, socket.SOL_UDP)
             if not addrs: # drop
                 return
             af, socktype, proto, canonname, sa = addrs[0]
             if af == socket.AF_INET6:
                 self._remote_sock_v6.sendto(data, (server_addr, remote_addr[1]))
-                if self._udpv6_send_pack_id == 0:
+                if self._udpv6_send_pack_id == 0 and log.CONNECT:
                     addr, port = self._remote_sock_v6.getsockname()[:2]
-                    common.connect_log('UDPv6 sendto %s(%s):%d from %s:%d by user %d' %
-                        (common.to_str(remote_addr[0]), common.to_str(server_addr), remote_addr[1], addr, port, self._user_id))
+                    common.connect_log('UDPv6 sendto %s(%s):%d from %s:%d by user %d',
+                        common.to_str(remote_addr[0]), common.to_str(server_addr), remote_addr[1], addr, port, self._user_id)
                 self._udpv6_send_pack_id += 1
             else:
                 self._remote_sock.sendto(data, (server_addr, remote_addr[1]))
-                if self._udp_send_pack_id == 0:
+                if self._udp_send_pack_id == 0 and log.CONNECT:
                     addr, port = self._remote_sock.getsockname()[:2]
-                    common.connect_log('UDP sendto %s(%s):%d from %s:%d by user %d' %
-                        (common.to_str(remote_addr[0]), common.to_str(server_addr), remote_addr[1], addr, port, self._user_id))
+                    common.connect_log('UDP sendto %s(%s):%d from %s:%d by user %d',
+                        common.to_str(remote_addr[0]), common.to_str(server_addr), remote_addr[1], addr, port, self._user_id)
                 self._udp_send_pack_id += 1
             return True
         except Exception as e:
@@ -447,7 +794,7 @@ class TCPRelayHandler(object):
             logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
 
     def _get_redirect_host(self, client_address, ogn_data):
-        host_list = self._redir_list or ["*#0.0.0.0:0"]
+        host_list = self._template.redir_list or ["*#0.0.0.0:0"]
 
         if type(host_list) != list:
             host_list = [host_list]
@@ -455,7 +802,7 @@ class TCPRelayHandler(object):
         items_sum = common.to_str(host_list[0]).rsplit('#', 1)
         if len(items_sum) < 2:
             hash_code = binascii.crc32(ogn_data)
-            addrs = socket.getaddrinfo(client_address[0], client_address[1], 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            addrs = common.getaddrinfo(client_address[0], client_address[1], socket.SOCK_STREAM, socket.SOL_TCP)
             af, socktype, proto, canonname, sa = addrs[0]
             address_bytes = common.inet_pton(af, sa[0])
             if af == socket.AF_INET6:
@@ -518,7 +865,9 @@ class TCPRelayHandler(object):
             return ("0.0.0.0", 0)
 
     def _handel_protocol_error(self, client_address, ogn_data):
-        logging.warn("Protocol ERROR, TCP ogn data %s from %s:%d via port %d by UID %d" % (binascii.hexlify(ogn_data), client_address[0], client_address[1], self._server._listen_port, self._user_id))
+        port = self._server._listen_port
+        log.protocol_errors.add(port, client_address[0])
+        log.limited(client_address[0], logging.WARN, "Protocol ERROR, TCP ogn data %s from %s:%d via port %d by UID %d", log.Hex(ogn_data), client_address[0], client_address[1], port, self._user_id)
         self._encrypt_correct = False
         #create redirect or disconnect by hash code
         host, port = self._get_redirect_host(client_address, ogn_data)
@@ -526,7 +875,9 @@ class TCPRelayHandler(object):
             raise Exception('can not parse header')
         data = b"\x03" + common.to_bytes(common.chr(len(host))) + common.to_bytes(host) + struct.pack('>H', port)
         self._is_redirect = True
-        logging.warn("TCP data redir %s:%d %s" % (host, port, binascii.hexlify(data)))
+        # the redirected bytes are relayed untouched
+        self._splice = self._template.splice
+        log.limited(client_address[0], logging.WARN, "TCP data redir %s:%d %s", host, port, log.Hex(data))
         return data + ogn_data
 
     def _handle_stage_connecting(self, data):
@@ -537,6 +888,9 @@ class TCPRelayHandler(object):
                 data = self._obfs.client_encode(data)
         if data:
             self._data_to_write_to_remote.append(data)
+            if self._data_to_write_to_remote.size >= self._template.write_buffer_high:
+                # not connected yet, stop reading until it is
+                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
         if self._is_local and not self._fastopen_connected and \
                 self._config['fast_open']:
             # for sslocal and fastopen, we basically wait for data and use
@@ -548,14 +902,13 @@ class TCPRelayHandler(object):
                     self._create_remote_socket(self._chosen_server[0],
                                                self._chosen_server[1])
                 self._loop.add(remote_sock, eventloop.POLL_ERR, self._server)
+                self._set_stage(STAGE_CONNECTING)
                 data = b''.join(self._data_to_write_to_remote)
                 l = len(data)
                 s = remote_sock.sendto(data, MSG_FASTOPEN, self._chosen_server)
+                self._data_to_write_to_remote.clear()
                 if s < l:
-                    data = data[s:]
-                    self._data_to_write_to_remote = [data]
-                else:
-                    self._data_to_write_to_remote = []
+                    self._data_to_write_to_remote.append(data[s:])
                 self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
             except (OSError, IOError) as e:
                 if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
@@ -600,7 +953,7 @@ class TCPRelayHandler(object):
                     port_to_send = struct.pack('>H', port)
                     self._write_to_sock(header + addr_to_send + port_to_send,
                                         self._local_sock)
-                    self._stage = STAGE_UDP_ASSOC
+                    self._set_stage(STAGE_UDP_ASSOC)
                     # just wait for the client to disconnect
                     return
                 elif cmd == CMD_CONNECT:
@@ -613,12 +966,12 @@ class TCPRelayHandler(object):
 
             before_parse_data = data
             if self._is_local:
-                header_result = parse_header(data)
+                header_result = parse_header(data, self._client_address[0])
             else:
                 data = pre_parse_header(data)
                 if data is None:
                     data = self._handel_protocol_error(self._client_address, ogn_data)
-                header_result = parse_header(data)
+                header_result = parse_header(data, self._client_address[0])
                 if header_result is not None:
                     try:
                         common.to_str(header_result[2])
@@ -626,7 +979,7 @@ class TCPRelayHandler(object):
                         header_result = None
                 if header_result is None:
                     data = self._handel_protocol_error(self._client_address, ogn_data)
-                    header_result = parse_header(data)
+                    header_result = parse_header(data, self._client_address[0])
                 self._overhead = self._obfs.get_overhead(self._is_local) + self._protocol.get_overhead(self._is_local)
                 self._recv_buffer_size = BUF_SIZE - self._overhead
                 server_info = self._obfs.get_server_info()
@@ -638,14 +991,15 @@ class TCPRelayHandler(object):
                 pass
                 #common.connect_log('UDP over TCP by user %d' %
                 #        (self._user_id, ))
-            else:
-                common.connect_log('TCP request %s:%d by user %d' %
-                        (common.to_str(remote_addr), remote_port, self._user_id))
+            elif log.CONNECT:
+                common.connect_log('TCP request %s:%d by user %d',
+                        common.to_str(remote_addr), remote_port, self._user_id)
             self._remote_address = (common.to_str(remote_addr), remote_port)
             self._remote_udp = (connecttype != 0)
+            self._mark_latency(latency.HEADER)
             # pause reading
             self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
-            self._stage = STAGE_DNS
+            self._set_stage(STAGE_DNS)
             if self._is_local:
                 # forward address to remote
                 self._write_to_sock((b'\x05\x00\x00\x01'
@@ -677,52 +1031,61 @@ class TCPRelayHandler(object):
 
     def _socket_bind_addr(self, sock, af):
         bind_addr = ''
-        if self._bind and af == socket.AF_INET:
-            bind_addr = self._bind
-        elif self._bindv6 and af == socket.AF_INET6:
-            bind_addr = self._bindv6
+        template = self._template
+        if template.bind and af == socket.AF_INET:
+            bind_addr = template.bind
+        elif template.bindv6 and af == socket.AF_INET6:
+            bind_addr = template.bindv6
         else:
             bind_addr = self._accept_address[0]
 
         bind_addr = bind_addr.replace("::ffff:", "")
-        if bind_addr in self._ignore_bind_list:
+        if bind_addr in template.ignore_bind_list:
             bind_addr = None
         if bind_addr:
-            local_addrs = socket.getaddrinfo(bind_addr, 0, 0, socket.SOCK_STREAM, socket.SOL_TCP)
-            if local_addrs[0][0] == af:
-                logging.debug("bind %s" % (bind_addr,))
+            bind_af = template.bind_families.get(bind_addr, None)
+            if bind_af is None:
+                bind_af = common.getaddrinfo(bind_addr, 0, socket.SOCK_STREAM, socket.SOL_TCP)[0][0]
+                template.bind_families[bind_addr] = bind_af
+            if bind_af == af:
+                if log.DEBUG:
+                    logging.debug("bind %s", bind_addr)
                 try:
                     sock.bind((bind_addr, 0))
                 except Exception as e:
                     logging.warn("bind %s fail" % (bind_addr,))
 
-    def _create_remote_socket(self, ip, port):
+    def _create_remote_socket(self, ip, port, race=False):
         if self._remote_udp:
-            addrs_v6 = socket.getaddrinfo("::", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
-            addrs = socket.getaddrinfo("0.0.0.0", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs_v6 = common.getaddrinfo("::", 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs = common.getaddrinfo("0.0.0.0", 0, socket.SOCK_DGRAM, socket.SOL_UDP)
         else:
-            addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            addrs = common.getaddrinfo(ip, port, socket.SOCK_STREAM, socket.SOL_TCP)
         if len(addrs) == 0:
             raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
         af, socktype, proto, canonname, sa = addrs[0]
         if not self._remote_udp and not self._is_redirect:
-            if self._forbidden_iplist:
-                if common.to_str(sa[0]) in self._forbidden_iplist:
+            if self._template.forbidden_iplist:
+                if common.to_str(sa[0]) in self._template.forbidden_iplist:
                     if self._remote_address:
                         raise Exception('IP %s is in forbidden list, when connect to %s:%d via port %d by UID %d' %
                             (common.to_str(sa[0]), self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
                     raise Exception('IP %s is in forbidden list, reject' %
                                     common.to_str(sa[0]))
-            if self._forbidden_portset:
-                if sa[1] in self._forbidden_portset:
+            if self._template.forbidden_portset:
+                if sa[1] in self._template.forbidden_portset:
                     if self._remote_address:
                         raise Exception('Port %d is in forbidden list, when connect to %s:%d via port %d by UID %d' %
                             (sa[1], self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
                     raise Exception('Port %d is in forbidden list, reject' % sa[1])
         remote_sock = socket.socket(af, socktype, proto)
-        self._remote_sock = remote_sock
-        self._remote_sock_fd = remote_sock.fileno()
-        self._fd_to_handlers[self._remote_sock_fd] = self
+        if race:
+            self._remote_sock_race = remote_sock
+            self._remote_sock_race_fd = remote_sock.fileno()
+        else:
+            self._remote_sock = remote_sock
+            self._remote_sock_fd = remote_sock.fileno()
+        self._fd_to_handlers[remote_sock.fileno()] = self
 
         if self._remote_udp:
             af, socktype, proto, canonname, sa = addrs_v6[0]
@@ -744,6 +1107,82 @@ class TCPRelayHandler(object):
                 self._socket_bind_addr(remote_sock, af)
         return remote_sock
 
+    def _connect_remote(self, remote_sock, remote_addr, remote_port,
+                        fast_open=False):
+        if fast_open:
+            try:
+                remote_sock.setsockopt(socket.SOL_TCP, TCP_FASTOPEN_CONNECT, 1)
+            except socket.error:
+                logging.error('warning: fast open is not available')
+                self._template.remote_fast_open = False
+        self._loop.add(remote_sock,
+                       eventloop.POLL_ERR | eventloop.POLL_OUT,
+                       self._server)
+        try:
+            remote_sock.connect((remote_addr, remote_port))
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in (errno.EINPROGRESS,
+                    errno.EWOULDBLOCK):
+                pass # always goto here
+            else:
+                raise e
+        if log.CONNECT:
+            addr, port = remote_sock.getsockname()[:2]
+            common.connect_log('TCP connecting %s(%s):%d from %s:%d by user %d',
+                common.to_str(self._remote_address[0]), common.to_str(remote_addr), remote_port, addr, port, self._user_id)
+
+    def _close_remote_sock(self, sock, fd):
+        # close a remote socket that lost the connect race
+        try:
+            self._loop.removefd(fd)
+        except Exception as e:
+            shell.print_exception(e)
+        if fd in self._fd_to_handlers:
+            del self._fd_to_handlers[fd]
+        sock.close()
+
+    def _start_race(self):
+        # the IPv6 connect is taking long, connect to IPv4 as well
+        self._race_timer = None
+        if self._stage != STAGE_CONNECTING or self._remote_sock_race:
+            return
+        hostname, remote_port = self._race_target
+        ipv4 = self._dns_resolver.ipv4_address(hostname)
+        if not ipv4:
+            return
+        try:
+            remote_sock = self._create_remote_socket(ipv4, remote_port, True)
+            self._connect_remote(remote_sock, ipv4, remote_port)
+        except Exception as e:
+            logging.debug('connect to %s: %s', ipv4, e)
+            self._end_race()
+
+    def _end_race(self):
+        if self._race_timer is not None:
+            self._loop.cancel(self._race_timer)
+            self._race_timer = None
+        if self._remote_sock_race:
+            self._close_remote_sock(self._remote_sock_race,
+                                    self._remote_sock_race_fd)
+            self._remote_sock_race = None
+            self._remote_sock_race_fd = None
+
+    def _promote_race(self):
+        # the IPv4 socket takes the place of the IPv6 one
+        if self._race_timer is not None:
+            self._loop.cancel(self._race_timer)
+            self._race_timer = None
+            self._start_race()
+        if not self._remote_sock_race:
+            return False
+        self._close_remote_sock(self._remote_sock, self._remote_sock_fd)
+        self._remote_sock = self._remote_sock_race
+        self._remote_sock_fd = self._remote_sock_race_fd
+        self._remote_sock_race = None
+        self._remote_sock_race_fd = None
+        self._loop.modify(self._remote_sock, self._remote_event())
+        return True
+
     def _handle_dns_resolved(self, result, error):
         if error:
             self._log_error(error)
@@ -752,8 +1191,9 @@ class TCPRelayHandler(object):
         if result:
             ip = result[1]
             if ip:
+                self._mark_latency(latency.DNS)
                 try:
-                    self._stage = STAGE_CONNECTING
+                    self._set_stage(STAGE_CONNECTING)
                     remote_addr = ip
                     if self._is_local:
                         remote_port = self._chosen_server[1]
@@ -781,28 +1221,41 @@ class TCPRelayHandler(object):
                                         eventloop.POLL_IN,
                                         self._server)
                         else:
+                            race = self._template.happy_eyeballs and \
+                                common.is_ip(remote_addr) == socket.AF_INET6 and \
+                                not common.is_ip(result[0])
+                            # the request waiting to be sent rides the SYN,
+                            # not when racing as the connect is reported done
+                            # before the SYN is sent
+                            fast_open = self._template.remote_fast_open and \
+                                not self._is_local and not race and \
+                                bool(self._data_to_write_to_remote)
                             try:
-                                remote_sock.connect((remote_addr, remote_port))
+                                self._connect_remote(remote_sock, remote_addr,
+                                                     remote_port, fast_open)
                             except (OSError, IOError) as e:
-                                if eventloop.errno_from_exception(e) in (errno.EINPROGRESS,
-                                        errno.EWOULDBLOCK):
-                                    pass # always goto here
-                                else:
+                                # no route to the IPv6 address, go on with IPv4 at once
+                                ipv4 = race and self._dns_resolver.ipv4_address(result[0])
+                                if not ipv4:
                                     raise e
-                            addr, port = self._remote_sock.getsockname()[:2]
-                            common.connect_log('TCP connecting %s(%s):%d from %s:%d by user %d' %
-                                (common.to_str(self._remote_address[0]), common.to_str(remote_addr), remote_port, addr, port, self._user_id))
-
-                            self._loop.add(remote_sock,
-                                       eventloop.POLL_ERR | eventloop.POLL_OUT,
-                                       self._server)
+                                logging.debug('connect to %s: %s, trying %s',
+                                              common.to_str(remote_addr), e, ipv4)
+                                self._close_remote_sock(remote_sock, self._remote_sock_fd)
+                                remote_addr = ipv4
+                                race = False
+                                remote_sock = self._create_remote_socket(remote_addr,
+                                                                         remote_port)
+                                self._connect_remote(remote_sock, remote_addr, remote_port)
+                            if race:
+                                self._race_target = (result[0], remote_port)
+                                self._race_timer = self._loop.call_later(
+                                    CONNECT_ATTEMPT_DELAY, self._start_race)
                         self._stage = STAGE_CONNECTING
                         self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
                         self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
                         if self._remote_udp:
                             while self._data_to_write_to_remote:
-                                data = self._data_to_write_to_remote[0]
-                                del self._data_to_write_to_remote[0]
+                                data = self._data_to_write_to_remote.popleft()
                                 self._write_to_sock(data, self._remote_sock)
                     return
                 except Exception as e:
@@ -812,31 +1265,46 @@ class TCPRelayHandler(object):
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
         self.destroy()
 
-    def _get_read_size(self, sock, recv_buffer_size, up):
+    def _get_read_size(self, recv_buffer_size, up):
         if self._overhead == 0:
             return recv_buffer_size
-        buffer_size = len(sock.recv(recv_buffer_size, socket.MSG_PEEK))
         frame_size = self._tcp_mss - self._overhead
         if up:
-            buffer_size = min(buffer_size, self._recv_u_max_size)
+            buffer_size = min(recv_buffer_size, self._recv_u_max_size)
             self._recv_u_max_size = min(self._recv_u_max_size + frame_size, BUF_SIZE)
         else:
-            buffer_size = min(buffer_size, self._recv_d_max_size)
+            buffer_size = min(recv_buffer_size, self._recv_d_max_size)
             self._recv_d_max_size = min(self._recv_d_max_size + frame_size, BUF_SIZE)
-        if buffer_size == recv_buffer_size:
-            return buffer_size
-        if buffer_size > frame_size:
-            buffer_size = int(buffer_size / frame_size) * frame_size
         return buffer_size
 
+    def _split_frames(self, data, buffer_size):
+        # a short read is cut down to whole frames for the protocol, the
+        # rest goes in a short frame of its own at once. it used to be left
+        # in the socket by a recv with MSG_PEEK before every read, and went
+        # out with whatever had arrived by the next read
+        if self._overhead == 0 or buffer_size is None or \
+                len(data) == buffer_size:
+            return (data,)
+        frame_size = self._tcp_mss - self._overhead
+        size = len(data) // frame_size * frame_size
+        if size == 0 or size == len(data):
+            return (data,)
+        return (data[:size], data[size:])
+
     def _on_local_read(self):
         # handle all local read events and dispatch them to methods for
         # each stage
+        # returns False if there was nothing to read
         if not self._local_sock:
             return
+        if self._splice and self._stage == STAGE_STREAM and \
+                not self._data_to_write_to_remote:
+            result = self._splice_read(STREAM_UP)
+            if self._splice:
+                return result
         is_local = self._is_local
         if is_local:
-            recv_buffer_size = self._get_read_size(self._local_sock, self._recv_buffer_size, True)
+            recv_buffer_size = self._get_read_size(self._recv_buffer_size, True)
         else:
             recv_buffer_size = BUF_SIZE
         data = None
@@ -845,13 +1313,12 @@ class TCPRelayHandler(object):
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-                return
+                return False
         if not data:
             self.destroy()
             return
 
-        self.speed_tester_u.add(len(data))
-        self._server.speed_tester_u(self._user_id).add(len(data))
+        self._add_read(STREAM_UP, len(data))
         ogn_data = data
         if not is_local:
             if self._encryptor is not None:
@@ -912,14 +1379,17 @@ class TCPRelayHandler(object):
         if self._stage == STAGE_STREAM:
             if self._is_local:
                 if self._encryptor is not None:
-                    data = self._protocol.client_pre_encrypt(data)
-                    data = self._encryptor.encrypt(data)
-                    data = self._obfs.client_encode(data)
+                    frames = self._split_frames(data, recv_buffer_size)
+                    data = b''
+                    for frame in frames:
+                        frame = self._protocol.client_pre_encrypt(frame)
+                        frame = self._encryptor.encrypt(frame)
+                        data += self._obfs.client_encode(frame)
             self._write_to_sock(data, self._remote_sock)
         elif is_local and self._stage == STAGE_INIT:
             # TODO check auth method
             self._write_to_sock(b'\x05\00', self._local_sock)
-            self._stage = STAGE_ADDR
+            self._set_stage(STAGE_ADDR)
         elif self._stage == STAGE_CONNECTING:
             self._handle_stage_connecting(data)
         elif (is_local and self._stage == STAGE_ADDR) or \
@@ -928,7 +1398,14 @@ class TCPRelayHandler(object):
 
     def _on_remote_read(self, is_remote_sock):
         # handle all remote read events
+        # returns False if there was nothing to read
+        if self._splice and self._stage == STAGE_STREAM and \
+                not self._remote_udp and not self._data_to_write_to_local:
+            result = self._splice_read(STREAM_DOWN)
+            if self._splice:
+                return result
         data = None
+        recv_buffer_size = None
         try:
             if self._remote_udp:
                 if is_remote_sock:
@@ -949,19 +1426,20 @@ class TCPRelayHandler(object):
                 if self._is_local:
                     recv_buffer_size = BUF_SIZE
                 else:
-                    recv_buffer_size = self._get_read_size(self._remote_sock, self._recv_buffer_size, False)
+                    recv_buffer_size = self._get_read_size(self._recv_buffer_size, False)
                 data = self._remote_sock.recv(recv_buffer_size)
                 self._recv_pack_id += 1
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK, 10035): #errno.WSAEWOULDBLOCK
-                return
+                return False
         if not data:
             self.destroy()
             return
+        if self._latency_mark == latency.CONNECT:
+            self._mark_latency(latency.FIRST_BYTE)
 
-        self.speed_tester_d.add(len(data))
-        self._server.speed_tester_d(self._user_id).add(len(data))
+        self._add_read(STREAM_DOWN, len(data))
         if self._encryptor is not None:
             if self._is_local:
                 try:
@@ -989,9 +1467,12 @@ class TCPRelayHandler(object):
                     return
             else:
                 if self._encrypt_correct:
-                    data = self._protocol.server_pre_encrypt(data)
-                    data = self._encryptor.encrypt(data)
-                    data = self._obfs.server_encode(data)
+                    frames = self._split_frames(data, recv_buffer_size)
+                    data = b''
+                    for frame in frames:
+                        frame = self._protocol.server_pre_encrypt(frame)
+                        frame = self._encryptor.encrypt(frame)
+                        data += self._obfs.server_encode(frame)
                     self._server.add_transfer_d(self._user, len(data))
                 self._update_activity(len(data))
         else:
@@ -1007,20 +1488,25 @@ class TCPRelayHandler(object):
 
     def _on_local_write(self):
         # handle local writable event
-        if self._data_to_write_to_local:
-            data = b''.join(self._data_to_write_to_local)
-            self._data_to_write_to_local = []
-            self._write_to_sock(data, self._local_sock)
+        if self._pipe_to_local is not None and self._pipe_to_local.size:
+            self._splice_write(STREAM_DOWN)
+        elif self._data_to_write_to_local:
+            self._flush_to_sock(self._data_to_write_to_local, self._local_sock)
         else:
             self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
 
     def _on_remote_write(self):
         # handle remote writable event
-        self._stage = STAGE_STREAM
-        if self._data_to_write_to_remote:
-            data = b''.join(self._data_to_write_to_remote)
-            self._data_to_write_to_remote = []
-            self._write_to_sock(data, self._remote_sock)
+        if self._stage == STAGE_CONNECTING:
+            self._mark_latency(latency.CONNECT)
+            if self._race_target:
+                self._end_race()
+        if self._stage != STAGE_STREAM:
+            self._set_stage(STAGE_STREAM)
+        if self._pipe_to_remote is not None and self._pipe_to_remote.size:
+            self._splice_write(STREAM_UP)
+        elif self._data_to_write_to_remote:
+            self._flush_to_sock(self._data_to_write_to_remote, self._remote_sock)
         else:
             self._update_stream(STREAM_UP, WAIT_STATUS_READING)
 
@@ -1033,6 +1519,10 @@ class TCPRelayHandler(object):
         self.destroy()
 
     def _on_remote_error(self):
+        if self._stage == STAGE_CONNECTING and self._race_target and \
+                self._promote_race():
+            logging.debug('connect to IPv6 failed, going on with IPv4')
+            return
         if self._remote_sock:
             err = eventloop.get_sock_error(self._remote_sock)
             if err.errno not in [errno.ECONNRESET]:
@@ -1047,7 +1537,8 @@ class TCPRelayHandler(object):
         # handle all events in this handler and dispatch them to methods
         handle = False
         if self._stage == STAGE_DESTROYED:
-            logging.debug('ignore handle_event: destroyed')
+            if log.DEBUG:
+                logging.debug('ignore handle_event: destroyed')
             return True
         if self._user is not None and self._user not in self._server.server_users:
             self.destroy()
@@ -1056,28 +1547,42 @@ class TCPRelayHandler(object):
             if event & eventloop.POLL_ERR:
                 handle = True
                 self._on_remote_error()
-            elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_d.isExceed() and not self._server.speed_tester_d(self._user_id).isExceed():
+            else:
+                # a throttled socket may still be in the events of this
+                # poll, it is read once it is polled again
+                if event & (eventloop.POLL_IN | eventloop.POLL_HUP) and \
+                        (self._throttle_d is None or
+                         event & eventloop.POLL_HUP):
+                    handle = self._on_remote_read(sock == self._remote_sock) is not False
+                    if handle:
+                        self._throttle(STREAM_DOWN)
+                # an edge triggered loop reports both at once and won't
+                # report POLL_OUT again
+                if event & eventloop.POLL_OUT and self._stage != STAGE_DESTROYED:
                     handle = True
-                    self._on_remote_read(sock == self._remote_sock)
-                else:
-                    self._recv_d_max_size = self._tcp_mss - self._overhead
-            elif event & eventloop.POLL_OUT:
-                handle = True
-                self._on_remote_write()
+                    self._on_remote_write()
         elif fd == self._local_sock_fd:
             if event & eventloop.POLL_ERR:
                 handle = True
                 self._on_local_error()
-            elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_u.isExceed() and not self._server.speed_tester_u(self._user_id).isExceed():
+            else:
+                if event & (eventloop.POLL_IN | eventloop.POLL_HUP) and \
+                        (self._throttle_u is None or
+                         event & eventloop.POLL_HUP):
+                    handle = self._on_local_read() is not False
+                    if handle:
+                        self._throttle(STREAM_UP)
+                if event & eventloop.POLL_OUT and self._stage != STAGE_DESTROYED:
                     handle = True
-                    self._on_local_read()
-                else:
-                    self._recv_u_max_size = self._tcp_mss - self._overhead
+                    self._on_local_write()
+        elif fd == self._remote_sock_race_fd:
+            handle = True
+            if event & eventloop.POLL_ERR:
+                self._end_race()
             elif event & eventloop.POLL_OUT:
-                handle = True
-                self._on_local_write()
+                # the IPv4 connect is done first
+                self._promote_race()
+                self._on_remote_write()
         else:
             logging.warn('unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
             try:
@@ -1093,8 +1598,9 @@ class TCPRelayHandler(object):
         return handle
 
     def _log_error(self, e):
-        logging.error('%s when handling connection from %s:%d' %
-                      (e, self._client_address[0], self._client_address[1]))
+        log.limited(self._client_address[0], logging.ERROR,
+                    '%s when handling connection from %s:%d',
+                    e, self._client_address[0], self._client_address[1])
 
     def stage(self):
         return self._stage
@@ -1112,13 +1618,26 @@ class TCPRelayHandler(object):
             logging.debug('already destroyed')
             return
         self._stage = STAGE_DESTROYED
-        if self._remote_address:
-            logging.debug('destroy: %s:%d' %
-                          self._remote_address)
-        else:
-            logging.debug('destroy')
+        self._server.latency.record(latency.LIFETIME,
+                                    eventloop.monotonic() - self._accept_time)
+        if self._race_target:
+            self._end_race()
+        for stream, throttle in ((STREAM_UP, self._throttle_u),
+                                 (STREAM_DOWN, self._throttle_d)):
+            if isinstance(throttle, shaper.Shaper):
+                throttle.unpark((self._server._listen_port, self._user_id),
+                                self, stream)
+            elif throttle is not None:
+                self._loop.cancel(throttle)
+        self._throttle_u = self._throttle_d = None
+        if log.DEBUG:
+            if self._remote_address:
+                logging.debug('destroy: %s:%d', *self._remote_address)
+            else:
+                logging.debug('destroy')
         if self._remote_sock:
-            logging.debug('destroying remote')
+            if log.DEBUG:
+                logging.debug('destroying remote')
             try:
                 self._loop.removefd(self._remote_sock_fd)
             except Exception as e:
@@ -1131,7 +1650,8 @@ class TCPRelayHandler(object):
             self._remote_sock.close()
             self._remote_sock = None
         if self._remote_sock_v6:
-            logging.debug('destroying remote_v6')
+            if log.DEBUG:
+                logging.debug('destroying remote_v6')
             try:
                 self._loop.removefd(self._remotev6_sock_fd)
             except Exception as e:
@@ -1144,7 +1664,8 @@ class TCPRelayHandler(object):
             self._remote_sock_v6.close()
             self._remote_sock_v6 = None
         if self._local_sock:
-            logging.debug('destroying local')
+            if log.DEBUG:
+                logging.debug('destroying local')
             try:
                 self._loop.removefd(self._local_sock_fd)
             except Exception as e:
@@ -1163,6 +1684,14 @@ class TCPRelayHandler(object):
             self._protocol.dispose()
             self._protocol = None
         self._encryptor = None
+        self._data_to_write_to_local.clear()
+        self._data_to_write_to_remote.clear()
+        if self._pipe_to_local is not None:
+            self._pipe_to_local.close()
+            self._pipe_to_local = None
+        if self._pipe_to_remote is not None:
+            self._pipe_to_remote.close()
+            self._pipe_to_remote = None
         self._dns_resolver.remove_callback(self._handle_dns_resolved)
         self._server.remove_handler(self)
         if self._add_ref > 0:
@@ -1170,32 +1699,72 @@ class TCPRelayHandler(object):
             self._server.stat_add(self._client_address[0], -1)
 
 class TCPRelay(object):
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None, transfer_table=None):
         self._config = config
         self._is_local = is_local
         self._dns_resolver = dns_resolver
         self._closed = False
         self._eventloop = None
+        self._sweeper = None
         self._fd_to_handlers = {}
         self.server_transfer_ul = 0
         self.server_transfer_dl = 0
         self.server_users = {}
         self.server_users_cfg = {}
-        self.server_user_transfer_ul = {}
-        self.server_user_transfer_dl = {}
+        if transfer_table is None:
+            transfer_table = TransferTable()
+        self._transfer_table = transfer_table
+        self._transfer_slots = {}  # user -> slot in the transfer table
+        # how long the connections of this port take in each stage
+        self.latency = latency.ConnectionLatency()
         self.mu = False
         self._speed_tester_u = {}
         self._speed_tester_d = {}
+        # the shapers the connections of the port read under, with a limit
+        self._port_shaper_u = shaper.Shaper(config.get('speed_limit_per_port', 0))
+        self._port_shaper_d = shaper.Shaper(config.get('speed_limit_per_port', 0))
+        self.shapers_u = ()
+        self.shapers_d = ()
+        if self._port_shaper_u.max_speed > 0:
+            self.shapers_u = (self._port_shaper_u,)
+            self.shapers_d = (self._port_shaper_d,)
+        # the workers share the node evenly
+        node_speed = config.get('speed_limit_per_node', 0)
+        if node_speed > 0:
+            node_speed /= max(int(config.get('workers', 1)), 1)
+            shaper.node_up.update_limit(node_speed)
+            shaper.node_down.update_limit(node_speed)
+            self.shapers_u += (shaper.node_up,)
+            self.shapers_d += (shaper.node_down,)
         self.server_connections = 0
         self.protocol_data = obfs.obfs(config['protocol']).init_data()
         self.obfs_data = obfs.obfs(config['obfs']).init_data()
+        self.template = ConnectionTemplate(config)
 
         if config.get('connect_verbose_info', 0) > 0:
             common.connect_log = logging.info
+            log.connect_verbose = True
+            log.update()
 
         self._timeout = config['timeout']
-        self._timeout_cache = lru_cache.LRUCache(timeout=self._timeout,
-                                         close_callback=self._close_tcp_client)
+        # the timeout of a connection depends on its stage
+        timeouts = [min(config.get(name, default), self._timeout)
+                    for name, default in (
+                        ('handshake_timeout', HANDSHAKE_TIMEOUT),
+                        ('dns_timeout', DNS_TIMEOUT),
+                        ('connect_timeout', CONNECT_TIMEOUT))]
+        self._stage_timeouts = {
+            STAGE_INIT: timeouts[0],
+            STAGE_ADDR: timeouts[0],
+            STAGE_UDP_ASSOC: self._timeout,
+            STAGE_DNS: timeouts[1],
+            STAGE_CONNECTING: timeouts[2],
+            STAGE_STREAM: self._timeout,
+            STAGE_DESTROYED: 0,
+        }
+        self._timeout_wheel = lru_cache.ActivityWheel(
+            timeout=min(timeouts), close_callback=self._close_tcp_client,
+            timeout_of=self._handler_timeout)
 
         if is_local:
             listen_addr = config['local_address']
@@ -1216,6 +1785,9 @@ class TCPRelay(object):
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if config.get('reuse_port', False):
+            # every worker listens on its own socket
+            server_socket.setsockopt(socket.SOL_SOCKET, common.SO_REUSEPORT, 1)
         server_socket.bind(sa)
         server_socket.setblocking(False)
         if config['fast_open']:
@@ -1229,6 +1801,8 @@ class TCPRelay(object):
         self._server_socket_fd = server_socket.fileno()
         self._stat_counter = stat_counter
         self._stat_callback = stat_callback
+        self._accept_batch = max(config.get('accept_batch', ACCEPT_BATCH), 1)
+        self._accept_backoff = False
 
     def add_to_loop(self, loop):
         if self._eventloop:
@@ -1237,22 +1811,29 @@ class TCPRelay(object):
             raise Exception('already closed')
         self._eventloop = loop
         self._eventloop.add(self._server_socket,
-                            eventloop.POLL_IN | eventloop.POLL_ERR, self)
-        self._eventloop.add_periodic(self.handle_periodic)
+                            eventloop.POLL_IN | eventloop.POLL_ERR, self,
+                            exclusive=True)
+        self._sweeper = lru_cache.Sweeper(loop, self._timeout_wheel)
+
+    def add_handler(self, client):
+        self._timeout_wheel.add(client)
 
     def remove_handler(self, client):
-        if hash(client) in self._timeout_cache:
-            del self._timeout_cache[hash(client)]
+        self._timeout_wheel.remove(client)
+
+    def _handler_timeout(self, client):
+        stage = client._stage
+        if stage == STAGE_CONNECTING and self._is_local and \
+                not client._fastopen_connected and self._config['fast_open']:
+            # sslocal with fast_open waits for the client to send something
+            # before it connects, the connect timeout starts then
+            return self._timeout
+        return self._stage_timeouts[stage]
 
     def add_connection(self, val):
         self.server_connections += val
-        logging.debug('server port %5d connections = %d' % (self._listen_port, self.server_connections,))
-
-    def get_ud(self):
-        return (self.server_transfer_ul, self.server_transfer_dl)
-
-    def get_users_ud(self):
-        return (self.server_user_transfer_ul.copy(), self.server_user_transfer_dl.copy())
+        if log.DEBUG:
+            logging.debug('server port %5d connections = %d', self._listen_port, self.server_connections)
 
     def _update_users(self, protocol_param, acl):
         if protocol_param is None:
@@ -1294,11 +1875,11 @@ class TCPRelay(object):
         if uid in self._speed_tester_u:
             self._speed_tester_u[uid].update_limit(speed)
         else:
-            self._speed_tester_u[uid] = SpeedTester(speed)
+            self._speed_tester_u[uid] = shaper.SpeedTester(speed)
         if uid in self._speed_tester_d:
             self._speed_tester_d[uid].update_limit(speed)
         else:
-            self._speed_tester_d[uid] = SpeedTester(speed)
+            self._speed_tester_d[uid] = shaper.SpeedTester(speed)
 
     def del_user(self, uid):
         if uid in self.server_users:
@@ -1306,38 +1887,51 @@ class TCPRelay(object):
         if uid in self.server_users_cfg:
             del self.server_users_cfg[uid]
 
+    def _transfer_slot(self, user):
+        slot = self._transfer_slots.get(user)
+        if slot is None:
+            if user is None:
+                slot = self._transfer_table.slot(self._listen_port)
+            else:
+                slot = self._transfer_table.slot(struct.unpack('<I', user)[0])
+            self._transfer_slots[user] = slot
+        return slot
+
     def add_transfer_u(self, user, transfer):
         if user is None:
-            self.server_transfer_ul += transfer
+            if self.mu:
+                # counted for the next user seen on this port
+                self.server_transfer_ul += transfer
+                return
         else:
-            if user not in self.server_user_transfer_ul:
-                self.server_user_transfer_ul[user] = 0
-            self.server_user_transfer_ul[user] += transfer + self.server_transfer_ul
+            transfer += self.server_transfer_ul
             self.server_transfer_ul = 0
+        self._transfer_table.add_u(self._transfer_slot(user), transfer)
 
     def add_transfer_d(self, user, transfer):
         if user is None:
-            self.server_transfer_dl += transfer
+            if self.mu:
+                self.server_transfer_dl += transfer
+                return
         else:
-            if user not in self.server_user_transfer_dl:
-                self.server_user_transfer_dl[user] = 0
-            self.server_user_transfer_dl[user] += transfer + self.server_transfer_dl
+            transfer += self.server_transfer_dl
             self.server_transfer_dl = 0
+        self._transfer_table.add_d(self._transfer_slot(user), transfer)
 
     def speed_tester_u(self, uid):
         if uid not in self._speed_tester_u:
             if self.mu: #TODO
-                self._speed_tester_u[uid] = SpeedTester(self._config.get("speed_limit_per_user", 0))
+                self._speed_tester_u[uid] = shaper.SpeedTester(self._config.get("speed_limit_per_user", 0))
             else:
-                self._speed_tester_u[uid] = SpeedTester(self._config.get("speed_limit_per_user", 0))
+                self._speed_tester_u[uid] = shaper.SpeedTester(self._config.get("speed_limit_per_user", 0))
         return self._speed_tester_u[uid]
 
     def speed_tester_d(self, uid):
         if uid not in self._speed_tester_d:
             if self.mu: #TODO
-                self._speed_tester_d[uid] = SpeedTester(self._config.get("speed_limit_per_user", 0))
+                self._speed_tester_d[uid] = shaper.SpeedTester(self._config.get("speed_limit_per_user", 0))
             else:
-                self._speed_tester_d[uid] = SpeedTester(self._config.get("speed_limit_per_user", 0))
+                self._speed_tester_d[uid] = shaper.SpeedTester(self._config.get("speed_limit_per_user", 0))
         return self._speed_tester_d[uid]
 
     def update_limit(self, uid, max_speed):
@@ -1349,13 +1943,14 @@ class TCPRelay(object):
     def update_stat(self, port, stat_dict, val):
         newval = stat_dict.get(0, 0) + val
         stat_dict[0] = newval
-        logging.debug('port %d connections %d' % (port, newval))
+        if log.DEBUG:
+            logging.debug('port %d connections %d', port, newval)
         connections_step = 25
         if newval >= stat_dict.get(-1, 0) + connections_step:
-            logging.info('port %d connections up to %d' % (port, newval))
+            logging.info('port %d connections up to %d', port, newval)
             stat_dict[-1] = stat_dict.get(-1, 0) + connections_step
         elif newval <= stat_dict.get(-1, 0) - connections_step:
-            logging.info('port %d connections down to %d' % (port, newval))
+            logging.info('port %d connections down to %d', port, newval)
             stat_dict[-1] = stat_dict.get(-1, 0) - connections_step
 
     def stat_add(self, local_addr, val):
@@ -1363,7 +1958,8 @@ class TCPRelay(object):
             if self._listen_port not in self._stat_counter:
                 self._stat_counter[self._listen_port] = {}
             newval = self._stat_counter[self._listen_port].get(local_addr, 0) + val
-            logging.debug('port %d addr %s connections %d' % (self._listen_port, local_addr, newval))
+            if log.DEBUG:
+                logging.debug('port %d addr %s connections %d', self._listen_port, local_addr, newval)
             self._stat_counter[self._listen_port][local_addr] = newval
             self.update_stat(self._listen_port, self._stat_counter[self._listen_port], val)
             if newval <= 0:
@@ -1372,64 +1968,36 @@ class TCPRelay(object):
 
             newval = self._stat_counter.get(0, 0) + val
             self._stat_counter[0] = newval
-            logging.debug('Total connections %d' % newval)
+            if log.DEBUG:
+                logging.debug('Total connections %d', newval)
 
             connections_step = 50
             if newval >= self._stat_counter.get(-1, 0) + connections_step:
-                logging.info('Total connections up to %d' % newval)
+                logging.info('Total connections up to %d', newval)
                 self._stat_counter[-1] = self._stat_counter.get(-1, 0) + connections_step
             elif newval <= self._stat_counter.get(-1, 0) - connections_step:
-                logging.info('Total connections down to %d' % newval)
+                logging.info('Total connections down to %d', newval)
                 self._stat_counter[-1] = self._stat_counter.get(-1, 0) - connections_step
 
-    def update_activity(self, client, data_len):
-        if data_len and self._stat_callback:
-            self._stat_callback(self._listen_port, data_len)
-
-        self._timeout_cache[hash(client)] = client
-
-    def _sweep_timeout(self):
-        self._timeout_cache.sweep()
-
     def _close_tcp_client(self, client):
-        if client.remote_address:
-            logging.debug('timed out: %s:%d' %
-                         client.remote_address)
-        else:
-            logging.debug('timed out')
+        if log.DEBUG:
+            if client.remote_address:
+                logging.debug('timed out: %s:%d', *client.remote_address)
+            else:
+                logging.debug('timed out')
         client.destroy()
 
     def handle_event(self, sock, fd, event):
         # handle events and dispatch to handlers
         handle = False
-        if sock:
+        if sock and log.VERBOSE:
             logging.log(shell.VERBOSE_LEVEL, 'fd %d %s', fd,
                         eventloop.EVENT_NAMES.get(event, event))
         if sock == self._server_socket:
             if event & eventloop.POLL_ERR:
                 # TODO
                 raise Exception('server_socket error')
-            handler = None
-            handle = True
-            try:
-                logging.debug('accept')
-                conn = self._server_socket.accept()
-                handler = TCPRelayHandler(self, self._fd_to_handlers,
-                                self._eventloop, conn[0], self._config,
-                                self._dns_resolver, self._is_local)
-                if handler.stage() == STAGE_DESTROYED:
-                    conn[0].close()
-            except (OSError, IOError) as e:
-                error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
-                                errno.EWOULDBLOCK):
-                    return
-                else:
-                    shell.print_exception(e)
-                    if self._config['verbose']:
-                        traceback.print_exc()
-                    if handler:
-                        handler.destroy()
+            return self._accept_conns()
         else:
             if sock:
                 handler = self._fd_to_handlers.get(fd, None)
@@ -1453,24 +2021,76 @@ class TCPRelay(object):
                         shell.print_exception(e)
         return handle
 
-    def handle_periodic(self):
-        if self._closed:
-            if self._server_socket:
-                self._eventloop.removefd(self._server_socket_fd)
-                self._server_socket.close()
-                self._server_socket = None
-                logging.info('closed TCP port %d', self._listen_port)
-            for handler in list(self._fd_to_handlers.values()):
-                handler.destroy()
-        self._sweep_timeout()
+    def _accept_conns(self):
+        # accept until nothing is waiting, but no more than accept_batch
+        # connections so the connected sockets still get their turn
+        # returns False if there was nothing to accept
+        for i in range(self._accept_batch):
+            handler = None
+            try:
+                if log.DEBUG:
+                    logging.debug('accept')
+                conn = self._server_socket.accept()
+                self._accept_backoff = False
+                handler = TCPRelayHandler(self, self._fd_to_handlers,
+                                self._eventloop, conn[0], self._config,
+                                self._dns_resolver, self._is_local)
+                if handler.stage() == STAGE_DESTROYED:
+                    conn[0].close()
+            except (OSError, IOError) as e:
+                error_no = eventloop.errno_from_exception(e)
+                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
+                                errno.EWOULDBLOCK):
+                    return i > 0
+                if error_no in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                                errno.ENOMEM):
+                    # accept would fail again at once, the connections
+                    # wait in the backlog until some are closed
+                    if handler:
+                        handler.destroy()
+                    self._back_off_accept(e)
+                    return False
+                shell.print_exception(e)
+                if self._config['verbose']:
+                    traceback.print_exc()
+                if handler:
+                    handler.destroy()
+                return True
+        return True
+
+    def _back_off_accept(self, e):
+        if not self._accept_backoff:
+            logging.error('%s, not accepting on port %d for now',
+                          e, self._listen_port)
+        self._accept_backoff = True
+        self._eventloop.modify(self._server_socket, eventloop.POLL_ERR)
+        self._eventloop.call_later(ACCEPT_BACKOFF, self._resume_accept)
+
+    def _resume_accept(self):
+        if self._server_socket and not self._closed:
+            self._eventloop.modify(self._server_socket,
+                                   eventloop.POLL_IN | eventloop.POLL_ERR)
+
+    def _close_in_loop(self):
+        self._sweeper.cancel()
+        if self._server_socket:
+            self._eventloop.removefd(self._server_socket_fd)
+            self._server_socket.close()
+            self._server_socket = None
+            logging.info('closed TCP port %d', self._listen_port)
+        for handler in list(self._fd_to_handlers.values()):
+            handler.destroy()
 
     def close(self, next_tick=False):
+        # next_tick: called from another thread, close in the loop thread
         logging.debug('TCP close')
         self._closed = True
         if not next_tick:
             if self._eventloop:
-                self._eventloop.remove_periodic(self.handle_periodic)
+                self._sweeper.cancel()
                 self._eventloop.removefd(self._server_socket_fd)
             self._server_socket.close()
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
+        elif self._eventloop:
+            self._eventloop.call_soon(self._close_in_loop)
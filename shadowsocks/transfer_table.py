@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# upload and download byte counters of ports and users in an array
+#
+# the array lives in an anonymous mmap, so the workers forked after the
+# table is created all add to the same table. every writer has its own
+# region of counters and never races the others, readers sum the regions.
+# a shared table can't grow, every process counts the ids beyond its
+# capacity apart, for the master to collect with overflow()
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import mmap
+import ctypes
+import logging
+import operator
+
+
+DEFAULT_CAPACITY = 1024
+
+# a memoryview indexes faster than ctypes, but only Python 3 has cast, and
+# Python 2.6 no memoryview at all
+try:
+    HAS_CAST = hasattr(memoryview, 'cast')
+except NameError:
+    HAS_CAST = False
+
+
+def _array(mm, offset, length, typecode):
+    if HAS_CAST:
+        return memoryview(mm)[offset:offset + 8 * length].cast(typecode)
+    if typecode == 'q':
+        return (ctypes.c_int64 * length).from_buffer(mm, offset)
+    return (ctypes.c_uint64 * length).from_buffer(mm, offset)
+
+
+class TransferTable(object):
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, writers=1):
+        # a table with a single writer grows, a shared one can't be mapped
+        # again after the fork and gives the ids beyond capacity a slot of
+        # this process only
+        self._writers = writers
+        self._lock = None
+        if writers > 1:
+            import multiprocessing
+            self._lock = multiprocessing.Lock()
+        self._slots = {}  # id -> slot, as far as this process knows
+        self._known = 0
+        self._base = 0
+        self._last = []
+        self._full = False
+        self._arrays = self._map(capacity)
+        self._counters = self._arrays[2]
+        self._capacity = capacity
+        self._overflow_ids = []
+        self._overflow = []  # [upload, download] * overflow ids
+        self._last_overflow = {}
+
+    def _map(self, capacity):
+        # layout: count, ids[capacity], then for every writer
+        # [upload, download] * (capacity + 1), the last pair is unused
+        stride = 2 * (capacity + 1)
+        mm = mmap.mmap(-1, 8 * (1 + capacity + stride * self._writers))
+        count = _array(mm, 0, 1, 'q')
+        ids = _array(mm, 8, capacity, 'q')
+        counters = _array(mm, 8 * (1 + capacity), stride * self._writers, 'Q')
+        return count, ids, counters, capacity
+
+    def _grow(self):
+        count, ids, counters, capacity = self._arrays
+        arrays = self._map(capacity * 2)
+        n = count[0]
+        arrays[1][:n] = ids[:n]
+        arrays[2][:2 * n] = counters[:2 * n]
+        arrays[0][0] = n
+        # readers in other threads take all the arrays at once
+        self._arrays = arrays
+        self._counters = arrays[2]
+        self._capacity = arrays[3]
+
+    def set_writer(self, index):
+        # called by a worker after the fork
+        self._base = 2 * (self._arrays[3] + 1) * index
+
+    def slot(self, id):
+        slot = self._slots.get(id)
+        if slot is not None:
+            return slot
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            count, ids, counters, capacity = self._arrays
+            n = count[0]
+            for i in range(self._known, n):
+                self._slots[ids[i]] = i
+            self._known = n
+            slot = self._slots.get(id)
+            if slot is not None:
+                return slot
+            if n == capacity:
+                if self._lock is not None:
+                    if not self._full:
+                        logging.warning('transfer table full, %d ids, '
+                                        'counting the others apart' % n)
+                        self._full = True
+                    slot = capacity + len(self._overflow_ids)
+                    self._overflow_ids.append(id)
+                    self._overflow.extend((0, 0))
+                    self._slots[id] = slot
+                    return slot
+                self._grow()
+                count, ids, counters, capacity = self._arrays
+            ids[n] = id
+            count[0] = n + 1
+            self._slots[id] = n
+            self._known = n + 1
+            return n
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+
+    def add_u(self, slot, transfer):
+        if slot < self._capacity:
+            self._counters[self._base + 2 * slot] += transfer
+        else:
+            self._overflow[2 * (slot - self._capacity)] += transfer
+
+    def add_d(self, slot, transfer):
+        if slot < self._capacity:
+            self._counters[self._base + 2 * slot + 1] += transfer
+        else:
+            self._overflow[2 * (slot - self._capacity) + 1] += transfer
+
+    def overflow(self):
+        # {id: [upload, download]} since the start of the ids this process
+        # counts apart
+        overflow = self._overflow
+        return dict((id, overflow[2 * i:2 * i + 2])
+                    for i, id in enumerate(self._overflow_ids))
+
+    def _merge_overflow(self, ret, overflows):
+        # the sum of overflow() of this process and of the given ones
+        for overflow in [self.overflow()] + list(overflows):
+            for id, transfer in (overflow or {}).items():
+                if id in ret:
+                    ret[id] = [ret[id][0] + transfer[0],
+                               ret[id][1] + transfer[1]]
+                else:
+                    ret[id] = list(transfer)
+        return ret
+
+    def _totals(self):
+        count, ids, counters, capacity = self._arrays
+        n = count[0]
+        stride = 2 * (capacity + 1)
+        totals = list(counters[:2 * n])
+        for base in range(stride, stride * self._writers, stride):
+            totals = list(map(operator.add, totals,
+                              counters[base:base + 2 * n]))
+        return list(ids[:n]), totals
+
+    def snapshot(self, overflows=()):
+        # {id: [upload, download]} of every id with any transfer, overflows
+        # are overflow() of the other processes writing the table
+        ids, totals = self._totals()
+        ret = {}
+        for i, id in enumerate(ids):
+            u = totals[2 * i]
+            d = totals[2 * i + 1]
+            if u or d:
+                ret[id] = [u, d]
+        return self._merge_overflow(ret, overflows)
+
+    def delta(self, overflows=()):
+        # {id: [upload, download]} added since the last call
+        ids, totals = self._totals()
+        last = self._last
+        last.extend([0] * (len(totals) - len(last)))
+        ret = {}
+        for i, id in enumerate(ids):
+            u = totals[2 * i] - last[2 * i]
+            d = totals[2 * i + 1] - last[2 * i + 1]
+            if u or d:
+                ret[id] = [u, d]
+        self._last = totals
+        overflow = self._merge_overflow({}, overflows)
+        last_overflow = self._last_overflow
+        for id, transfer in overflow.items():
+            last = last_overflow.get(id, (0, 0))
+            u = transfer[0] - last[0]
+            d = transfer[1] - last[1]
+            if u or d:
+                ret[id] = [u, d]
+        self._last_overflow = overflow
+        return ret
+
+
+def test():
+    table = TransferTable(capacity=2)
+    a = table.slot(1000)
+    table.add_u(a, 10)
+    table.add_d(a, 20)
+    assert table.slot(1000) == a
+    b = table.slot(1001)
+    c = table.slot(1002)  # grows
+    table.add_u(c, 5)
+    assert table.snapshot() == {1000: [10, 20], 1002: [5, 0]}
+    assert table.delta() == {1000: [10, 20], 1002: [5, 0]}
+    table.add_d(b, 7)
+    table.add_u(a, 1)
+    assert table.delta() == {1000: [1, 0], 1001: [0, 7]}
+    assert table.delta() == {}
+    assert table.snapshot() == {1000: [11, 20], 1001: [0, 7], 1002: [5, 0]}
+
+    if not hasattr(os, 'fork'):
+        return
+    from multiprocessing import Pipe
+    table = TransferTable(capacity=4, writers=2)
+    table.add_u(table.slot(1), 1)
+    conn, worker_conn = Pipe()
+    pid = os.fork()
+    if pid == 0:
+        table.set_writer(1)
+        table.add_u(table.slot(1), 2)
+        for id in range(2, 7):
+            table.add_d(table.slot(id), id)
+        table.add_u(table.slot(6), 1)
+        worker_conn.send(table.overflow())
+        os._exit(0)
+    overflows = [conn.recv()]
+    os.waitpid(pid, 0)
+    # 5 and 6 are beyond the capacity, counted by the worker apart
+    assert overflows == [{5: [0, 5], 6: [1, 6]}], overflows
+    # the master counts 6 apart too
+    table.add_u(table.slot(6), 10)
+    assert table.delta(overflows) == {1: [3, 0], 2: [0, 2], 3: [0, 3],
+                                      4: [0, 4], 5: [0, 5], 6: [11, 6]}
+    assert table.delta(overflows) == {}
+    table.add_d(table.slot(5), 1)
+    assert table.delta(overflows) == {5: [0, 1]}
+    assert table.snapshot(overflows) == {1: [3, 0], 2: [0, 2], 3: [0, 3],
+                                         4: [0, 4], 5: [0, 6], 6: [11, 6]}
+
+
+if __name__ == '__main__':
+    test()
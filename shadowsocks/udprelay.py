@@ -68,12 +68,12 @@ import logging
 import struct
 import errno
 import random
-import binascii
 import traceback
 import threading
 
-from shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell
+from shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell, log
 from shadowsocks.common import pre_parse_header, parse_header, pack_addr
+from shadowsocks.transfer_table import TransferTable
 
 # for each handler, we have 2 stream directions:
 #    upstream:    from client to server direction
@@ -123,15 +123,21 @@ RSP_STATE_ERROR = b"\x03"
 RSP_STATE_DISCONNECT = b"\x04"
 RSP_STATE_REDIRECT = b"\x05"
 
+def _would_block(e):
+    return isinstance(e, (OSError, IOError)) and \
+        eventloop.errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
 def client_key(source_addr, server_af):
     # notice this is server af, not dest af
     return '%s:%s:%d' % (source_addr[0], source_addr[1], server_af)
 
 class UDPRelay(object):
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None, transfer_table=None):
         self._config = config
         if config.get('connect_verbose_info', 0) > 0:
             common.connect_log = logging.info
+            log.connect_verbose = True
+            log.update()
         if is_local:
             self._listen_addr = config['local_address']
             self._listen_port = config['local_port']
@@ -155,12 +161,16 @@ class UDPRelay(object):
         self._client_fd_to_server_addr = {}
         #self._dns_cache = lru_cache.LRUCache(timeout=1800)
         self._eventloop = None
+        self._sweepers = []
         self._closed = False
         self.server_transfer_ul = 0
         self.server_transfer_dl = 0
         self.server_users = {}
-        self.server_user_transfer_ul = {}
-        self.server_user_transfer_dl = {}
+        self.mu = False
+        if transfer_table is None:
+            transfer_table = TransferTable()
+        self._transfer_table = transfer_table
+        self._transfer_slots = {}  # user -> slot in the transfer table
 
         if common.to_bytes(config['protocol']) in obfs.mu_protocol():
             self._update_users(None, None)
@@ -194,6 +204,8 @@ class UDPRelay(object):
         self._bind = config.get('out_bind', '')
         self._bindv6 = config.get('out_bindv6', '')
         self._ignore_bind_list = config.get('ignore_bind', [])
+        # the address family of each address bound to, from getaddrinfo
+        self._bind_families = {}
 
         if 'forbidden_ip' in config:
             self._forbidden_iplist = config['forbidden_ip']
@@ -211,6 +223,8 @@ class UDPRelay(object):
                             (self._listen_addr, self._listen_port))
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
+        if config.get('reuse_port', False):
+            server_socket.setsockopt(socket.SOL_SOCKET, common.SO_REUSEPORT, 1)
         server_socket.bind((self._listen_addr, self._listen_port))
         server_socket.setblocking(False)
         self._server_socket = server_socket
@@ -226,18 +240,12 @@ class UDPRelay(object):
         logging.debug('chosen server: %s:%d', server, server_port)
         return server, server_port
 
-    def get_ud(self):
-        return (self.server_transfer_ul, self.server_transfer_dl)
-
-    def get_users_ud(self):
-        ret = (self.server_user_transfer_ul.copy(), self.server_user_transfer_dl.copy())
-        return ret
-
     def _update_users(self, protocol_param, acl):
         if protocol_param is None:
             protocol_param = self._config['protocol_param']
         param = common.to_bytes(protocol_param).split(b'#')
         if len(param) == 2:
+            self.mu = True
             user_list = param[1].split(b',')
             if user_list:
                 for user in user_list:
@@ -272,23 +280,36 @@ class UDPRelay(object):
         if uid in self.server_users:
             del self.server_users[uid]
 
+    def _transfer_slot(self, user):
+        slot = self._transfer_slots.get(user)
+        if slot is None:
+            if user is None:
+                slot = self._transfer_table.slot(self._listen_port)
+            else:
+                slot = self._transfer_table.slot(struct.unpack('<I', user)[0])
+            self._transfer_slots[user] = slot
+        return slot
+
     def add_transfer_u(self, user, transfer):
         if user is None:
-            self.server_transfer_ul += transfer
+            if self.mu:
+                # counted for the next user seen on this port
+                self.server_transfer_ul += transfer
+                return
         else:
-            if user not in self.server_user_transfer_ul:
-                self.server_user_transfer_ul[user] = 0
-            self.server_user_transfer_ul[user] += transfer + self.server_transfer_ul
+            transfer += self.server_transfer_ul
             self.server_transfer_ul = 0
+        self._transfer_table.add_u(self._transfer_slot(user), transfer)
 
     def add_transfer_d(self, user, transfer):
         if user is None:
-            self.server_transfer_dl += transfer
+            if self.mu:
+                self.server_transfer_dl += transfer
+                return
         else:
-            if user not in self.server_user_transfer_dl:
-                self.server_user_transfer_dl[user] = 0
-            self.server_user_transfer_dl[user] += transfer + self.server_transfer_dl
+            transfer += self.server_transfer_dl
             self.server_transfer_dl = 0
+        self._transfer_table.add_d(self._transfer_slot(user), transfer)
 
     def _close_client_pair(self, client_pair):
         client, uid = client_pair
@@ -298,8 +319,9 @@ class UDPRelay(object):
         if hasattr(client, 'close'):
             if not self._is_local:
                 if client.fileno() in self._client_fd_to_server_addr:
-                    logging.debug('close_client: %s' %
-                                 (self._client_fd_to_server_addr[client.fileno()],))
+                    if log.DEBUG:
+                        logging.debug('close_client: %s',
+                                      self._client_fd_to_server_addr[client.fileno()])
                 else:
                     client.info('close_client')
             self._sockets.remove(client.fileno())
@@ -313,7 +335,7 @@ class UDPRelay(object):
 
     def _handel_protocol_error(self, client_address, ogn_data):
         #raise Exception('can not parse header')
-        logging.warn("Protocol ERROR, UDP ogn data %s from %s:%d" % (binascii.hexlify(ogn_data), client_address[0], client_address[1]))
+        logging.warn("Protocol ERROR, UDP ogn data %s from %s:%d", log.Hex(ogn_data), client_address[0], client_address[1])
 
     def _socket_bind_addr(self, sock, af):
         bind_addr = ''
@@ -326,9 +348,13 @@ class UDPRelay(object):
         if bind_addr in self._ignore_bind_list:
             bind_addr = None
         if bind_addr:
-            local_addrs = socket.getaddrinfo(bind_addr, 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
-            if local_addrs[0][0] == af:
-                logging.debug("bind %s" % (bind_addr,))
+            bind_af = self._bind_families.get(bind_addr, None)
+            if bind_af is None:
+                bind_af = common.getaddrinfo(bind_addr, 0, socket.SOCK_DGRAM, socket.SOL_UDP)[0][0]
+                self._bind_families[bind_addr] = bind_af
+            if bind_af == af:
+                if log.DEBUG:
+                    logging.debug("bind %s", bind_addr)
                 try:
                     sock.bind((bind_addr, 0))
                 except Exception as e:
@@ -367,7 +393,7 @@ class UDPRelay(object):
                 return
 
         try:
-            header_result = parse_header(data)
+            header_result = parse_header(data, r_addr[0])
         except:
             self._handel_protocol_error(r_addr, ogn_data)
             return
@@ -400,8 +426,8 @@ class UDPRelay(object):
         user_id = self._listen_port
         try:
             server_port = remote_addr[1]
-            addrs = socket.getaddrinfo(server_addr, server_port, 0,
-                                        socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs = common.getaddrinfo(server_addr, server_port,
+                                       socket.SOCK_DGRAM, socket.SOL_UDP)
             if not addrs: # drop
                 return
             af, socktype, proto, canonname, sa = addrs[0]
@@ -413,12 +439,14 @@ class UDPRelay(object):
             if client_pair is None:
                 if self._forbidden_iplist:
                     if common.to_str(sa[0]) in self._forbidden_iplist:
-                        logging.debug('IP %s is in forbidden list, drop' % common.to_str(sa[0]))
+                        if log.DEBUG:
+                            logging.debug('IP %s is in forbidden list, drop', common.to_str(sa[0]))
                         # drop
                         return
                 if self._forbidden_portset:
                     if sa[1] in self._forbidden_portset:
-                        logging.debug('Port %d is in forbidden list, reject' % sa[1])
+                        if log.DEBUG:
+                            logging.debug('Port %d is in forbidden list, reject', sa[1])
                         # drop
                         return
                 client = socket.socket(af, socktype, proto)
@@ -431,7 +459,8 @@ class UDPRelay(object):
                 else:
                     pass
                 if sa[1] == 53 and is_dns: #DNS
-                    logging.debug("DNS query %s from %s:%d" % (common.to_str(sa[0]), r_addr[0], r_addr[1]))
+                    if log.DEBUG:
+                        logging.debug("DNS query %s from %s:%d", common.to_str(sa[0]), r_addr[0], r_addr[1])
                     self._cache_dns_client[key] = (client, uid)
                 else:
                     self._cache[key] = (client, uid)
@@ -440,7 +469,8 @@ class UDPRelay(object):
                 self._sockets.add(client.fileno())
                 self._eventloop.add(client, eventloop.POLL_IN, self)
 
-                logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sockets)))
+                if log.DEBUG:
+                    logging.debug('UDP port %5d sockets %d', self._listen_port, len(self._sockets))
 
                 if uid is not None:
                     user_id = struct.unpack('<I', client_uid)[0]
@@ -468,10 +498,10 @@ class UDPRelay(object):
         try:
             client.sendto(data, (server_addr, server_port))
             self.add_transfer_u(client_uid, len(data))
-            if client_pair is None: # new request
+            if client_pair is None and log.CONNECT: # new request
                 addr, port = client.getsockname()[:2]
-                common.connect_log('UDP data to %s(%s):%d from %s:%d by user %d' %
-                        (common.to_str(remote_addr[0]), common.to_str(server_addr), server_port, addr, port, user_id))
+                common.connect_log('UDP data to %s(%s):%d from %s:%d by user %d',
+                        common.to_str(remote_addr[0]), common.to_str(server_addr), server_port, addr, port, user_id)
         except IOError as e:
             err = eventloop.errno_from_exception(e)
             logging.warning('IOError sendto %s:%d by user %d' % (server_addr, server_port, user_id))
@@ -520,7 +550,7 @@ class UDPRelay(object):
                 return
             self._protocol.obfs.server_info.recv_iv = ref_iv[0]
             data = self._protocol.client_udp_post_decrypt(data)
-            header_result = parse_header(data)
+            header_result = parse_header(data, r_addr[0])
             if header_result is None:
                 return
             #connecttype, dest_addr, dest_port, header_length = header_result
@@ -529,13 +559,11 @@ class UDPRelay(object):
             response = b'\x00\x00\x00' + data
 
         if client_addr:
-            if client_uid:
-                self.add_transfer_d(client_uid, len(response))
-            else:
-                self.server_transfer_dl += len(response)
+            self.add_transfer_d(client_uid, len(response))
             self.write_to_server_socket(response, client_addr[0])
             if client_dns_pair:
-                logging.debug("remove dns client %s:%d" % (client_addr[0][0], client_addr[0][1]))
+                if log.DEBUG:
+                    logging.debug("remove dns client %s:%d", client_addr[0][0], client_addr[0][1])
                 del self._cache_dns_client[key]
                 self._close_client(client_dns_pair[0])
         else:
@@ -577,7 +605,11 @@ class UDPRelay(object):
         server_socket = self._server_socket
         self._eventloop.add(server_socket,
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
-        loop.add_periodic(self.handle_periodic)
+        self._sweepers = [
+            lru_cache.Sweeper(loop, self._cache, self._sweep_cache),
+            lru_cache.Sweeper(loop, self._cache_dns_client),
+            lru_cache.Sweeper(loop, self._timeout_cache),
+        ]
 
     def remove_handler(self, client):
         if hash(client) in self._timeout_cache:
@@ -586,8 +618,13 @@ class UDPRelay(object):
     def update_activity(self, client):
         self._timeout_cache[hash(client)] = client
 
-    def _sweep_timeout(self):
-        self._timeout_cache.sweep()
+    def _sweep_cache(self):
+        before_sweep_size = len(self._sockets)
+        result = self._cache.sweep()
+        if before_sweep_size != len(self._sockets):
+            if log.DEBUG:
+                logging.debug('UDP port %5d sockets %d', self._listen_port, len(self._sockets))
+        return result
 
     def _close_tcp_client(self, client):
         if client.remote_address:
@@ -599,12 +636,15 @@ class UDPRelay(object):
         client.destroy_local()
 
     def handle_event(self, sock, fd, event):
+        # returns False only if the event turned out to be spurious
         if sock == self._server_socket:
             if event & eventloop.POLL_ERR:
                 logging.error('UDP server_socket err')
             try:
                 self._handle_server()
             except Exception as e:
+                if _would_block(e):
+                    return False
                 shell.print_exception(e)
                 if self._config['verbose']:
                     traceback.print_exc()
@@ -614,6 +654,8 @@ class UDPRelay(object):
             try:
                 self._handle_client(sock)
             except Exception as e:
+                if _would_block(e):
+                    return False
                 shell.print_exception(e)
                 if self._config['verbose']:
                     traceback.print_exc()
@@ -624,33 +666,33 @@ class UDPRelay(object):
                     handler.handle_event(sock, event)
             else:
                 logging.warn('poll removed fd')
-
-    def handle_periodic(self):
-        if self._closed:
-            self._cache.clear(0)
-            self._cache_dns_client.clear(0)
-            if self._eventloop:
-                self._eventloop.remove_periodic(self.handle_periodic)
-                self._eventloop.remove(self._server_socket)
-            if self._server_socket:
-                self._server_socket.close()
-                self._server_socket = None
-                logging.info('closed UDP port %d', self._listen_port)
-        else:
-            before_sweep_size = len(self._sockets)
-            self._cache.sweep()
-            self._cache_dns_client.sweep()
-            if before_sweep_size != len(self._sockets):
-                logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sockets)))
-            self._sweep_timeout()
+        return True
+
+    def _cancel_sweepers(self):
+        for sweeper in self._sweepers:
+            sweeper.cancel()
+        self._sweepers = []
+
+    def _close_in_loop(self):
+        self._cancel_sweepers()
+        self._cache.clear(0)
+        self._cache_dns_client.clear(0)
+        if self._server_socket:
+            self._eventloop.remove(self._server_socket)
+            self._server_socket.close()
+            self._server_socket = None
+            logging.info('closed UDP port %d', self._listen_port)
 
     def close(self, next_tick=False):
+        # next_tick: called from another thread, close in the loop thread
         logging.debug('UDP close')
         self._closed = True
         if not next_tick:
             if self._eventloop:
-                self._eventloop.remove_periodic(self.handle_periodic)
+                self._cancel_sweepers()
                 self._eventloop.remove(self._server_socket)
             self._server_socket.close()
             self._cache.clear(0)
             self._cache_dns_client.clear(0)
+        elif self._eventloop:
+            self._eventloop.call_soon(self._close_in_loop)
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# micro benchmarks for the event loop and the relays, in tests/benchmarks
+#
+# usage: python tests/benchmark.py [-d SECONDS] [NAME]...
+#
+# without NAME every benchmark is run
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import sys
+import os
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+
+from shadowsocks import log
+from benchmarks import loop, stats, relay, conns, udp, shaping
+
+
+BENCHMARKS = loop.BENCHMARKS + stats.BENCHMARKS + relay.BENCHMARKS + \
+    conns.BENCHMARKS + udp.BENCHMARKS + shaping.BENCHMARKS
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark Shadowsocks')
+    parser.add_argument('-d', '--duration', type=float, default=2.0)
+    parser.add_argument('names', nargs='*')
+    config = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+    log.update()
+    for name, func in BENCHMARKS:
+        if not config.names or name in config.names:
+            func(config.duration)
+
+
+if __name__ == '__main__':
+    main()
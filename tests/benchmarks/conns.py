@@ -0,0 +1,383 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# benchmarks of setting up and tracking TCP connections
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import time
+import struct
+import random
+import socket
+import logging
+import threading
+
+from shadowsocks import eventloop, lru_cache, asyncdns, tcprelay, common, \
+    latency
+from benchmarks.util import percentile, report, cpu_time, relay_config, \
+    accepted_conns, short_conns
+
+
+def bench_short_conns(duration):
+    # connections/sec of a short lived connection workload, and the CPU
+    # time ssserver spends creating and destroying a handler
+    configs = [
+        ('none, origin', {}),
+        ('chacha20, auth_sha1_v4, http_simple',
+         {'method': 'chacha20', 'protocol': 'auth_sha1_v4',
+          'obfs': 'http_simple'}),
+    ]
+    conns = 2000
+    for name, config in configs:
+        rate = short_conns(duration, **config)
+        config = relay_config(**config)
+        loop, dns_resolver, relay, clients, accepted = \
+            accepted_conns(config, conns)
+        start = cpu_time()
+        for sock in accepted:
+            tcprelay.TCPRelayHandler(relay, relay._fd_to_handlers, loop,
+                                     sock, config, dns_resolver,
+                                     False).destroy()
+        elapsed = cpu_time() - start
+        report('short_conns: ' + name,
+               conns_per_sec='%.0f' % rate,
+               handler_us='%.1f' % (elapsed * 1e6 / conns))
+        relay.close()
+        for sock in clients:
+            sock.close()
+
+
+def bench_latency(duration):
+    # cost of recording a stage of a connection, and the stages of the
+    # ssserver connections of the short connection workload
+    h = latency.Histogram()
+    n = 1000000
+    start = time.time()
+    for i in range(n):
+        h.record(0.000123)
+    report('latency: record', ns_per_record='%.0f' %
+           ((time.time() - start) * 1e9 / n))
+    stats = {}
+    short_conns(duration, stats=stats)
+    for stage in latency.STAGES:
+        summary = stats['latency'][stage]
+        report('latency: ' + stage, count=summary['count'],
+               p50_ms=summary.get('p50', '-'), p99_ms=summary.get('p99', '-'))
+
+
+def bench_accept_storm(duration):
+    # connections/sec accepted by ssserver when they all arrive at once,
+    # one accept per poll against accepting in batches
+    conns = 2000
+    for name, batch in (('1 per poll', 1),
+                        ('batch of %d' % tcprelay.ACCEPT_BATCH,
+                         tcprelay.ACCEPT_BATCH)):
+        samples = []
+        for i in range(3):
+            config = relay_config(accept_batch=batch, max_connect=4096)
+            loop = eventloop.EventLoop(config)
+            dns_resolver = asyncdns.DNSResolver()
+            relay = tcprelay.TCPRelay(config, dns_resolver, False)
+            relay.add_to_loop(loop)
+            # the connections wait in the backlog when the loop starts
+            clients = []
+            for j in range(conns):
+                c = socket.socket()
+                c.setblocking(False)
+                c.connect_ex(('127.0.0.1', config['server_port']))
+                clients.append(c)
+            loop_thread = threading.Thread(target=loop.run)
+            loop_thread.daemon = True
+            start = time.time()
+            loop_thread.start()
+            while relay.server_connections < conns:
+                time.sleep(0.001)
+            samples.append(conns / (time.time() - start))
+            loop.call_soon(loop.stop)
+            loop_thread.join()
+            relay.close()
+            dns_resolver.close()
+            for c in clients:
+                c.close()
+        report('accept_storm: ' + name, conns=conns,
+               accepts_per_sec='%.0f' % max(samples))
+
+
+def bench_happy_eyeballs(duration):
+    # time to the first byte through ssserver for a host with an IPv6 and
+    # an IPv4 address, when IPv6 connects are dropped or refused
+    hostname = b'dualstack.test'
+    # the refused connects are logged as errors
+    logging.disable(logging.ERROR)
+    for name, blackhole in (('ipv6 dropped', True), ('ipv6 refused', False)):
+        for happy_eyeballs in (False, True):
+            config = relay_config(happy_eyeballs=happy_eyeballs)
+            loop = eventloop.create_loop(config)
+            dns_resolver = asyncdns.DNSResolver()
+            relay = tcprelay.TCPRelay(config, dns_resolver, False)
+            dns_resolver.add_to_loop(loop)
+            relay.add_to_loop(loop)
+            loop_thread = threading.Thread(target=loop.run)
+            loop_thread.daemon = True
+            loop_thread.start()
+
+            sink = socket.socket()
+            sink.bind(('127.0.0.1', 0))
+            sink.listen(128)
+            port = sink.getsockname()[1]
+            holes = []
+            if blackhole:
+                # a full accept queue drops the SYNs
+                hole = socket.socket(socket.AF_INET6)
+                hole.bind(('::1', port))
+                hole.listen(0)
+                holes.append(hole)
+                for i in range(3):
+                    c = socket.socket(socket.AF_INET6)
+                    c.setblocking(False)
+                    c.connect_ex(('::1', port))
+                    holes.append(c)
+            dns_resolver._cache[hostname] = '::1'
+            dns_resolver._cache_v4[hostname] = '127.0.0.1'
+
+            def serve():
+                while True:
+                    try:
+                        conn = sink.accept()[0]
+                    except (OSError, IOError):
+                        return
+                    conn.recv(64)
+                    conn.sendall(b'y' * 64)
+                    conn.close()
+
+            t = threading.Thread(target=serve)
+            t.daemon = True
+            t.start()
+            request = b'\x03' + common.chr(len(hostname)) + hostname + \
+                struct.pack('>H', port) + b'x' * 64
+            samples = []
+            failed = 0
+            deadline = time.time() + duration
+            while time.time() < deadline or not samples and not failed:
+                c = socket.create_connection(('127.0.0.1',
+                                              config['server_port']))
+                c.settimeout(3)
+                start = time.time()
+                c.sendall(request)
+                try:
+                    if c.recv(64):
+                        samples.append(time.time() - start)
+                    else:
+                        failed += 1
+                except socket.timeout:
+                    failed += 1
+                c.close()
+            loop.call_soon(loop.stop)
+            loop_thread.join()
+            relay.close()
+            dns_resolver.close()
+            sink.close()
+            for sock in holes:
+                sock.close()
+            if samples:
+                ttfb = '%.1f' % (percentile(samples, 50) * 1000)
+            else:
+                ttfb = '-'
+            report('happy_eyeballs: %s, %s' %
+                   (name, 'racing' if happy_eyeballs else 'IPv6 only'),
+                   conns=len(samples) + failed, failed=failed, ttfb_ms=ttfb)
+    logging.disable(logging.NOTSET)
+
+
+def bench_remote_fast_open(duration):
+    # time to the first byte through ssserver, and how many of the requests
+    # reach the destination in the SYN. TFO needs net.ipv4.tcp_fastopen = 3
+    # for the sink on the same host, the RTT of lo is too small to show the
+    # round trip saved unless a delay is added, with netem for example
+    for remote_fast_open in (False, True):
+        config = relay_config(remote_fast_open=remote_fast_open)
+        loop = eventloop.create_loop(config)
+        dns_resolver = asyncdns.DNSResolver()
+        relay = tcprelay.TCPRelay(config, dns_resolver, False)
+        dns_resolver.add_to_loop(loop)
+        relay.add_to_loop(loop)
+        loop_thread = threading.Thread(target=loop.run)
+        loop_thread.daemon = True
+        loop_thread.start()
+
+        sink = socket.socket()
+        sink.bind(('127.0.0.1', 0))
+        try:
+            sink.setsockopt(socket.SOL_TCP, 23, 128)
+        except socket.error:
+            pass
+        sink.listen(128)
+        syn_data = [0]
+
+        def serve():
+            while True:
+                try:
+                    conn = sink.accept()[0]
+                except (OSError, IOError):
+                    return
+                # tcpi_options has TCPI_OPT_SYN_DATA
+                info = bytearray(conn.getsockopt(socket.SOL_TCP, 11, 8))
+                if info[5] & 32:
+                    syn_data[0] += 1
+                conn.recv(64)
+                conn.sendall(b'y' * 64)
+                conn.close()
+
+        t = threading.Thread(target=serve)
+        t.daemon = True
+        t.start()
+        request = b'\x01' + socket.inet_aton('127.0.0.1') + \
+            struct.pack('>H', sink.getsockname()[1]) + b'x' * 64
+        samples = []
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            c = socket.create_connection(('127.0.0.1',
+                                          config['server_port']))
+            start = time.time()
+            c.sendall(request)
+            if c.recv(64):
+                samples.append(time.time() - start)
+            c.close()
+        loop.call_soon(loop.stop)
+        loop_thread.join()
+        relay.close()
+        dns_resolver.close()
+        sink.close()
+        report('remote_fast_open: %s' % ('on' if remote_fast_open else 'off'),
+               conns=len(samples), syn_data=syn_data[0],
+               ttfb_us='%.0f' % (percentile(samples, 50) * 1e6))
+
+
+class _Conn(object):
+    __slots__ = ('last_activity',)
+
+    def __init__(self, t):
+        self.last_activity = t
+
+
+def bench_activity_tracking(duration):
+    # cost of refreshing the timeout of one of 20k active connections for
+    # a chunk, and of sweeping them, over 10 minutes of loop time with the
+    # default timeout: reinserting the connection in a LRUCache, as the
+    # relay did, against setting last_activity for an ActivityWheel
+    conns = 20000
+    timeout = 300
+    seconds = 600
+    chunks = 2000  # a second, every connection is active every 10 s
+    order = list(range(conns))
+    random.shuffle(order)
+
+    class Clock(object):
+        now = 0
+
+    def lru():
+        clock = Clock()
+        cache = lru_cache.LRUCache(timeout=timeout)
+        cache.clock = clock
+        objs = [_Conn(0) for i in range(conns)]
+        for obj in objs:
+            cache[hash(obj)] = obj
+
+        def touch(i):
+            obj = objs[i]
+            cache[hash(obj)] = obj
+        return clock, cache, touch
+
+    def wheel():
+        clock = Clock()
+        wheel = lru_cache.ActivityWheel(timeout=timeout)
+        wheel.clock = clock
+        objs = [_Conn(0) for i in range(conns)]
+        for obj in objs:
+            wheel.add(obj)
+
+        def touch(i):
+            objs[i].last_activity = clock.now
+        return clock, wheel, touch
+
+    for name, setup in (('LRUCache', lru), ('ActivityWheel', wheel)):
+        clock, timeouts, touch = setup()
+        touch_time = 0
+        sweep_time = 0
+        for second in range(1, seconds + 1):
+            clock.now = second
+            batch = order[second % 10 * chunks:][:chunks]
+            start = time.time()
+            for i in batch:
+                touch(i)
+            touch_time += time.time() - start
+            start = time.time()
+            while not timeouts.sweep():
+                pass
+            sweep_time += time.time() - start
+        assert len(timeouts) == conns
+        report('activity_tracking: ' + name, conns=conns,
+               ns_per_chunk='%.0f' % (touch_time * 1e9 / seconds / chunks),
+               sweep_ms_per_sec='%.3f' % (sweep_time * 1e3 / seconds))
+
+
+def bench_handshake_flood(duration):
+    # seconds until ssserver frees the connections of a flood which never
+    # send a header, with a 5 s timeout, without and with a 1 s
+    # handshake_timeout
+    conns = 500
+    for name, timeout in (('timeout', 5), ('handshake_timeout', 1)):
+        config = relay_config(timeout=5, handshake_timeout=timeout)
+        loop = eventloop.EventLoop()
+        dns_resolver = asyncdns.DNSResolver()
+        dns_resolver.add_to_loop(loop)
+        relay = tcprelay.TCPRelay(config, dns_resolver, False)
+        relay.add_to_loop(loop)
+        loop_thread = threading.Thread(target=loop.run)
+        loop_thread.daemon = True
+        loop_thread.start()
+        start = time.time()
+        clients = [socket.create_connection(('127.0.0.1',
+                                             config['server_port']))
+                   for i in range(conns)]
+        accepted = 0
+        while time.time() - start < 30:
+            accepted = max(accepted, relay.server_connections)
+            if accepted == conns and not relay.server_connections:
+                break
+            time.sleep(0.05)
+        elapsed = time.time() - start
+        loop.call_soon(loop.stop)
+        loop_thread.join()
+        relay.close()
+        dns_resolver.close()
+        for sock in clients:
+            sock.close()
+        report('handshake_flood: ' + name, conns=conns,
+               seconds_to_free='%.1f' % elapsed)
+
+
+BENCHMARKS = [
+    ('short_conns', bench_short_conns),
+    ('latency', bench_latency),
+    ('accept_storm', bench_accept_storm),
+    ('happy_eyeballs', bench_happy_eyeballs),
+    ('remote_fast_open', bench_remote_fast_open),
+    ('activity_tracking', bench_activity_tracking),
+    ('handshake_flood', bench_handshake_flood),
+]
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# benchmarks of the event loops
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import time
+import struct
+import socket
+
+from shadowsocks import eventloop, lru_cache
+from benchmarks.util import percentile, report, cpu_time, relay_throughput
+
+
+class _PingPongHandler(object):
+    # every readable socket receives a timestamp and immediately gets
+    # a new one from its peer, so the loop never runs out of events
+
+    def __init__(self, loop, pairs, duration, result):
+        self._loop = loop
+        self._pairs = pairs
+        self._deadline = time.time() + duration
+        self._result = result
+        self.events = 0
+        self.latency = []
+
+    def handle_event(self, sock, fd, event):
+        now = time.time()
+        data = sock.recv(8)
+        self.latency.append(now - struct.unpack('d', data)[0])
+        self.events += 1
+        if now >= self._deadline:
+            self._loop.stop()
+        self._pairs[fd].send(struct.pack('d', time.time()))
+        return self._result
+
+
+def bench_loop_idle_sleep(duration):
+    # events/sec and added latency of the old "sleep if nobody handled the
+    # event" behaviour against handlers reporting their work precisely
+    modes = [
+        ('legacy handlers, 1ms idle sleep', None, 0.001),
+        ('precise handlers, 1ms idle sleep', True, 0.001),
+        ('legacy handlers, no idle sleep', None, 0),
+    ]
+    for name, result, idle_sleep in modes:
+        loop = eventloop.EventLoop({'loop_idle_sleep': idle_sleep})
+        pairs = {}
+        socks = [socket.socketpair() for i in range(64)]
+        handler = _PingPongHandler(loop, pairs, duration, result)
+        for a, b in socks:
+            pairs[a.fileno()] = b
+            loop.add(a, eventloop.POLL_IN, handler)
+            b.send(struct.pack('d', time.time()))
+        start = time.time()
+        loop.run()
+        elapsed = time.time() - start
+        report('loop_idle_sleep: ' + name,
+               events_per_sec='%.0f' % (handler.events / elapsed),
+               p50_us='%.0f' % (percentile(handler.latency, 50) * 1e6),
+               p99_us='%.0f' % (percentile(handler.latency, 99) * 1e6))
+        for a, b in socks:
+            a.close()
+            b.close()
+
+
+class _CountingPoller(object):
+    # counts the syscalls made on the poller wrapped by EventLoop
+
+    def __init__(self, impl):
+        self._impl = impl
+        self.polls = 0
+        self.ctls = 0
+
+    def poll(self, timeout):
+        self.polls += 1
+        return self._impl.poll(timeout)
+
+    def register(self, *args):
+        self.ctls += 1
+        return self._impl.register(*args)
+
+    def unregister(self, fd):
+        self.ctls += 1
+        return self._impl.unregister(fd)
+
+    def modify(self, fd, mode):
+        self.ctls += 1
+        return self._impl.modify(fd, mode)
+
+    def close(self):
+        self._impl.close()
+
+
+class _EchoHandler(object):
+    # flips every socket between reading and writing like
+    # TCPRelayHandler._update_stream does for a relayed chunk
+
+    def __init__(self, loop, duration):
+        self._loop = loop
+        self._deadline = time.time() + duration
+        self._data = {}
+        self.chunks = 0
+
+    def handle_event(self, sock, fd, event):
+        if event & eventloop.POLL_IN:
+            try:
+                data = sock.recv(4096)
+            except (OSError, IOError):
+                return False
+            self._data[fd] = data
+            self._loop.modify(sock, eventloop.POLL_OUT)
+            return True
+        if event & eventloop.POLL_OUT and fd in self._data:
+            sock.send(self._data.pop(fd))
+            self.chunks += 1
+            if time.time() >= self._deadline:
+                self._loop.stop()
+            self._loop.modify(sock, eventloop.POLL_IN)
+            return True
+        return False
+
+
+def bench_loop_edge_triggered(duration):
+    # syscalls to the poller per relayed chunk, level against edge triggered
+    if not hasattr(eventloop.select, 'epoll'):
+        print('loop_edge_triggered: epoll not available, skipped')
+        return
+    for name, edge in (('level triggered', False), ('edge triggered', True)):
+        loop = eventloop.EventLoop({'loop_edge_triggered': edge})
+        poller = _CountingPoller(loop._impl)
+        loop._impl = poller
+        handler = _EchoHandler(loop, duration)
+        socks = [socket.socketpair() for i in range(64)]
+        for a, b in socks:
+            a.setblocking(False)
+            b.setblocking(False)
+            loop.add(a, eventloop.POLL_IN, handler)
+            loop.add(b, eventloop.POLL_IN, handler)
+            a.send(b'x' * 512)
+        poller.ctls = 0
+        start = time.time()
+        loop.run()
+        elapsed = time.time() - start
+        chunks = max(handler.chunks, 1)
+        report('loop_edge_triggered: ' + name,
+               chunks_per_sec='%.0f' % (handler.chunks / elapsed),
+               ctl_per_chunk='%.2f' % (poller.ctls / chunks),
+               poll_per_chunk='%.3f' % (poller.polls / chunks))
+        for a, b in socks:
+            loop.remove(a)
+            loop.remove(b)
+            a.close()
+            b.close()
+
+
+class _CountingHandler(object):
+
+    def __init__(self, loop, count):
+        self._loop = loop
+        self._count = count
+        self.events = 0
+
+    def handle_event(self, sock, fd, event):
+        self.events += 1
+        if self.events >= self._count:
+            self._loop.stop()
+        return True
+
+
+class _ReadyPoller(object):
+    # reports every registered fd as ready, without any syscall
+
+    def __init__(self):
+        self._events = []
+
+    def poll(self, timeout):
+        return self._events
+
+    def register(self, fd, mode, *args):
+        self._events.append((fd, mode))
+
+    def unregister(self, fd):
+        self._events = [e for e in self._events if e[0] != fd]
+
+    def close(self):
+        pass
+
+
+class _FakeSocket(object):
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    def fileno(self):
+        return self._fd
+
+
+def bench_loop_dispatch(duration):
+    # overhead of EventLoop.run per event with 10k ready fds, the poller
+    # itself is left out
+    fds = 10000
+    loop = eventloop.EventLoop()
+    loop._impl = _ReadyPoller()
+    handler = _CountingHandler(loop, 0)
+    for fd in range(fds):
+        loop.add(_FakeSocket(fd), eventloop.POLL_IN, handler)
+    samples = []
+    while sum(samples) < duration:
+        handler.__init__(loop, fds * 20)
+        loop._stopping = False
+        start = time.time()
+        loop.run()
+        samples.append(time.time() - start)
+    report('loop_dispatch: %d ready fds' % fds,
+           ns_per_event='%.0f' % (min(samples) * 1e9 / (fds * 20)))
+
+
+def bench_loop_timers(duration):
+    # CPU spent keeping the timeout caches of many idle ports, walking all
+    # of them periodically against sweeping them when their keys time out
+    ports = 2000
+    precision = eventloop.TIMEOUT_PRECISION
+    # poll as often as the periodic callbacks would run on a busy node
+    eventloop.TIMEOUT_PRECISION = 0.1
+    try:
+        for name, timers in (('periodic sweep', False), ('timers', True)):
+            loop = eventloop.EventLoop()
+            caches = []
+            for i in range(ports):
+                cache = lru_cache.LRUCache(timeout=300)
+                for j in range(16):
+                    cache[j] = j
+                caches.append(cache)
+                if timers:
+                    lru_cache.Sweeper(loop, cache)
+                else:
+                    loop.add_periodic(cache.sweep)
+            loop.call_later(duration, loop.stop)
+            start = cpu_time()
+            loop.run()
+            report('loop_timers: ' + name, ports=ports,
+                   cpu_ms_per_sec='%.2f' %
+                   ((cpu_time() - start) * 1000 / duration))
+    finally:
+        eventloop.TIMEOUT_PRECISION = precision
+
+
+def bench_loop_backends(duration):
+    # the relays and the echo handler on the native loop, asyncio and uvloop
+    backends = [
+        ('native', {}),
+        ('native, edge triggered', {'loop_edge_triggered': True}),
+        ('asyncio', {'event_loop': 'asyncio'}),
+        ('uvloop', {'event_loop': 'uvloop'}),
+    ]
+    for name, config in backends:
+        loop = eventloop.create_loop(config)
+        if config.get('event_loop') and isinstance(loop, eventloop.EventLoop):
+            print('loop_backends: %s not available, skipped' % name)
+            continue
+        handler = _EchoHandler(loop, duration)
+        socks = [socket.socketpair() for i in range(64)]
+        for a, b in socks:
+            a.setblocking(False)
+            b.setblocking(False)
+            loop.add(a, eventloop.POLL_IN, handler)
+            loop.add(b, eventloop.POLL_IN, handler)
+            a.send(b'x' * 512)
+        start = time.time()
+        loop.run()
+        elapsed = time.time() - start
+        for a, b in socks:
+            loop.remove(a)
+            loop.remove(b)
+            a.close()
+            b.close()
+        report('loop_backends: ' + name,
+               echo_chunks_per_sec='%.0f' % (handler.chunks / elapsed),
+               relay_mb_per_sec='%.1f' %
+               (relay_throughput(duration, **config) / 1e6))
+
+
+BENCHMARKS = [
+    ('loop_idle_sleep', bench_loop_idle_sleep),
+    ('loop_edge_triggered', bench_loop_edge_triggered),
+    ('loop_timers', bench_loop_timers),
+    ('loop_backends', bench_loop_backends),
+    ('loop_dispatch', bench_loop_dispatch),
+]
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# benchmarks of the data path of the TCP relay
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import time
+import socket
+
+from shadowsocks import eventloop, tcprelay
+from benchmarks.util import report, cpu_time, relay_config, \
+    relay_throughput, accepted_conns
+
+
+def bench_relay_cpu(duration):
+    # bytes relayed per CPU second of the loop running sslocal and ssserver,
+    # with and without a protocol overhead
+    configs = [
+        ('none, origin', {}),
+        ('chacha20, auth_sha1_v4', {'method': 'chacha20',
+                                    'protocol': 'auth_sha1_v4'}),
+    ]
+    for name, config in configs:
+        for direction, download in (('upload', False), ('download', True)):
+            stats = {}
+            rate = relay_throughput(duration, download=download,
+                                    stats=stats, **config)
+            report('relay_cpu: %s, %s' % (name, direction),
+                   mb_per_sec='%.1f' % (rate / 1e6),
+                   mb_per_cpu_sec='%.1f' %
+                   (stats['bytes'] / stats['cpu'] / 1e6))
+
+
+class _WriteQueueOwner(object):
+    # the part of TCPRelayHandler _flush_to_sock works with
+
+    _encrypt_correct = False
+    _client_address = ('127.0.0.1', 0)
+    _remote_sock = None
+
+    def __init__(self, sock):
+        self._local_sock = sock
+
+    def _update_activity(self, data_len=0):
+        pass
+
+    def _update_stream(self, stream, status):
+        pass
+
+    def _update_write_status(self, stream, queue):
+        pass
+
+    def destroy(self):
+        raise Exception('write failed')
+
+
+def _join_and_slice(queue, sock):
+    # what _on_local_write did before sendmsg
+    data = b''.join(queue)
+    queue.clear()
+    try:
+        sent = sock.send(data)
+    except (OSError, IOError):
+        sent = 0
+    if sent < len(data):
+        queue.append(data[sent:])
+
+
+def bench_write_queue(duration):
+    # CPU spent flushing a deep backlog of small chunks to a slow reader,
+    # joining and slicing it on every write against sendmsg
+    method = tcprelay.TCPRelayHandler._flush_to_sock
+    flush_to_sock = getattr(method, '__func__', method)
+    chunks = [b'x' * 1400] * 2000
+    for name, flush in (('join and slice', _join_and_slice),
+                        ('sendmsg', None)):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        owner = _WriteQueueOwner(a)
+        written = 0
+        start = cpu_time()
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            queue = tcprelay.WriteBuffer()
+            for chunk in chunks:
+                queue.append(chunk)
+            while queue:
+                if flush is None:
+                    flush_to_sock(owner, queue, a)
+                else:
+                    flush(queue, a)
+                written += len(b.recv(65536))
+        report('write_queue: ' + name,
+               mb_per_cpu_sec='%.1f' %
+               (written / (cpu_time() - start) / 1e6))
+        a.close()
+        b.close()
+
+
+def bench_splice(duration):
+    # bytes relayed per CPU second of the loop for none, origin and plain,
+    # copied through Python against spliced between the sockets
+    if not tcprelay.HAS_SPLICE:
+        print('splice: os.splice not available, skipped')
+        return
+    for name, splice in (('copy', False), ('splice', True)):
+        for direction, download in (('upload', False), ('download', True)):
+            stats = {}
+            rate = relay_throughput(duration, download=download,
+                                    stats=stats, splice=splice)
+            report('splice: %s, %s' % (name, direction),
+                   mb_per_sec='%.1f' % (rate / 1e6),
+                   mb_per_cpu_sec='%.1f' %
+                   (stats['bytes'] / stats['cpu'] / 1e6))
+
+
+def bench_handler_memory(duration):
+    # bytes allocated per accepted connection by TCPRelayHandler, for a
+    # port without and with a protocol and an obfs
+    try:
+        import tracemalloc
+    except ImportError:
+        print('handler_memory: tracemalloc not available, skipped')
+        return
+    conns = 2000
+    configs = [
+        ('none, origin, plain', {}),
+        ('chacha20, auth_chain_a, tls1.2_ticket_auth',
+         {'method': 'chacha20', 'protocol': 'auth_chain_a',
+          'obfs': 'tls1.2_ticket_auth'}),
+    ]
+    for name, config in configs:
+        config = relay_config(**config)
+        loop, dns_resolver, relay, clients, accepted = \
+            accepted_conns(config, conns)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        handlers = []
+        for sock in accepted:
+            handlers.append(tcprelay.TCPRelayHandler(
+                relay, relay._fd_to_handlers, loop, sock, config,
+                dns_resolver, False))
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report('handler_memory: ' + name,
+               bytes_per_conn='%.0f' % ((after - before) / conns))
+        relay.close()
+        for sock in clients:
+            sock.close()
+
+
+class _ClockReadingLoop(object):
+    # a loop whose now reads the clock every time, as the relays did before
+    # EventLoop.now
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    @property
+    def now(self):
+        return eventloop.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self._loop, name)
+
+
+def bench_chunk_bookkeeping(duration):
+    # cost of what a handler does for every chunk besides relaying it:
+    # refresh its timeout, count the bytes against its speed limits and
+    # check them, with the time of the loop iteration or reading the clock
+    conns = 100
+    chunks = 200000
+    config = relay_config(speed_limit_per_con=1 << 20,
+                           speed_limit_per_user=1 << 20)
+    loop, dns_resolver, relay, clients, accepted = \
+        accepted_conns(config, conns)
+    handlers = [tcprelay.TCPRelayHandler(relay, relay._fd_to_handlers, loop,
+                                         sock, config, dns_resolver, False)
+                for sock in accepted]
+    for name, clock in (('clock read per call', _ClockReadingLoop(loop)),
+                        ('loop time', loop)):
+        for handler in handlers:
+            handler._loop = clock
+        samples = []
+        while sum(samples) < duration:
+            start = time.time()
+            for i in range(chunks // conns):
+                for handler in handlers:
+                    handler._update_activity(1024)
+                    handler._add_read(tcprelay.STREAM_DOWN, 1024)
+                    handler._throttle(tcprelay.STREAM_DOWN)
+            samples.append(time.time() - start)
+            loop.now = eventloop.monotonic()
+        report('chunk_bookkeeping: ' + name,
+               ns_per_chunk='%.0f' % (min(samples) * 1e9 / chunks))
+    for handler in handlers:
+        handler._loop = loop
+        handler.destroy()
+    relay.close()
+    dns_resolver.close()
+    for sock in clients:
+        sock.close()
+
+
+BENCHMARKS = [
+    ('relay_cpu', bench_relay_cpu),
+    ('write_queue', bench_write_queue),
+    ('splice', bench_splice),
+    ('handler_memory', bench_handler_memory),
+    ('chunk_bookkeeping', bench_chunk_bookkeeping),
+]
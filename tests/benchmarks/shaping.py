@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# benchmarks of the speed limits
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import time
+import struct
+import socket
+import threading
+
+from shadowsocks import eventloop, asyncdns, tcprelay, shaper
+from benchmarks.util import report, thread_cpu_time, relay_config, \
+    relay_throughput
+
+
+def bench_speed_limit(duration):
+    # how close the relayed rate is to speed_limit_per_con, and the CPU the
+    # loop spends on the throttled connections
+    conns = 4
+    for limit in (256, 4096):
+        for et in (False, True):
+            stats = {}
+            rate = relay_throughput(duration, conns=conns, stats=stats,
+                                    speed_limit_per_con=limit,
+                                    loop_edge_triggered=et)
+            report('speed_limit: %d KB/s%s' % (limit, et and ', ET' or ''),
+                   of_limit='%.2f' % (rate / conns / 1024 / limit),
+                   cpu='%.1f%%' % (stats['cpu'] / duration * 100))
+
+
+def bench_fair_share(duration):
+    # a download through two ports of ssserver under speed_limit_per_node,
+    # one with 8 connections and one with 1, which should get as much
+    limit = 4096
+    conns = (8, 1)
+    loop = eventloop.create_loop()
+    dns_resolver = asyncdns.DNSResolver()
+    dns_resolver.add_to_loop(loop)
+    relays = []
+    local_ports = []
+    for n in conns:
+        config = relay_config(speed_limit_per_node=limit)
+        local_config = dict(config, speed_limit_per_node=0)
+        relays.append(tcprelay.TCPRelay(config, dns_resolver, False))
+        relays.append(tcprelay.TCPRelay(local_config, dns_resolver, True))
+        local_ports.append(config['local_port'])
+    for relay in relays:
+        relay.add_to_loop(loop)
+    cpu = []
+
+    def run():
+        start = thread_cpu_time()
+        loop.run()
+        cpu.append(thread_cpu_time() - start)
+
+    loop_thread = threading.Thread(target=run)
+    loop_thread.daemon = True
+    loop_thread.start()
+
+    sink = socket.socket()
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(sum(conns))
+    deadline = time.time() + duration
+    data = b'x' * 65536
+
+    def pump(conn):
+        try:
+            while time.time() < deadline:
+                conn.sendall(data)
+        except socket.error:
+            pass
+        conn.close()
+
+    def accept():
+        for i in range(sum(conns)):
+            t = threading.Thread(target=pump, args=(sink.accept()[0],))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    received = [0] * len(conns)
+
+    def connect(i):
+        c = socket.create_connection(('127.0.0.1', local_ports[i]))
+        c.sendall(b'\x05\x01\x00')
+        c.recv(2)
+        c.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') +
+                  struct.pack('>H', sink.getsockname()[1]))
+        c.recv(10)
+        c.settimeout(0.1)
+        while time.time() < deadline:
+            try:
+                d = c.recv(262144)
+            except socket.timeout:
+                continue
+            if not d:
+                break
+            received[i] += len(d)
+        c.close()
+
+    clients = [threading.Thread(target=connect, args=(i,))
+               for i, n in enumerate(conns) for j in range(n)]
+    for t in clients:
+        t.start()
+    # the burst of the first second is not shared, and the buffers of the
+    # pumps drain after the deadline, only the rates in between count
+    time.sleep(min(1.5, duration / 3))
+    start = time.time()
+    first = list(received)
+    time.sleep(max(deadline - start - 0.2, 0.1))
+    elapsed = time.time() - start
+    received = [r - f for r, f in zip(received, first)]
+    for t in clients:
+        t.join()
+    loop.call_soon(loop.stop)
+    loop_thread.join()
+    for relay in relays:
+        relay.close()
+    dns_resolver.close()
+    sink.close()
+    shaper.node_up.update_limit(0)
+    shaper.node_down.update_limit(0)
+    for i, n in enumerate(conns):
+        report('fair_share: port with %d conns' % n,
+               KB_per_sec='%.0f' % (received[i] / elapsed / 1024))
+    report('fair_share: node', of_limit='%.2f' %
+           (sum(received) / elapsed / 1024 / limit),
+           cpu='%.1f%%' % (cpu[0] / elapsed * 100))
+
+
+BENCHMARKS = [
+    ('speed_limit', bench_speed_limit),
+    ('fair_share', bench_fair_share),
+]
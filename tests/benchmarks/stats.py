@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# benchmarks of the transfer accounting and of the logging
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import time
+import struct
+import logging
+import binascii
+import collections
+
+from shadowsocks import common, transfer_table, log
+from benchmarks.util import report
+
+
+class _DictTransfer(object):
+    # the per relay dicts the relays counted the users in before the
+    # transfer table, copied and merged on every collection
+
+    def __init__(self):
+        self.ul = {}
+        self.dl = {}
+
+    def add_transfer_u(self, user, transfer):
+        if user not in self.ul:
+            self.ul[user] = 0
+        self.ul[user] += transfer
+
+    def collect(self, relays):
+        ret = {}
+        for relay in relays:
+            u, d = relay.ul.copy(), relay.dl.copy()
+            for uid in u:
+                port = struct.unpack('<I', uid)[0]
+                if port not in ret:
+                    ret[port] = [0, 0]
+                ret[port][0] += u[uid]
+            for uid in d:
+                port = struct.unpack('<I', uid)[0]
+                if port not in ret:
+                    ret[port] = [0, 0]
+                ret[port][1] += d[uid]
+        return ret
+
+
+def bench_transfer_table(duration):
+    # cost of counting a chunk for a user, and of collecting the transfer
+    # of every user of 4 relays, like ServerPool.get_servers_transfer
+    users = 50000
+    uids = [struct.pack('<I', i) for i in range(users)]
+    relays = [_DictTransfer() for i in range(4)]
+    table = transfer_table.TransferTable(users)
+    slots = [table.slot(i) for i in range(users)]
+    adds = users * 4
+
+    def run(add, collect):
+        add_samples = []
+        collect_samples = []
+        while sum(add_samples) + sum(collect_samples) < duration:
+            start = time.time()
+            add()
+            add_samples.append(time.time() - start)
+            start = time.time()
+            collect()
+            collect_samples.append(time.time() - start)
+        return min(add_samples) * 1e9 / adds, min(collect_samples) * 1e3
+
+    def dict_add():
+        for relay in relays:
+            for uid in uids:
+                relay.add_transfer_u(uid, 1)
+
+    def table_add():
+        add_u = table.add_u
+        for i in range(4):
+            for slot in slots:
+                add_u(slot, 1)
+
+    for name, add, collect in (
+            ('dicts', dict_add, lambda: relays[0].collect(relays)),
+            ('table', table_add, table.delta)):
+        add_ns, collect_ms = run(add, collect)
+        report('transfer_table: ' + name, users=users,
+               ns_per_add='%.0f' % add_ns,
+               collect_ms='%.1f' % collect_ms)
+
+
+def bench_logging(duration):
+    # cost of the debug lines of a connection and of a protocol error dump
+    # at the default level, formatted for the logger to drop against lazy
+    n = 200000
+    data = os.urandom(64)
+    addr = ('127.0.0.1', 8388)
+
+    def eager():
+        for i in range(n):
+            logging.debug('destroy: %s:%d' % addr)
+            logging.debug('TCP request %s:%d by user %d' %
+                          (addr[0], addr[1], 0))
+            logging.log(log.VERBOSE_LEVEL, 'data %s' %
+                        binascii.hexlify(data))
+
+    def lazy():
+        for i in range(n):
+            if log.DEBUG:
+                logging.debug('destroy: %s:%d', *addr)
+            if log.CONNECT:
+                common.connect_log('TCP request %s:%d by user %d',
+                                   addr[0], addr[1], 0)
+            if log.VERBOSE:
+                logging.log(log.VERBOSE_LEVEL, 'data %s', log.Hex(data))
+
+    for name, func in (('eager', eager), ('lazy', lazy)):
+        start = time.time()
+        func()
+        report('logging: debug ' + name, ns_per_conn='%.0f' %
+               ((time.time() - start) * 1e9 / n))
+
+    # a protocol error is logged, the dump is hexlified once either way
+    logger = logging.getLogger()
+    handlers, logger.handlers = logger.handlers, [logging.NullHandler()]
+    try:
+        for name, arg in (('eager', None), ('lazy', log.Hex(data))):
+            start = time.time()
+            for i in range(n // 10):
+                if arg is None:
+                    logging.warning('Protocol ERROR, data %s' %
+                                    binascii.hexlify(data))
+                else:
+                    logging.warning('Protocol ERROR, data %s', arg)
+            report('logging: warn ' + name, ns_per_line='%.0f' %
+                   ((time.time() - start) * 1e9 / (n // 10)))
+    finally:
+        logger.handlers = handlers
+
+
+def bench_error_flood(duration):
+    # the lines of a scan, bad connections from many addresses written to
+    # a log file, every line against the limited ones
+    n = 100000
+    data = os.urandom(64)
+    logger = logging.getLogger()
+    handlers = logger.handlers
+    with open(os.devnull, 'w') as f:
+        handler = logging.StreamHandler(f)
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)-8s %(filename)s:%(lineno)s %(message)s'))
+        logger.handlers = [handler]
+        counter = collections.Counter()
+
+        class Count(logging.Filter):
+            def filter(self, record):
+                counter[name] += 1
+                return True
+
+        handler.addFilter(Count())
+        try:
+            for name, line in (('every line', logging.log),
+                               ('limited', None)):
+                limiter = log.RateLimiter()
+                start = time.time()
+                for i in range(n):
+                    ip = '10.0.%d.%d' % (i % 4096 // 256, i % 256)
+                    args = ('Protocol ERROR, TCP ogn data %s from %s:%d',
+                            log.Hex(data), ip, 1024 + i % 60000)
+                    if line:
+                        line(logging.WARN, *args)
+                    else:
+                        limiter.log(ip, logging.WARN, *args)
+                report('error_flood: ' + name, lines=counter[name],
+                       ns_per_error='%.0f' % ((time.time() - start) * 1e9 / n))
+        finally:
+            logger.handlers = handlers
+
+
+BENCHMARKS = [
+    ('transfer_table', bench_transfer_table),
+    ('logging', bench_logging),
+    ('error_flood', bench_error_flood),
+]
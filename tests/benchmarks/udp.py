@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# benchmarks of the UDP relay
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import time
+import struct
+import socket
+import threading
+
+from shadowsocks import eventloop, asyncdns, udprelay, common
+from benchmarks.util import report, thread_cpu_time, relay_config
+
+
+def bench_udp_relay(duration):
+    # UDP packets/sec sent through sslocal and ssserver running in one loop
+    # to a sink, and the CPU time of the loop per packet
+    for name, kwargs in (('ip literal', {}),
+                         ('out_bind', {'out_bind': '127.0.0.1'})):
+        config = relay_config(**kwargs)
+        loop = eventloop.create_loop(config)
+        dns_resolver = asyncdns.DNSResolver()
+        relays = [udprelay.UDPRelay(config, dns_resolver, False),
+                  udprelay.UDPRelay(config, dns_resolver, True)]
+        dns_resolver.add_to_loop(loop)
+        for relay in relays:
+            relay.add_to_loop(loop)
+        cpu = []
+
+        def run():
+            start = thread_cpu_time()
+            loop.run()
+            cpu.append(thread_cpu_time() - start)
+
+        loop_thread = threading.Thread(target=run)
+        loop_thread.daemon = True
+        loop_thread.start()
+
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sink.settimeout(0.5)
+        received = [0]
+
+        def drain():
+            while True:
+                try:
+                    sink.recv(2048)
+                except (OSError, IOError):
+                    return
+                received[0] += 1
+
+        t = threading.Thread(target=drain)
+        t.daemon = True
+        t.start()
+        packet = b'\x00\x00\x00\x01' + socket.inet_aton('127.0.0.1') + \
+            struct.pack('>H', sink.getsockname()[1]) + b'x' * 512
+        # a few clients, each gets its own socket on ssserver
+        clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                   for i in range(4)]
+        local = ('127.0.0.1', config['local_port'])
+        start = time.time()
+        sent = 0
+        while time.time() - start < duration:
+            for c in clients:
+                c.sendto(packet, local)
+            sent += len(clients)
+            # keep the loop from dropping most of them
+            if sent - received[0] > 256:
+                time.sleep(0.0005)
+        elapsed = time.time() - start
+        time.sleep(0.1)
+        loop.call_soon(loop.stop)
+        loop_thread.join()
+        t.join()
+        for relay in relays:
+            relay.close()
+        dns_resolver.close()
+        sink.close()
+        for c in clients:
+            c.close()
+        report('udp_relay: ' + name,
+               pkts_per_sec='%.0f' % (received[0] / elapsed),
+               us_per_pkt='%.1f' % (cpu[0] * 1e6 / max(received[0], 1)))
+    # the address lookup done for every packet, on its own
+    calls = 100000
+    for name, lookup in (
+            ('socket.getaddrinfo',
+             lambda h: socket.getaddrinfo(h, 53, 0, socket.SOCK_DGRAM,
+                                          socket.SOL_UDP)),
+            ('common.getaddrinfo',
+             lambda h: common.getaddrinfo(h, 53, socket.SOCK_DGRAM,
+                                          socket.SOL_UDP))):
+        for host in ('127.0.0.1', '2001:db8::1'):
+            start = time.time()
+            for i in range(calls):
+                lookup(host)
+            report('udp_relay: %s %s' % (name, host),
+                   ns_per_call='%.0f' % ((time.time() - start) * 1e9 / calls))
+
+
+BENCHMARKS = [
+    ('udp_relay', bench_udp_relay),
+]
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# helpers shared by the benchmarks
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import time
+import struct
+import socket
+import threading
+
+from shadowsocks import eventloop, asyncdns, tcprelay
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def report(name, **values):
+    items = ['%s=%s' % (k, values[k]) for k in sorted(values.keys())]
+    print('%-40s %s' % (name, ' '.join(items)))
+
+
+def cpu_time():
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    return time.clock()
+
+
+def thread_cpu_time():
+    # Python 2 has no thread_time, the other threads are counted as well
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    return cpu_time()
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def relay_config(**kwargs):
+    config = {
+        'server': '127.0.0.1', 'server_port': free_port(),
+        'local_address': '127.0.0.1', 'local_port': free_port(),
+        'password': b'benchmark', 'method': 'none', 'protocol': 'origin',
+        'protocol_param': '', 'obfs': 'plain', 'obfs_param': '',
+        'timeout': 60, 'udp_timeout': 60, 'udp_cache': 64,
+        'fast_open': False, 'verbose': 0, 'connect_verbose_info': 0,
+        'forbidden_ip': None, 'forbidden_port': None, 'ignore_bind': [],
+    }
+    config.update(kwargs)
+    return config
+
+
+def relay_throughput(duration, conns=4, chunk=65536, download=False,
+                     stats=None, **kwargs):
+    # bytes/sec sent through sslocal and ssserver running in one loop to a
+    # sink, or from it when download, kwargs go to the config of the relays
+    # and the loop. stats gets the bytes and the CPU seconds of the loop
+    config = relay_config(**kwargs)
+    loop = eventloop.create_loop(config)
+    dns_resolver = asyncdns.DNSResolver()
+    relays = [tcprelay.TCPRelay(config, dns_resolver, False),
+              tcprelay.TCPRelay(config, dns_resolver, True)]
+    dns_resolver.add_to_loop(loop)
+    for relay in relays:
+        relay.add_to_loop(loop)
+    cpu = []
+
+    def run():
+        start = thread_cpu_time()
+        loop.run()
+        cpu.append(thread_cpu_time() - start)
+
+    loop_thread = threading.Thread(target=run)
+    loop_thread.daemon = True
+    loop_thread.start()
+
+    sink = socket.socket()
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(conns)
+    received = [0]
+    deadline = time.time() + duration
+    data = b'x' * chunk
+
+    def drain(conn):
+        while True:
+            data = conn.recv(262144)
+            if not data:
+                break
+            received[0] += len(data)
+        conn.close()
+
+    def pump(conn):
+        while time.time() < deadline:
+            conn.sendall(data)
+        conn.close()
+
+    def accept():
+        for i in range(conns):
+            t = threading.Thread(target=download and pump or drain,
+                                 args=(sink.accept()[0],))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+
+    def connect():
+        c = socket.create_connection(('127.0.0.1', config['local_port']))
+        c.sendall(b'\x05\x01\x00')
+        c.recv(2)
+        c.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') +
+                  struct.pack('>H', sink.getsockname()[1]))
+        c.recv(10)
+        if download:
+            drain(c)
+        else:
+            pump(c)
+
+    start = time.time()
+    clients = [threading.Thread(target=connect) for i in range(conns)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.time() - start
+    loop.call_soon(loop.stop)
+    loop_thread.join()
+    for relay in relays:
+        relay.close()
+    dns_resolver.close()
+    sink.close()
+    if stats is not None:
+        stats['bytes'] = received[0]
+        stats['cpu'] = cpu[0]
+    return received[0] / elapsed
+
+
+def accepted_conns(config, conns):
+    # an ssserver relay and conns connections accepted on its port, without
+    # handlers yet
+    loop = eventloop.EventLoop()
+    dns_resolver = asyncdns.DNSResolver()
+    relay = tcprelay.TCPRelay(config, dns_resolver, False)
+    relay.add_to_loop(loop)
+    listener = relay._server_socket
+    listener.setblocking(True)
+    clients = []
+    accepted = []
+    for i in range(conns):
+        clients.append(socket.create_connection(
+            ('127.0.0.1', config['server_port'])))
+        accepted.append(listener.accept()[0])
+    listener.setblocking(False)
+    return loop, dns_resolver, relay, clients, accepted
+
+
+def short_conns(duration, conns=8, stats=None, **kwargs):
+    # connections/sec made through sslocal and ssserver running in one loop,
+    # each sends a request, reads the reply of the sink and closes. stats
+    # gets the latency summary of the ssserver connections
+    config = relay_config(**kwargs)
+    loop = eventloop.create_loop(config)
+    dns_resolver = asyncdns.DNSResolver()
+    relays = [tcprelay.TCPRelay(config, dns_resolver, False),
+              tcprelay.TCPRelay(config, dns_resolver, True)]
+    dns_resolver.add_to_loop(loop)
+    for relay in relays:
+        relay.add_to_loop(loop)
+    loop_thread = threading.Thread(target=loop.run)
+    loop_thread.daemon = True
+    loop_thread.start()
+
+    sink = socket.socket()
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(1024)
+    deadline = time.time() + duration
+    done = [0]
+
+    def serve():
+        while True:
+            try:
+                conn = sink.accept()[0]
+            except (OSError, IOError):
+                return
+            conn.recv(64)
+            conn.sendall(b'y' * 64)
+            conn.close()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+    request = b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + \
+        struct.pack('>H', sink.getsockname()[1])
+
+    def connect():
+        while time.time() < deadline:
+            c = socket.create_connection(('127.0.0.1', config['local_port']))
+            c.sendall(b'\x05\x01\x00')
+            c.recv(2)
+            c.sendall(request)
+            c.recv(10)
+            c.sendall(b'x' * 64)
+            while c.recv(64):
+                pass
+            c.close()
+            done[0] += 1
+
+    start = time.time()
+    clients = [threading.Thread(target=connect) for i in range(conns)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.time() - start
+    loop.call_soon(loop.stop)
+    loop_thread.join()
+    for relay in relays:
+        relay.close()
+    dns_resolver.close()
+    sink.close()
+    if stats is not None:
+        stats['latency'] = relays[0].latency.summary()
+    return done[0] / elapsed
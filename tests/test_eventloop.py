@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# behaviour of the timers of the event loops and of the caches they sweep
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+
+from shadowsocks import eventloop, asyncioloop, lru_cache
+from shadowsocks.eventloop import monotonic
+
+
+def _loops():
+    # the native loop, level and edge triggered, and asyncio if available
+    configs = [{}, {'loop_edge_triggered': True}]
+    if asyncioloop.asyncio is not None:
+        configs.append({'event_loop': 'asyncio'})
+    for config in configs:
+        yield eventloop.create_loop(config)
+
+
+def _run(loop, seconds):
+    # runs the loop for seconds at most, or until something stops it
+    timer = loop.call_later(seconds, loop.stop)
+    loop.run()
+    loop.cancel(timer)
+
+
+def test_timers_fire_in_deadline_order():
+    for loop in _loops():
+        fired = []
+        for delay, name in ((0.15, 'c'), (0.05, 'a'), (0.1, 'b'),
+                            (0, 'first'), (0, 'second')):
+            loop.call_later(delay, fired.append, name)
+        loop.call_later(0.2, loop.stop)
+        loop.run()
+        assert fired == ['first', 'second', 'a', 'b', 'c'], (loop, fired)
+
+
+def test_idle_loop_wakes_up_for_its_timer():
+    # the poll waits until the next timer, not a fixed period
+    for loop in _loops():
+        fired = []
+        start = monotonic()
+        loop.call_later(0.3, lambda: fired.append(monotonic() - start))
+        loop.call_later(0.3, loop.stop)
+        loop.run()
+        assert len(fired) == 1, (loop, fired)
+        assert 0.3 <= fired[0] < 0.3 + 0.15, (loop, fired)
+
+
+def test_cancelled_timers_never_fire():
+    for loop in _loops():
+        fired = []
+        timers = [loop.call_later(0.01 * (i % 10), fired.append, i)
+                  for i in range(1000)]
+        # most of them, so the native loop drops them from its heap
+        for timer in timers[:700]:
+            loop.cancel(timer)
+        done = loop.call_later(0, fired.append, 'done')
+        _run(loop, 0.2)
+        # once fired, cancelling does nothing
+        loop.cancel(done)
+        loop.cancel(timers[0])
+        fired.remove('done')
+        assert sorted(fired) == list(range(700, 1000)), loop
+        assert [i % 10 for i in fired] == sorted(i % 10 for i in fired), loop
+
+
+def test_timers_added_by_timers_run_at_the_next_iteration():
+    for loop in _loops():
+        count = [0]
+
+        def again():
+            count[0] += 1
+            if count[0] < 100:
+                loop.call_later(0, again)
+            else:
+                loop.stop()
+
+        loop.call_later(0, again)
+        start = monotonic()
+        _run(loop, 5)
+        assert count[0] == 100, (loop, count)
+        assert monotonic() - start < 1, loop
+
+
+def test_sweeper_expires_keys_when_due():
+    for loop in _loops():
+        closed = []
+        cache = lru_cache.LRUCache(
+            timeout=0.3,
+            close_callback=lambda v: closed.append((v, monotonic() - start)))
+        sweeper = lru_cache.Sweeper(loop, cache)
+        start = monotonic()
+        cache['idle'] = 'idle'
+        cache['used'] = 'used'
+
+        def use():
+            cache['used']
+            if monotonic() - start < 1.5:
+                loop.call_later(0.1, use)
+
+        loop.call_later(0.1, use)
+        _run(loop, 0.3 + lru_cache.SWEEP_SLACK + 0.5)
+        sweeper.cancel()
+        # swept once its timeout and the slack are over, the key still
+        # used is kept
+        assert [v for v, t in closed] == ['idle'], (loop, closed)
+        assert 0.3 <= closed[0][1] <= 0.3 + lru_cache.SWEEP_SLACK + 0.2, \
+            (loop, closed)
+        assert 'used' in cache, loop
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# how the shapers share a limit between the users
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import sys
+import os
+import time
+import heapq
+import struct
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+
+from shadowsocks import eventloop, asyncdns, tcprelay, shaper
+
+
+class _Loop(object):
+    # the timers of a loop on a clock of its own
+
+    def __init__(self):
+        self.now = 0.0
+        self._timers = []
+        self._seq = 0
+
+    def call_later(self, delay, callback, *args):
+        self._seq += 1
+        timer = (self.now + delay, self._seq, callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def advance(self, now):
+        while self._timers and self._timers[0][0] <= now:
+            deadline, seq, callback, args = heapq.heappop(self._timers)
+            self.now = deadline
+            callback(*args)
+        self.now = now
+
+
+class _Conn(object):
+    # a connection reading chunks as fast as it is let, or at rate bytes
+    # per second if it has one, the way TCPRelayHandler does: it reads,
+    # and is parked if its user is not admitted anymore
+
+    def __init__(self, user, rate=None, chunk=1400):
+        self.user = user
+        self.rate = rate
+        self.chunk = chunk
+        self.pending = 0
+        self.parked = False
+
+    def _unthrottle(self, stream):
+        self.parked = False
+
+
+def _share(limit, conns, seconds=10, warmup=1, tick=0.001):
+    # bytes per second each user reads after the warmup, the first second
+    # is the burst the bucket holds
+    s = shaper.Shaper(limit)
+    loop = _Loop()
+    s.tester.last_time = 0.0
+    read = {}
+    for i in range(int(seconds / tick)):
+        loop.advance(i * tick)
+        for conn in conns:
+            if conn.rate is None:
+                conn.pending = conn.chunk
+            else:
+                conn.pending += conn.rate * tick
+            if conn.parked or conn.pending < 1:
+                continue
+            n = min(conn.pending, conn.chunk)
+            conn.pending -= n
+            s.add(conn.user, n)
+            if loop.now >= warmup:
+                read[conn.user] = read.get(conn.user, 0) + n
+            if not s.admit(conn.user, loop.now):
+                s.park(loop, conn.user, conn, 0)
+                conn.parked = True
+    seconds -= warmup
+    return dict((user, n / seconds) for user, n in read.items())
+
+
+def test_users_get_the_same_share_whatever_their_connections():
+    limit = 1000
+    conns = [_Conn('a') for i in range(8)] + [_Conn('b')] + \
+        [_Conn('c') for i in range(2)]
+    rates = _share(limit, conns)
+    total = sum(rates.values())
+    assert 0.95 * limit * 1024 <= total <= 1.02 * limit * 1024, rates
+    for user in 'abc':
+        assert abs(rates[user] - total / 3) <= 0.05 * total / 3, rates
+
+
+def test_what_a_light_user_leaves_goes_to_the_others():
+    limit = 1000
+    light = limit * 1024 / 10
+    conns = [_Conn('light', light)] + [_Conn('a') for i in range(4)] + \
+        [_Conn('b')]
+    rates = _share(limit, conns)
+    total = sum(rates.values())
+    # the light user reads all it has, the limit is used up and split
+    # evenly between the others
+    assert rates['light'] >= 0.95 * light, rates
+    assert 0.95 * limit * 1024 <= total <= 1.02 * limit * 1024, rates
+    assert abs(rates['a'] - rates['b']) <= 0.05 * rates['b'], rates
+
+
+def test_a_user_overdrawing_its_share_pays_it_back():
+    # a user reading much more than its share at once gets that much less
+    # later, instead of the others
+    limit = 1000
+    conns = [_Conn('a', chunk=limit * 1024 * shaper.ROUND), _Conn('b')]
+    rates = _share(limit, conns)
+    assert abs(rates['a'] - rates['b']) <= 0.1 * rates['b'], rates
+
+
+def test_ports_under_a_node_limit_get_the_same_share():
+    # a download through two ports of ssserver under speed_limit_per_node,
+    # one with 4 connections and one with 1
+    limit = 2048
+    conns = (4, 1)
+    loop = eventloop.create_loop()
+    dns_resolver = asyncdns.DNSResolver()
+    dns_resolver.add_to_loop(loop)
+    relays = []
+    local_ports = []
+    for n in conns:
+        config = {
+            'server': '127.0.0.1', 'server_port': 0,
+            'local_address': '127.0.0.1', 'local_port': 0,
+            'password': b'test', 'method': 'none', 'protocol': 'origin',
+            'protocol_param': '', 'obfs': 'plain', 'obfs_param': '',
+            'timeout': 60, 'udp_timeout': 60, 'udp_cache': 64,
+            'fast_open': False, 'verbose': 0, 'connect_verbose_info': 0,
+            'forbidden_ip': None, 'forbidden_port': None, 'ignore_bind': [],
+            'speed_limit_per_node': limit,
+        }
+        for key in ('server_port', 'local_port'):
+            s = socket.socket()
+            s.bind(('127.0.0.1', 0))
+            config[key] = s.getsockname()[1]
+            s.close()
+        local_config = dict(config, speed_limit_per_node=0)
+        relays.append(tcprelay.TCPRelay(config, dns_resolver, False))
+        relays.append(tcprelay.TCPRelay(local_config, dns_resolver, True))
+        local_ports.append(config['local_port'])
+    for relay in relays:
+        relay.add_to_loop(loop)
+    loop_thread = threading.Thread(target=loop.run)
+    loop_thread.daemon = True
+    loop_thread.start()
+
+    sink = socket.socket()
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(sum(conns))
+    deadline = time.time() + 4
+    data = b'x' * 65536
+
+    def pump(conn):
+        try:
+            while time.time() < deadline:
+                conn.sendall(data)
+        except socket.error:
+            pass
+        conn.close()
+
+    def accept():
+        for i in range(sum(conns)):
+            t = threading.Thread(target=pump, args=(sink.accept()[0],))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    received = [0] * len(conns)
+
+    def connect(i):
+        c = socket.create_connection(('127.0.0.1', local_ports[i]))
+        c.sendall(b'\x05\x01\x00')
+        c.recv(2)
+        c.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') +
+                  struct.pack('>H', sink.getsockname()[1]))
+        c.recv(10)
+        c.settimeout(0.1)
+        while time.time() < deadline:
+            try:
+                d = c.recv(262144)
+            except socket.timeout:
+                continue
+            if not d:
+                break
+            received[i] += len(d)
+        c.close()
+
+    clients = [threading.Thread(target=connect, args=(i,))
+               for i, n in enumerate(conns) for j in range(n)]
+    try:
+        for t in clients:
+            t.start()
+        # past the burst of the first second
+        time.sleep(1.5)
+        start = time.time()
+        first = list(received)
+        time.sleep(deadline - start - 0.3)
+        elapsed = time.time() - start
+        rates = [(r - f) / elapsed / 1024 for r, f in zip(received, first)]
+        for t in clients:
+            t.join()
+    finally:
+        loop.call_soon(loop.stop)
+        loop_thread.join()
+        for relay in relays:
+            relay.close()
+        dns_resolver.close()
+        sink.close()
+        shaper.node_up.update_limit(0)
+        shaper.node_down.update_limit(0)
+    assert 0.8 * limit <= sum(rates) <= 1.25 * limit, rates
+    assert 0.7 <= rates[0] / rates[1] <= 1.4, rates
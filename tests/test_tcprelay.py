@@ -0,0 +1,476 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# behaviour of sslocal and ssserver relaying through the loopback
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import sys
+import errno
+import os
+import time
+import logging
+import struct
+import socket
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+
+from shadowsocks import eventloop, asyncdns, tcprelay, lru_cache
+from shadowsocks.eventloop import monotonic
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _relay_config(**kwargs):
+    config = {
+        'server': '127.0.0.1', 'server_port': _free_port(),
+        'local_address': '127.0.0.1', 'local_port': _free_port(),
+        'password': b'test', 'method': 'table', 'protocol': 'origin',
+        'protocol_param': '', 'obfs': 'plain', 'obfs_param': '',
+        'timeout': 60, 'udp_timeout': 60, 'udp_cache': 64,
+        'fast_open': False, 'verbose': 0, 'connect_verbose_info': 0,
+        'forbidden_ip': None, 'forbidden_port': None, 'ignore_bind': [],
+    }
+    config.update(kwargs)
+    return config
+
+
+class _Relays(object):
+    # sslocal and ssserver of a config running in a loop of their own, and
+    # an echo server to connect to through them
+
+    def __init__(self, **kwargs):
+        self.config = config = _relay_config(**kwargs)
+        self.loop = eventloop.create_loop(config)
+        self.dns_resolver = asyncdns.DNSResolver()
+        self.relays = [tcprelay.TCPRelay(config, self.dns_resolver, False),
+                       tcprelay.TCPRelay(config, self.dns_resolver, True)]
+        self.dns_resolver.add_to_loop(self.loop)
+        for relay in self.relays:
+            relay.add_to_loop(self.loop)
+        self.echo = socket.socket()
+        self.echo.bind(('127.0.0.1', 0))
+        self.echo.listen(16)
+        self.loop_thread = threading.Thread(target=self.loop.run)
+        echo_thread = threading.Thread(target=self._echo)
+        for t in (self.loop_thread, echo_thread):
+            t.daemon = True
+            t.start()
+
+    def _echo(self):
+        while True:
+            try:
+                conn = self.echo.accept()[0]
+            except (OSError, IOError):
+                return
+            t = threading.Thread(target=self._echo_conn, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _echo_conn(self, conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def connect(self, addr=None):
+        # a socks5 connection through sslocal, to the echo server by default,
+        # ssserver resolves a hostname given as bytes
+        addr = addr or self.echo.getsockname()
+        c = socket.create_connection(('127.0.0.1', self.config['local_port']))
+        c.settimeout(10)
+        c.sendall(b'\x05\x01\x00')
+        assert c.recv(2) == b'\x05\x00'
+        if type(addr[0]) == bytes:
+            host = b'\x03' + struct.pack('>B', len(addr[0])) + addr[0]
+        else:
+            host = b'\x01' + socket.inet_aton(addr[0])
+        c.sendall(b'\x05\x01\x00' + host + struct.pack('>H', addr[1]))
+        assert len(c.recv(10)) == 10
+        return c
+
+    def close(self):
+        # the relays are closed once their loop is done
+        self.loop.call_soon(self.loop.stop)
+        self.loop_thread.join()
+        self.echo.close()
+        for relay in self.relays:
+            relay.close()
+        self.dns_resolver.close()
+
+
+def _recv_all(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk, 'closed after %d bytes' % len(data)
+        data += chunk
+    return data
+
+
+def test_split_frames():
+    # a short read of more than a frame goes to the protocol as whole
+    # frames and the rest in a frame of its own, the other side decodes
+    # them back to the same bytes
+    split_frames = tcprelay.TCPRelayHandler._split_frames
+    splits = []
+
+    def recording(self, data, buffer_size):
+        frames = split_frames(self, data, buffer_size)
+        if len(frames) > 1:
+            splits.append((self._is_local, self._tcp_mss - self._overhead,
+                           [len(frame) for frame in frames]))
+        return frames
+
+    tcprelay.TCPRelayHandler._split_frames = recording
+    try:
+        for protocol in ('auth_aes128_md5', 'auth_aes128_sha1'):
+            del splits[:]
+            relays = _Relays(protocol=protocol, obfs='tls1.2_ticket_auth')
+            try:
+                c = relays.connect()
+                for size in (3000, 1, 4500, 2 * tcprelay.TCP_MSS + 7):
+                    data = os.urandom(size)
+                    c.sendall(data)
+                    assert _recv_all(c, size) == data, protocol
+                c.close()
+            finally:
+                relays.close()
+            for is_local, frame_size, sizes in splits:
+                assert len(sizes) == 2, sizes
+                assert sizes[0] % frame_size == 0, (frame_size, sizes)
+                assert 0 < sizes[1] < frame_size, (frame_size, sizes)
+            # both the upload of sslocal and the download of ssserver
+            sides = [is_local for is_local, frame_size, sizes in splits]
+            assert True in sides and False in sides, (protocol, splits)
+    finally:
+        tcprelay.TCPRelayHandler._split_frames = split_frames
+
+
+def test_write_buffers_stop_reading_at_the_high_watermark():
+    # a reader which doesn't read stops the relays from reading the writer
+    # once what waits for it reaches the high watermark, or the process
+    # limit, and everything arrives once it reads again
+    high = 16384
+    for kwargs, bound in (
+            ({'write_buffer_high': high, 'write_buffer_low': 4096},
+             2 * (high + tcprelay.BUF_SIZE)),
+            ({'write_buffer_limit': 1}, 2 * tcprelay.BUF_SIZE)):
+        before = tcprelay.buffered_bytes()
+        relays = _Relays(**kwargs)
+        sink = socket.socket()
+        sink.bind(('127.0.0.1', 0))
+        sink.listen(1)
+        try:
+            c = relays.connect(sink.getsockname())
+            conn = sink.accept()[0]
+            conn.settimeout(10)
+            # send until nothing moves for a while
+            block = os.urandom(65536)
+            sent = 0
+            c.settimeout(0.5)
+            while True:
+                try:
+                    sent += c.send(block[sent % len(block):])
+                except socket.timeout:
+                    break
+            buffered = tcprelay.buffered_bytes() - before
+            assert 0 < buffered <= bound, (kwargs, buffered)
+            received = 0
+            while received < sent:
+                data = conn.recv(65536)
+                assert data, received
+                offset = received % len(block)
+                expected = (block[offset:] + block)[:len(data)]
+                assert data == expected, received
+                received += len(data)
+            c.close()
+            conn.close()
+        finally:
+            relays.close()
+            sink.close()
+        assert tcprelay.buffered_bytes() == before, kwargs
+
+
+def _echo_through(relays, sizes):
+    c = relays.connect()
+    for size in sizes:
+        data = os.urandom(size)
+        c.sendall(data)
+        assert _recv_all(c, size) == data, size
+    c.close()
+
+
+def test_splice_relays_the_bytes_unchanged():
+    # none, origin and plain are spliced both ways, other methods copied
+    if not tcprelay.HAS_SPLICE:
+        raise unittest.SkipTest('no os.splice')
+    fill = tcprelay.SplicePipe.fill
+    spliced = []
+
+    def recording(self, fd, size):
+        n = fill(self, fd, size)
+        spliced.append(n)
+        return n
+
+    tcprelay.SplicePipe.fill = recording
+    try:
+        for method, splice in (('none', True), ('table', False)):
+            del spliced[:]
+            relays = _Relays(method=method)
+            try:
+                _echo_through(relays, (1, 3000, 1 << 20))
+            finally:
+                relays.close()
+            # the upload of ssserver and the download of sslocal at least
+            assert bool(spliced) == splice, (method, len(spliced))
+            if splice:
+                assert sum(spliced) >= 2 * (1 << 20), sum(spliced)
+    finally:
+        tcprelay.SplicePipe.fill = fill
+
+
+def test_splice_falls_back_to_copying():
+    # when the kernel refuses to splice, the connection copies from then on
+    # and nothing is lost or reordered
+    if not tcprelay.HAS_SPLICE:
+        raise unittest.SkipTest('no os.splice')
+    fill = tcprelay.SplicePipe.fill
+    calls = []
+
+    def refusing(self, fd, size):
+        calls.append(fd)
+        if len(calls) > 4:
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        return fill(self, fd, size)
+
+    tcprelay.SplicePipe.fill = refusing
+    try:
+        relays = _Relays(method='none')
+        try:
+            _echo_through(relays, (1, 3000, 1 << 20, 5))
+            # a new connection falls back at its first splice
+            _echo_through(relays, (1 << 16, 1))
+        finally:
+            relays.close()
+        assert len(calls) > 4, calls
+    finally:
+        tcprelay.SplicePipe.fill = fill
+
+
+def test_ipv4_takes_over_a_failing_ipv6_connect():
+    # ssserver connects to the IPv6 address of a host and to its IPv4 one
+    # as well if that is refused, or not done after CONNECT_ATTEMPT_DELAY,
+    # the first to connect carries the data and the other is closed
+    hostname = b'dualstack.test'
+    sink = socket.socket()
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(16)
+    port = sink.getsockname()[1]
+    try:
+        hole = socket.socket(socket.AF_INET6)
+        hole.bind(('::1', port))
+    except (OSError, IOError):
+        raise unittest.SkipTest('no IPv6 on the loopback')
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                conn = sink.accept()[0]
+            except (OSError, IOError):
+                return
+            accepted.append(conn.getsockname()[0])
+            data = conn.recv(64)
+            conn.sendall(data)
+            conn.close()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+    # the refused connects are logged as errors
+    logging.disable(logging.ERROR)
+    try:
+        for dropped in (False, True):
+            holes = []
+            if dropped:
+                # a full accept queue drops the SYNs
+                hole.listen(0)
+                for i in range(3):
+                    c = socket.socket(socket.AF_INET6)
+                    c.setblocking(False)
+                    c.connect_ex(('::1', port))
+                    holes.append(c)
+            relays = _Relays()
+            relays.dns_resolver._cache[hostname] = '::1'
+            relays.dns_resolver._cache_v4[hostname] = '127.0.0.1'
+            server = relays.relays[0]
+            try:
+                del accepted[:]
+                c = relays.connect((hostname, port))
+                start = monotonic()
+                c.sendall(b'x' * 64)
+                assert _recv_all(c, 64) == b'x' * 64, dropped
+                elapsed = monotonic() - start
+                c.close()
+                if dropped:
+                    assert tcprelay.CONNECT_ATTEMPT_DELAY <= elapsed < \
+                        tcprelay.CONNECT_ATTEMPT_DELAY + 1, elapsed
+                else:
+                    assert elapsed < tcprelay.CONNECT_ATTEMPT_DELAY, elapsed
+                assert accepted == ['127.0.0.1'], accepted
+                # the IPv6 socket which lost is closed with the rest
+                deadline = monotonic() + 5
+                while server._fd_to_handlers and monotonic() < deadline:
+                    time.sleep(0.01)
+                assert not server._fd_to_handlers, server._fd_to_handlers
+            finally:
+                relays.close()
+                for c in holes:
+                    c.close()
+    finally:
+        logging.disable(logging.NOTSET)
+        hole.close()
+        sink.close()
+
+
+def _closed_in(sock, seconds):
+    # how long until the other side closes sock, which must not send
+    sock.settimeout(seconds)
+    start = monotonic()
+    try:
+        assert not sock.recv(64)
+    except socket.error as e:
+        assert not isinstance(e, socket.timeout), 'still open'
+    return monotonic() - start
+
+
+def test_stages_before_the_stream_time_out_on_their_own():
+    # a connection idle in the handshake, or connecting to a host which
+    # doesn't answer, is closed after the timeout of its stage, once the
+    # wheel slot it is filed in and the sweep are over
+    late = lru_cache.WHEEL_SLOT + lru_cache.SWEEP_SLACK + 1
+    relays = _Relays(timeout=30, handshake_timeout=1, connect_timeout=2)
+    # a full accept queue drops the SYNs
+    hole = socket.socket()
+    hole.bind(('127.0.0.1', 0))
+    hole.listen(0)
+    holes = []
+    try:
+        for i in range(3):
+            c = socket.socket()
+            c.setblocking(False)
+            c.connect_ex(hole.getsockname())
+            holes.append(c)
+        for port in (relays.config['server_port'],
+                     relays.config['local_port']):
+            c = socket.create_connection(('127.0.0.1', port))
+            elapsed = _closed_in(c, 10)
+            assert 1 <= elapsed < 1 + late, (port, elapsed)
+            c.close()
+        c = relays.connect(hole.getsockname())
+        c.sendall(b'x')
+        elapsed = _closed_in(c, 10)
+        assert 2 <= elapsed < 2 + late, elapsed
+        c.close()
+        # the stream has the timeout
+        c = relays.connect()
+        time.sleep(2 + late)
+        c.sendall(b'x')
+        assert c.recv(1) == b'x'
+        c.close()
+    finally:
+        relays.close()
+        for c in holes:
+            c.close()
+        hole.close()
+
+
+def test_fast_open_waits_for_the_client_with_the_timeout():
+    # sslocal with fast_open connects once the client sends something, it
+    # may wait longer than the connect timeout for it
+    late = lru_cache.WHEEL_SLOT + lru_cache.SWEEP_SLACK + 1
+    relays = _Relays(timeout=30, connect_timeout=1, fast_open=True)
+    try:
+        c = relays.connect()
+        time.sleep(1 + late)
+        c.sendall(b'x' * 64)
+        assert _recv_all(c, 64) == b'x' * 64
+        c.close()
+    finally:
+        relays.close()
+
+
+def test_listener_backs_off_when_out_of_descriptors():
+    # accept failing with EMFILE doesn't spin the loop, the connections
+    # waiting are accepted once descriptors are freed
+    try:
+        import resource
+    except ImportError:
+        raise unittest.SkipTest('no resource')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # the failed accepts are logged as errors
+    logging.disable(logging.ERROR)
+    try:
+        for et in (False, True):
+            relays = _Relays(loop_edge_triggered=et, method='none')
+            server = relays.relays[0]
+            fill = []
+            clients = []
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+                try:
+                    while True:
+                        fill.append(socket.socket())
+                except socket.error:
+                    pass
+                for s in fill[-8:]:
+                    s.close()
+                del fill[-8:]
+                # the clients take the descriptors freed, ssserver has none
+                for i in range(6):
+                    clients.append(socket.create_connection(
+                        ('127.0.0.1', relays.config['server_port'])))
+                start = os.times()
+                time.sleep(1)
+                cpu = sum(os.times()[:2]) - sum(start[:2])
+                assert cpu < 0.3, (et, cpu)
+                for s in fill[:32]:
+                    s.close()
+                deadline = monotonic() + 5
+                while len(server._fd_to_handlers) < 6 and \
+                        monotonic() < deadline:
+                    time.sleep(0.01)
+                assert len(server._fd_to_handlers) == 6, et
+            finally:
+                for s in fill + clients:
+                    s.close()
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+                relays.close()
+    finally:
+        logging.disable(logging.NOTSET)
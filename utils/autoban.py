@@ -26,14 +26,93 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import sys
+import json
+import time
+import socket
+import signal
 import argparse
+import tempfile
+
+
+def ban(ip, banned):
+    banned.add(ip)
+    cmd = 'iptables -A INPUT -s %s -j DROP' % ip
+    print(cmd, file=sys.stderr)
+    sys.stderr.flush()
+    os.system(cmd)
+
+
+def manager_socket(manager_address):
+    # the socket and the path it is bound to, None for an UDP one
+    path = None
+    if ':' in manager_address:
+        addr = manager_address.rsplit(':', 1)
+        addr = addr[0], int(addr[1])
+        family = socket.getaddrinfo(addr[0], addr[1])[0][0]
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+    else:
+        addr = manager_address
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # the manager replies to the address it got the command from, in
+        # a directory of our own so nobody else can take the name
+        path = os.path.join(tempfile.mkdtemp(prefix='autoban-'),
+                            'autoban.sock')
+        try:
+            sock.bind(path)
+        except socket.error:
+            sock.close()
+            os.rmdir(os.path.dirname(path))
+            raise
+    sock.connect(addr)
+    return sock, path
+
+
+def poll_manager(config):
+    # ask the manager for the protocol errors per address instead of
+    # parsing the log, the counts are since the server started
+    sock, path = manager_socket(config.manager_address)
+    # the path is removed when killed as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        sock.settimeout(1)
+        banned = set()
+        command = 'errors: {"min_count": %d}' % config.count
+        while True:
+            sock.send(command.encode('utf-8'))
+            try:
+                while True:
+                    data = sock.recv(65536).decode('utf-8')
+                    sources = json.loads(data.split(':', 1)[1]) \
+                        .get('sources', {})
+                    for ip in sources:
+                        if ip not in banned:
+                            print(ip)
+                            sys.stdout.flush()
+                            ban(ip, banned)
+            except socket.timeout:
+                pass
+            time.sleep(config.interval)
+    finally:
+        sock.close()
+        if path:
+            os.unlink(path)
+            os.rmdir(os.path.dirname(path))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='See README')
     parser.add_argument('-c', '--count', default=3, type=int,
                         help='with how many failure times it should be '
                              'considered as an attack')
+    parser.add_argument('-m', '--manager-address',
+                        help='poll the manager at this address for the '
+                             'protocol errors instead of reading the log '
+                             'from stdin')
+    parser.add_argument('-i', '--interval', default=10, type=float,
+                        help='seconds between two polls of the manager')
     config = parser.parse_args()
+    if config.manager_address:
+        poll_manager(config)
     ips = {}
     banned = set()
     for line in sys.stdin:
@@ -46,8 +125,4 @@ if __name__ == '__main__':
             else:
                 ips[ip] += 1
             if ip not in banned and ips[ip] >= config.count:
-                banned.add(ip)
-                cmd = 'iptables -A INPUT -s %s -j DROP' % ip
-                print(cmd, file=sys.stderr)
-                sys.stderr.flush()
-                os.system(cmd)
+                ban(ip, banned)